@@ -0,0 +1,10 @@
+#
+# File: __init__
+#
+
+"""
+Offline benchmarks: a fake SmugMug API server and stand-in B2 buckets, so
+that performance can be measured without touching a real account.
+
+Run them with:  python -m benchmarks.run --help
+"""
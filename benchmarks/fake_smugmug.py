@@ -0,0 +1,301 @@
+#
+# File: fake_smugmug
+#
+
+"""
+A local HTTP server that answers the SmugMug v2 API requests made by
+smugmug_to_b2.smugmug, serving a generated tree of folders, albums and
+images.
+
+Responses follow the shape of the real API: objects have Uris, lists come
+in pages, and _expand puts the Album of each child node, and the
+LargestVideo of each video, in the Expansions next to the Response.
+Downloads are generated on the fly, so a big tree doesn't take much
+memory.  Each request can be made to wait, to stand in for the round trip
+to SmugMug.
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from smugmug_to_b2.smugmug import endpoint_name
+from smugmug_to_b2.transport import RequestCounter
+
+API = '/api/v2'
+
+# Downloads are sent this many bytes at a time.
+CHUNK_SIZE = 64 * 1024
+
+
+def content_chunks(key, size):
+    """
+    Yields the content of an image, CHUNK_SIZE bytes at a time.  The content
+    is different for each key.
+    """
+    block = hashlib.sha256(key.encode('utf-8')).digest() * (CHUNK_SIZE // 32)
+    for start in range(0, size, CHUNK_SIZE):
+        yield block[:min(CHUNK_SIZE, size - start)]
+
+
+class FakeImage:
+    def __init__(self, key, file_name, size, is_video):
+        self.key = key
+        self.file_name = file_name
+        self.size = size
+        self.is_video = is_video
+        self._md5 = None
+
+    @property
+    def md5(self):
+        if self._md5 is None:
+            md5 = hashlib.md5()
+            for chunk in content_chunks(self.key, self.size):
+                md5.update(chunk)
+            self._md5 = md5.hexdigest()
+        return self._md5
+
+
+class FakeNode:
+    def __init__(self, key, name, children=None, images=None):
+        self.key = key
+        self.name = name
+        self.children = children
+        self.images = images
+
+
+class FakeTree:
+    """
+    A generated tree: `folders` folders under the root, each holding
+    `albums` albums of `images` images.  Every `video_every`th image is a
+    video, fetched through LargestVideo; zero means no videos.
+    """
+
+    def __init__(self, folders=10, albums=10, images=20, image_size=64 * 1024, video_every=0, video_size=None):
+        self.nodes = {}
+        self.images = {}
+        folder_nodes = []
+        for f in range(folders):
+            album_nodes = []
+            for a in range(albums):
+                album_images = []
+                for i in range(images):
+                    key = 'i%d-%d-%d' % (f, a, i)
+                    is_video = video_every and (i + 1) % video_every == 0
+                    if is_video:
+                        image = FakeImage(key, 'IMG_%04d.mp4' % (i,), video_size or image_size, True)
+                    else:
+                        image = FakeImage(key, 'IMG_%04d.jpg' % (i,), image_size, False)
+                    self.images[key] = image
+                    album_images.append(image)
+                album_nodes.append(self._add(FakeNode('n%d-%d' % (f, a), 'Album %d' % (a,), images=album_images)))
+            folder_nodes.append(self._add(FakeNode('n%d' % (f,), 'Folder %d' % (f,), children=album_nodes)))
+        self.root = self._add(FakeNode('root', '', children=folder_nodes))
+
+    def _add(self, node):
+        self.nodes[node.key] = node
+        return node
+
+    @property
+    def image_count(self):
+        return len(self.images)
+
+    @property
+    def byte_count(self):
+        return sum(image.size for image in self.images.values())
+
+
+class FakeSmugMug:
+    """
+    Serves a FakeTree on a local port, on a thread of its own.  Use as a
+    context manager; origin is where to send requests.
+    """
+
+    def __init__(self, tree, latency=0.0):
+        self.tree = tree
+        self.latency = latency
+        self.counter = RequestCounter()
+        handler = type('Handler', (_Handler,), {'fake': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-smugmug', daemon=True)
+
+    @property
+    def origin(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # The JSON for each kind of object.
+
+    def node_json(self, node):
+        uris = {}
+        if node.children is not None:
+            uris['ChildNodes'] = {'Uri': '%s/node/%s!children' % (API, node.key)}
+        if node.images is not None:
+            uris['Album'] = {'Uri': '%s/album/%s' % (API, node.key)}
+        return {
+            'HasChildren': bool(node.children),
+            'Name': node.name,
+            'Type': 'Album' if node.images is not None else 'Folder',
+            'Uri': '%s/node/%s' % (API, node.key),
+            'Uris': uris,
+        }
+
+    def album_json(self, node):
+        return {
+            'ImagesLastUpdated': '2020-01-01T00:00:00+00:00',
+            'LastUpdated': '2020-01-01T00:00:00+00:00',
+            'Uri': '%s/album/%s' % (API, node.key),
+            'Uris': {'AlbumImages': {'Uri': '%s/album/%s!images' % (API, node.key)}},
+        }
+
+    def image_json(self, image):
+        data = {
+            'ArchivedMD5': image.md5,
+            'ArchivedSize': image.size,
+            'ArchivedUri': '%s/download/%s' % (self.origin, image.key),
+            'Caption': '',
+            'Date': '2020-01-01T00:00:00+00:00',
+            'FileName': image.file_name,
+            'Format': 'MP4' if image.is_video else 'JPG',
+            'ImageKey': image.key,
+            'Keywords': '',
+            'LastUpdated': '2020-01-01T00:00:00+00:00',
+            'Title': '',
+            'Uri': '%s/album/x/image/%s' % (API, image.key),
+            'Uris': {},
+        }
+        if image.is_video:
+            data['Uris']['LargestVideo'] = {'Uri': self.largest_video_uri(image)}
+        return data
+
+    def largest_video_uri(self, image):
+        return '%s/image/%s!largestvideo' % (API, image.key)
+
+    def largest_video_json(self, image):
+        return {
+            'MD5': image.md5,
+            'Size': image.size,
+            'Uri': self.largest_video_uri(image),
+            'Url': '%s/download/%s' % (self.origin, image.key),
+        }
+
+    def respond(self, path, query):
+        """
+        Returns the JSON body for an API path, or None if there's no such thing.
+        """
+        if path == API + '!authuser':
+            user = {'Name': 'bench', 'Uri': API + '/user/bench', 'Uris': {'Node': {'Uri': API + '/node/root'}}}
+            return _object_body(path, 'User', user)
+        object_type, _, rest = path[len(API) + 1:].partition('/')
+        key, _, method = rest.partition('!')
+        expand = query.get('_expand', '')
+        if object_type == 'node' and key in self.tree.nodes:
+            node = self.tree.nodes[key]
+            if method == '':
+                return _object_body(path, 'Node', self.node_json(node))
+            if method == 'children':
+                children = node.children or []
+                expansions = {}
+                if 'Album' in expand:
+                    for child in children:
+                        if child.images is not None:
+                            expansions['%s/album/%s' % (API, child.key)] = {'Album': self.album_json(child)}
+                return _page_body(path, 'Node', children, self.node_json, query, expansions)
+        if object_type == 'album' and key in self.tree.nodes:
+            node = self.tree.nodes[key]
+            if method == '':
+                return _object_body(path, 'Album', self.album_json(node))
+            if method == 'images':
+                expansions = {}
+                if 'LargestVideo' in expand:
+                    for image in node.images:
+                        if image.is_video:
+                            expansions[self.largest_video_uri(image)] = {
+                                'LargestVideo': self.largest_video_json(image)
+                            }
+                return _page_body(path, 'AlbumImage', node.images, self.image_json, query, expansions)
+        if object_type == 'image' and method == 'largestvideo' and key in self.tree.images:
+            return _object_body(path, 'LargestVideo', self.largest_video_json(self.tree.images[key]))
+        return None
+
+
+def _object_body(path, locator, data):
+    return {'Response': {'Uri': path, 'Locator': locator, 'LocatorType': 'Object', locator: data}}
+
+
+def _page_body(path, locator, items, to_json, query, expansions):
+    start = int(query.get('start', 1))
+    count = int(query.get('count', 100))
+    page = items[start - 1:start - 1 + count]
+    response = {
+        'Uri': path,
+        'Locator': locator,
+        'LocatorType': 'Objects',
+        locator: [to_json(item) for item in page],
+        'Pages': {
+            'Total': len(items),
+            'Start': start,
+            'Count': len(page),
+            'RequestedCount': count,
+            'NextPage': path if start - 1 + count < len(items) else None,
+        },
+    }
+    body = {'Response': response}
+    if expansions:
+        body['Expansions'] = expansions
+    return body
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections open, the way SmugMug does.
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = dict(parse_qsl(parts.query))
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        if parts.path.startswith('/download/'):
+            self.fake.counter.count('download')
+            image = self.fake.tree.images.get(parts.path[len('/download/'):])
+            if image is None:
+                self._send_json(404, {'Message': 'not found'})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/mp4' if image.is_video else 'image/jpeg')
+            self.send_header('Content-Length', str(image.size))
+            self.end_headers()
+            for chunk in content_chunks(image.key, image.size):
+                self.wfile.write(chunk)
+            return
+        self.fake.counter.count(endpoint_name(parts.path))
+        body = self.fake.respond(parts.path, query)
+        if body is None:
+            self._send_json(404, {'Message': 'not found'})
+        else:
+            self._send_json(200, body)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,162 @@
+#
+# File: memory_bucket
+#
+
+"""
+Stand-in B2 buckets for benchmarks.
+
+simulator_bucket() makes a bucket on b2sdk's RawSimulator, which behaves
+the most like B2, but keeps every byte uploaded in memory, so it can't say
+much about how much memory a backup needs.
+
+MemoryBucket keeps only the names, sizes and file info of its files, and
+does just enough of what smugmug_to_b2 asks of a bucket, including large
+files, to let a backup run against it.
+"""
+
+import hashlib
+import itertools
+import threading
+
+from b2sdk.v1 import B2Api, InMemoryAccountInfo, RawSimulator
+
+
+def simulator_bucket():
+    raw_api = RawSimulator()
+    api = B2Api(InMemoryAccountInfo(), raw_api=raw_api)
+    key_id, key = raw_api.create_account()
+    api.authorize_account('production', key_id, key)
+    return api.create_bucket('bucket', 'allPrivate')
+
+
+class MemoryFile:
+    """
+    Stands in for both a FileVersionInfo and an unfinished large file.
+    """
+    def __init__(self, id_, file_name, size, file_info, content_sha1=None):
+        self.id_ = id_
+        self.file_id = id_
+        self.file_name = file_name
+        self.size = size
+        self.file_info = file_info
+        self.content_sha1 = content_sha1
+
+
+class MemoryPart:
+    def __init__(self, part_number, content_length, content_sha1):
+        self.part_number = part_number
+        self.content_length = content_length
+        self.content_sha1 = content_sha1
+
+
+class _MemorySession:
+    """
+    The part of B2Api.session used by large_file.
+    """
+    def __init__(self, bucket):
+        self._bucket = bucket
+
+    def upload_part(self, file_id, part_number, content_length, sha1_sum, input_stream):
+        data = input_stream.read()
+        assert len(data) == content_length
+        assert hashlib.sha1(data).hexdigest() == sha1_sum
+        with self._bucket.lock:
+            self._bucket.parts[file_id][part_number] = MemoryPart(part_number, content_length, sha1_sum)
+
+    def finish_large_file(self, file_id, part_sha1_array):
+        with self._bucket.lock:
+            unfinished = self._bucket.unfinished.pop(file_id)
+            parts = self._bucket.parts.pop(file_id)
+            assert [parts[n + 1].content_sha1 for n in range(len(part_sha1_array))] == part_sha1_array
+            unfinished.size = sum(part.content_length for part in parts.values())
+            self._bucket.files[unfinished.file_name] = unfinished
+
+
+class _MemoryApi:
+    def __init__(self, bucket):
+        self.session = _MemorySession(bucket)
+
+
+class MemoryBucket:
+    """
+    A bucket that remembers what files it has, but not what is in them.
+    Safe to use from many threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.unfinished = {}
+        self.parts = {}
+        self.hidden = []
+        self.api = _MemoryApi(self)
+        self._ids = itertools.count(1)
+
+    def _new_id(self):
+        return 'file-%d' % (next(self._ids),)
+
+    def ls(self, folder_to_list='', recursive=False, fetch_count=None):
+        with self.lock:
+            names = sorted(name for name in self.files if name.startswith(folder_to_list))
+            files = [self.files[name] for name in names]
+        last_folder = None
+        for file in files:
+            rest = file.file_name[len(folder_to_list):]
+            if recursive or '/' not in rest:
+                yield file, None
+            else:
+                folder = folder_to_list + rest[:rest.index('/') + 1]
+                if folder != last_folder:
+                    last_folder = folder
+                    yield file, folder
+
+    def _add(self, file_name, size, file_info, sha1=None):
+        file = MemoryFile(self._new_id(), file_name, size, dict(file_info or {}), sha1)
+        with self.lock:
+            self.files[file_name] = file
+        return file
+
+    def upload_bytes(self, data_bytes, file_name, content_type=None, file_info=None, **kwargs):
+        return self._add(file_name, len(data_bytes), file_info, hashlib.sha1(data_bytes).hexdigest())
+
+    def upload_unbound_stream(self, read_only_object, file_name, content_type=None, file_info=None, **kwargs):
+        buffer_size = kwargs.get('buffer_size') or 1024 * 1024
+        size = 0
+        sha1 = hashlib.sha1()
+        while True:
+            data = read_only_object.read(buffer_size)
+            if not data:
+                break
+            size += len(data)
+            sha1.update(data)
+        return self._add(file_name, size, file_info, sha1.hexdigest())
+
+    def copy(self, file_id, new_file_name, content_type=None, file_info=None, **kwargs):
+        with self.lock:
+            [source] = [file for file in self.files.values() if file.id_ == file_id]
+        return self._add(new_file_name, source.size, file_info, source.content_sha1)
+
+    def hide_file(self, file_name):
+        with self.lock:
+            del self.files[file_name]
+            self.hidden.append(file_name)
+
+    def start_large_file(self, file_name, content_type=None, file_info=None, **kwargs):
+        unfinished = MemoryFile(self._new_id(), file_name, 0, dict(file_info or {}))
+        with self.lock:
+            self.unfinished[unfinished.file_id] = unfinished
+            self.parts[unfinished.file_id] = {}
+        return unfinished
+
+    def list_unfinished_large_files(self, prefix=None, **kwargs):
+        with self.lock:
+            return [f for f in self.unfinished.values() if prefix is None or f.file_name.startswith(prefix)]
+
+    def list_parts(self, file_id, **kwargs):
+        with self.lock:
+            return sorted(self.parts[file_id].values(), key=lambda part: part.part_number)
+
+    @property
+    def byte_count(self):
+        with self.lock:
+            return sum(file.size for file in self.files.values())
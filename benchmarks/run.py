@@ -0,0 +1,241 @@
+#
+# File: run
+#
+
+"""
+Runs the offline benchmarks, and reports how fast each one went.
+
+    python -m benchmarks.run [--images 50] [--latency 20] [--json results.json]
+
+Each benchmark reports items per second, bytes per second, the requests
+made to the fake SmugMug, and the peak memory allocated by Python while
+it ran.  The JSON output also has the per-phase stats from metrics.
+Tracing memory slows things down; use --no-memory to get timings without
+it.
+
+The benchmarks are:
+
+    crawl   all_smugmug_images() over the fake SmugMug tree
+    zip     ordered_zip() of two long sorted lists of names
+    backup  backup() from the fake SmugMug into a stand-in bucket
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import requests
+
+from smugmug_to_b2 import smugmug
+from smugmug_to_b2.backup import all_smugmug_images, backup
+from smugmug_to_b2.crawl import Crawler
+from smugmug_to_b2.metrics import run_metrics
+from smugmug_to_b2.smugmug import BaseObject, _get_json
+from smugmug_to_b2.transfer import TransferOptions
+from smugmug_to_b2.transport import mount_pools
+from smugmug_to_b2.util import ordered_zip
+
+from .fake_smugmug import FakeSmugMug, FakeTree
+from .memory_bucket import MemoryBucket, simulator_bucket
+
+KILOBYTE = 1024
+MEGABYTE = 1024 * 1024
+
+BENCHMARKS = ['crawl', 'zip', 'backup']
+
+
+class Result:
+    def __init__(self, name, seconds, items, byte_count, requests, peak_memory, phases=None):
+        self.name = name
+        self.seconds = seconds
+        self.items = items
+        self.byte_count = byte_count
+        self.requests = requests
+        self.peak_memory = peak_memory
+        self.phases = phases or {}
+
+    @property
+    def items_per_second(self):
+        return self.items / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.byte_count / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return dict(
+            name=self.name,
+            seconds=self.seconds,
+            items=self.items,
+            bytes=self.byte_count,
+            items_per_second=self.items_per_second,
+            bytes_per_second=self.bytes_per_second,
+            requests=self.requests,
+            peak_memory=self.peak_memory,
+            phases=self.phases
+        )
+
+    def __str__(self):
+        lines = [
+            '%-8s %8.2f s  %10.1f items/s  %8.2f MB/s  %6d requests  peak %s' % (
+                self.name,
+                self.seconds,
+                self.items_per_second,
+                self.bytes_per_second / MEGABYTE,
+                sum(self.requests.values()),
+                '-' if self.peak_memory is None else '%.1f MB' % (self.peak_memory / MEGABYTE,)
+            )
+        ]
+        for endpoint, count in sorted(self.requests.items()):
+            lines.append('    %-24s %d' % (endpoint, count))
+        return '\n'.join(lines)
+
+
+def _subtract_counts(after, before):
+    return dict((k, v - before.get(k, 0)) for (k, v) in after.items() if v != before.get(k, 0))
+
+
+def measure(name, fn, fake=None, trace_memory=True):
+    """
+    Runs fn, which returns (items, bytes), and returns a Result.  Output
+    printed while it runs is thrown away.
+    """
+    requests_before = fake.counter.as_dict() if fake is not None else {}
+    run_metrics.reset()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            items, byte_count = fn()
+        seconds = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    requests_made = _subtract_counts(fake.counter.as_dict(), requests_before) if fake is not None else {}
+    phases = run_metrics.summary()['phases']
+    return Result(name, seconds, items, byte_count, requests_made, peak_memory, phases)
+
+
+def make_session():
+    return mount_pools(requests.Session())
+
+
+@contextlib.contextmanager
+def pointing_at(fake):
+    """
+    Sends the requests made by smugmug_to_b2.smugmug to the fake server.
+    """
+    saved = smugmug.API_ORIGIN
+    smugmug.API_ORIGIN = fake.origin
+    try:
+        yield
+    finally:
+        smugmug.API_ORIGIN = saved
+
+
+def root_node(session):
+    return BaseObject.make_object(session, 'User', _get_json(session, '/api/v2!authuser')['User']).node
+
+
+def bench_crawl(fake, args):
+    def run():
+        with Crawler(workers=args.crawl_workers) as crawler:
+            count = sum(1 for _ in all_smugmug_images(root_node(make_session()), '', crawler=crawler))
+        assert count == fake.tree.image_count, (count, fake.tree.image_count)
+        return count, 0
+    return run
+
+
+def bench_zip(args):
+    def run():
+        # Two sides that mostly match, each with names the other doesn't have.
+        side_a = ('folder/album/%09d.jpg' % (i,) for i in range(args.zip_items) if i % 10 != 1)
+        side_b = ('folder/album/%09d.jpg' % (i,) for i in range(args.zip_items) if i % 10 != 2)
+        return sum(1 for _ in ordered_zip(side_a, side_b)), 0
+    return run
+
+
+def bench_backup(fake, args):
+    def run():
+        bucket = MemoryBucket() if args.bucket == 'memory' else simulator_bucket()
+        options = TransferOptions(
+            part_size=args.part_size * MEGABYTE,
+            large_file_threshold=args.large_file_threshold * MEGABYTE
+        )
+        with Crawler(workers=args.crawl_workers) as crawler:
+            backup(
+                root_node(make_session()),
+                bucket,
+                '',
+                workers=args.workers,
+                make_session=make_session,
+                options=options,
+                crawler=crawler
+            )
+        return fake.tree.image_count, fake.tree.byte_count
+    return run
+
+
+def run_benchmarks(args):
+    """
+    Runs the benchmarks named in args.only, and returns a list of Results.
+    """
+    tree = FakeTree(
+        folders=args.folders,
+        albums=args.albums,
+        images=args.images,
+        image_size=args.image_size * KILOBYTE,
+        video_every=args.video_every,
+        video_size=args.video_size * KILOBYTE
+    )
+    trace_memory = not args.no_memory
+    results = []
+    with FakeSmugMug(tree, latency=args.latency / 1000.0) as fake, pointing_at(fake):
+        if 'crawl' in args.only:
+            results.append(measure('crawl', bench_crawl(fake, args), fake, trace_memory))
+        if 'zip' in args.only:
+            results.append(measure('zip', bench_zip(args), None, trace_memory))
+        if 'backup' in args.only:
+            results.append(measure('backup', bench_backup(fake, args), fake, trace_memory))
+    return results
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description='Offline benchmarks')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='benchmarks to run')
+    parser.add_argument('--folders', type=int, default=5, help='folders in the fake SmugMug')
+    parser.add_argument('--albums', type=int, default=4, help='albums in each folder')
+    parser.add_argument('--images', type=int, default=50, help='images in each album')
+    parser.add_argument('--image-size', type=int, default=64, help='size of each image in KB')
+    parser.add_argument('--video-every', type=int, default=10, help='every Nth image is a video; 0 for none')
+    parser.add_argument('--video-size', type=int, default=1024, help='size of each video in KB')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added to each request')
+    parser.add_argument('--bucket', choices=['memory', 'simulator'], default='memory', help='stand-in for B2')
+    parser.add_argument('--workers', type=int, default=4, help='transfer workers')
+    parser.add_argument('--crawl-workers', type=int, default=8, help='concurrent SmugMug listing requests')
+    parser.add_argument('--part-size', type=int, default=16, help='upload part size in MB')
+    parser.add_argument('--large-file-threshold', type=int, default=100, help='size in MB for large files')
+    parser.add_argument('--zip-items', type=int, default=1000000, help='names on each side for zip')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace memory")
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    results = run_benchmarks(args)
+    for result in results:
+        print(result)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args=vars(args), results=[r.as_dict() for r in results]), f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#
+# File: startup
+#
+
+"""
+Measures how long the command line takes to start, using the import
+times that python -X importtime reports.
+
+    python -m benchmarks.startup [--top 15] [-- smugmug-to-b2 arguments]
+
+Each run is a new interpreter, so nothing is already imported.  Without
+arguments, it times importing the command line; with them, it runs the
+command, for example `-- --help`, and times everything that imported.
+
+The tool is run from cron and health checks many times a day, so the
+command line only imports what every command needs.  SLOW_MODULES are
+the ones that should wait until a command needs them.
+"""
+
+import argparse
+import subprocess
+import sys
+
+COMMAND_LINE = 'smugmug_to_b2.command_line'
+
+# Imported by the commands that use them, never at startup.
+SLOW_MODULES = ['aiohttp', 'b2sdk', 'oauthlib', 'rauth', 'requests', 'requests_oauthlib', 'yaml']
+
+# Generous, so that a slow machine doesn't fail the test; importing b2sdk
+# at startup would use most of it on its own.
+STARTUP_BUDGET_SECONDS = 0.5
+
+MICROSECONDS = 1000000
+
+
+def import_times(command_args=None):
+    """
+    Starts a new interpreter that imports the command line, or runs it with
+    command_args, and returns {module: (self seconds, cumulative seconds)}
+    for every module imported.
+    """
+    if command_args is None:
+        python_args = ['-c', 'import ' + COMMAND_LINE]
+    else:
+        code = 'import sys; from %s import main; sys.argv[1:] = %r; main()' % (COMMAND_LINE, command_args)
+        python_args = ['-c', code]
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + python_args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        if not self_time.strip().isdigit():
+            # The header line
+            continue
+        times[name.strip()] = (int(self_time) / MICROSECONDS, int(cumulative) / MICROSECONDS)
+    return times
+
+
+def slow_imports(times):
+    """
+    Returns the SLOW_MODULES that were imported.
+    """
+    return [name for name in SLOW_MODULES if name in times]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup', description='Startup benchmark')
+    parser.add_argument('--top', type=int, default=15, help='how many of the slowest imports to list')
+    parser.add_argument('command_args', nargs='*', help='arguments for smugmug-to-b2; put -- before them')
+    args = parser.parse_args(argv)
+    times = import_times(args.command_args or None)
+    total = sum(self_time for (self_time, _) in times.values())
+    print('%d modules imported in %.3f s' % (len(times), total))
+    print('Slow modules imported: %s' % (', '.join(slow_imports(times)) or 'none',))
+    for (name, (self_time, cumulative)) in sorted(times.items(), key=lambda item: -item[1][1])[:args.top]:
+        print('   %8.3f s  %8.3f s  %s' % (cumulative, self_time, name))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
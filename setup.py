@@ -12,12 +12,15 @@ setup(
     packages=['smugmug_to_b2'],
     include_package_data=False,
     install_requires=[
-        'b2sdk',
+        'b2sdk>=1.20.0',
         'PyYAML',
         'rauth',
         'requests',
         'requests_oauthlib'
     ],
+    extras_require={
+        'async': ['aiohttp']
+    },
     tests_require=[
         'pytest'
     ],
@@ -0,0 +1,404 @@
+#
+# File: async_smugmug
+#
+
+"""
+An asyncio client for the SmugMug API.
+
+Walking a big SmugMug account is thousands of small requests, and each one
+is almost all waiting.  A thread can only wait on one request at a time; a
+coroutine waiting costs next to nothing, so thousands of requests can be
+in flight, queued for a few connections, without a thread for each.
+
+AsyncSmugMug has awaitable versions of the properties in smugmug.py that
+make requests: children, album, images, largest_video and content.  The
+objects they return are the same Node, Album and AlbumImage objects, so
+everything that reads their fields works unchanged.
+
+AsyncCrawler is the sync facade.  It has the same submit() as Crawler, so
+all_smugmug_images can walk the tree with it, and it runs the event loop
+on a thread of its own.
+
+aiohttp is only needed here, and only imported when an AsyncSession is
+made, so the rest of the tool works without it:
+
+    pip install smugmug_to_b2[async]
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+
+from oauthlib.oauth1 import Client as OAuth1Client
+
+from . import smugmug
+from .exception import AppError, ContentError, HttpError
+from .metrics import CRAWL, run_metrics
+from .smugmug import (
+    PIN_PATH,
+    BaseObject,
+    _add_page,
+    _raise_http_error,
+    _read_json_dict,
+    _remaining_page_starts,
+    _unpack_response,
+    _with_query,
+    endpoint_name,
+    request_counter,
+)
+from .transport import RETRY_STATUSES, report_throttle, retry_counter, retry_policy
+
+# Connections kept open to each host.
+DEFAULT_CONNECTIONS = 8
+
+# Requests waiting for a connection, or using one, at once.
+DEFAULT_IN_FLIGHT = 1000
+
+# How many nodes ahead AsyncCrawler asks for the contents of, in all.
+DEFAULT_DISTANCE = 256
+
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise AppError('the async SmugMug client needs aiohttp: pip install aiohttp')
+    return aiohttp
+
+
+class AsyncResponse:
+    """
+    The parts of a response that are used, read in full.
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+
+class AsyncSession:
+    """
+    An aiohttp session whose requests are signed with OAuth1.  It has to be
+    made, used and closed on the same running event loop.
+    """
+
+    def __init__(self, oauth_client=None, connections=DEFAULT_CONNECTIONS):
+        aiohttp = _import_aiohttp()
+        import yarl  # comes with aiohttp
+        self._url_class = yarl.URL
+        self._oauth_client = oauth_client
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=connections))
+        self.connection_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+    async def get(self, url, headers=None):
+        headers = dict(headers or {})
+        if self._oauth_client is not None:
+            url, signed_headers, _ = self._oauth_client.sign(url)
+            headers.update(signed_headers)
+        # The URL was signed as it is, so aiohttp must not re-encode it.
+        async with self._session.get(self._url_class(url, encoded=True), headers=headers) as response:
+            return AsyncResponse(response.status, response.headers, await response.read())
+
+    async def close(self):
+        await self._session.close()
+
+
+def make_async_session(connections=DEFAULT_CONNECTIONS, pin_path=PIN_PATH):
+    """
+    Returns a new AsyncSession using the access token saved by set_pin.
+    """
+    info = _read_json_dict(pin_path)
+    oauth_client = OAuth1Client(
+        info['key'],
+        client_secret=info['secret'],
+        resource_owner_key=info['access_token'],
+        resource_owner_secret=info['access_token_secret']
+    )
+    return AsyncSession(oauth_client, connections)
+
+
+class AsyncSmugMug:
+    """
+    Awaitable ways to get the things SmugMug objects refer to.
+
+    session is an AsyncSession, or anything else with the same get() and
+    connection_errors.  Objects returned keep the session of the object
+    they came from, so their properties still work without the event loop.
+    """
+
+    def __init__(self, session, in_flight=DEFAULT_IN_FLIGHT, sleep=asyncio.sleep):
+        self.session = session
+        self._in_flight = asyncio.Semaphore(in_flight)
+        self._sleep = sleep
+
+    async def _send(self, url, endpoint, headers=None):
+        """
+        Like send_with_retry, but waits without holding a thread.
+        """
+        policy = retry_policy()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy.max_total_time
+        attempt = 1
+        while True:
+            response = None
+            error = None
+            try:
+                async with self._in_flight:
+                    response = await self.session.get(url, headers)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                report_throttle('smugmug', response.status_code)
+            except self.session.connection_errors as e:
+                error = e
+            delay = policy.delay(attempt, response)
+            if deadline < loop.time() + delay:
+                if error is not None:
+                    raise error
+                return response
+            retry_counter.count(endpoint)
+            print('RETRY   ', endpoint, response.status_code if response is not None else repr(error))
+            await self._sleep(delay)
+            attempt += 1
+
+    async def get_json(self, path):
+        endpoint = endpoint_name(path)
+        request_counter.count(endpoint)
+        response = await self._send(smugmug.API_ORIGIN + path, endpoint, {'Accept': 'application/json'})
+        if response.status_code != 200:
+            _raise_http_error(response.status_code, response.text)
+        return _unpack_response(json.loads(response.text))
+
+    async def get_paged_json(self, path):
+        """
+        Gets all of the pages of a list, and returns them as one response.
+        All of the pages after the first are asked for at once.
+        """
+        result = await self.get_json(_with_query(path, start=1, count=smugmug._page_size))
+        page_count, starts = _remaining_page_starts(result)
+        batches = await asyncio.gather(
+            *(self.get_json(_with_query(path, start=start, count=page_count)) for start in starts)
+        )
+        for one_batch in batches:
+            _add_page(result, one_batch)
+        return result
+
+    async def iter_paged_json(self, path):
+        """
+        Yields the pages of a list, in order, like smugmug._iter_paged_json.
+        The pages after the first are asked for a few at a time, so that no
+        more than that many are held in memory waiting to be used.
+        """
+        first = await self.get_json(_with_query(path, start=1, count=smugmug._page_size))
+        page_count, starts = _remaining_page_starts(first)
+        yield first
+        page_workers = smugmug._page_workers
+        for i in range(0, len(starts), page_workers):
+            batch = starts[i:i + page_workers]
+            pages = await asyncio.gather(
+                *(self.get_json(_with_query(path, start=start, count=page_count)) for start in batch)
+            )
+            for page in pages:
+                yield page
+
+    async def _get_from_uri(self, obj, uri_name):
+        expanded = obj._expanded(uri_name)
+        if expanded is not None:
+            return expanded
+        return obj._objects_from(await self.get_paged_json(obj._query_path(uri_name)))
+
+    async def _iter_from_uri(self, obj, uri_name):
+        """
+        Yields the objects in a list at one of obj's URIs, a page at a time.
+        """
+        expanded = obj._expanded(uri_name)
+        if expanded is not None:
+            for item in expanded:
+                yield item
+            return
+        async for page in self.iter_paged_json(obj._query_path(uri_name)):
+            for item in obj._objects_from(page):
+                yield item
+
+    async def auth_user(self, session=None):
+        """
+        Returns the User, whose objects make their requests through session.
+        """
+        return BaseObject.make_object(session, 'User', (await self.get_json('/api/v2!authuser'))['User'])
+
+    async def node(self, user):
+        return await self._get_from_uri(user, 'Node')
+
+    async def children(self, node):
+        assert node.has_children
+        assert not node.has_album
+        return await self._get_from_uri(node, 'ChildNodes')
+
+    async def album(self, node):
+        return await self._get_from_uri(node, 'Album')
+
+    async def images(self, album):
+        return await self._get_from_uri(album, 'AlbumImages')
+
+    def iter_images(self, album):
+        """
+        Yields the AlbumImages a page at a time, like Album.iter_images.
+        """
+        return self._iter_from_uri(album, 'AlbumImages')
+
+    async def largest_video(self, image):
+        return await self._get_from_uri(image, 'LargestVideo')
+
+    async def node_contents(self, node):
+        """
+        Like crawl.node_contents: the child nodes of a folder, or the
+        ImageRecords of an album node.
+        """
+        with run_metrics.timed(CRAWL):
+            if node.has_children:
+                return await self.children(node)
+            elif node.has_album:
+                album = await self.album(node)
+                return [image.record() async for image in self.iter_images(album)]
+            else:
+                return []
+
+    async def content(self, image):
+        """
+        Returns the bytes of an image, or of the LargestVideo of a video,
+        after checking their size and MD5.
+        """
+        fmt = image.data['Format']
+        if fmt == 'JPG':
+            url, byte_count, md5 = image.archived_uri, image.byte_count, image.archived_md5
+        elif fmt == 'MP4':
+            video = await self.largest_video(image)
+            url, byte_count, md5 = video.url, video.size, video.md5
+        else:
+            raise AppError('unknown format: ' + fmt)
+        request_counter.count('download')
+        response = await self._send(url, 'download')
+        if response.status_code != 200:
+            raise HttpError('status = %d %s' % (response.status_code, response.text,))
+        content = response.content
+        if len(content) != byte_count:
+            raise ContentError('expected %d bytes, got %d: %s' % (byte_count, len(content), url))
+        md5_hash = hashlib.md5(content).hexdigest()
+        if md5_hash != md5:
+            raise ContentError('expected MD5 %s, got %s: %s' % (md5, md5_hash, url))
+        return content
+
+
+class _FetchedAhead:
+    """
+    The Future for contents fetched ahead.  Taking its result gives back
+    its place in the crawler's lookahead.
+    """
+
+    def __init__(self, future, ahead):
+        self._future = future
+        self._ahead = ahead
+
+    def result(self):
+        try:
+            return self._future.result()
+        finally:
+            if self._ahead is not None:
+                self._ahead.release()
+                self._ahead = None
+
+
+class _Deferred:
+    """
+    Looks like a Future, but fetches the contents when the result is asked for.
+    """
+
+    def __init__(self, crawler, node):
+        self._crawler = crawler
+        self._node = node
+
+    def result(self):
+        return self._crawler.run(self._crawler.client.node_contents(self._node))
+
+
+class AsyncCrawler:
+    """
+    Looks like a Crawler, but fetches node contents with an AsyncSmugMug.
+
+    The event loop runs on a thread of its own, and submit() returns a
+    concurrent.futures.Future, so the walk in all_smugmug_images doesn't
+    need to know.  Waiting siblings cost a coroutine each, not a thread,
+    so the default distance is much farther ahead than a Crawler's.
+
+    The walk looks distance siblings ahead at each level of the tree, so
+    distance is also the most contents fetched and not yet used, across
+    all of the levels.  Past that, contents are fetched when asked for.
+
+    make_session is called on the event loop to make the AsyncSession.
+    """
+
+    def __init__(self, distance=DEFAULT_DISTANCE, make_session=make_async_session, in_flight=DEFAULT_IN_FLIGHT):
+        self.distance = distance
+        self._ahead = threading.BoundedSemaphore(max(1, distance))
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='async-crawl', daemon=True)
+        self._thread.start()
+        self._client = None
+        try:
+            self._client = self._call(self._start(make_session, in_flight))
+        except BaseException:
+            self.close()
+            raise
+
+    async def _start(self, make_session, in_flight):
+        return AsyncSmugMug(make_session(), in_flight)
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def submit(self, node):
+        """
+        Starts fetching the contents of a node, and returns a Future for them.
+        """
+        if not self._ahead.acquire(blocking=False):
+            return _Deferred(self, node)
+        future = asyncio.run_coroutine_threadsafe(self._client.node_contents(node), self._loop)
+        return _FetchedAhead(future, self._ahead)
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the crawler's event loop, and returns its result.
+        """
+        return self._call(coroutine)
+
+    @property
+    def client(self):
+        return self._client
+
+    async def _stop(self):
+        # Contents fetched ahead that nobody is going to ask for.
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._client is not None:
+            await self._client.session.close()
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        self._call(self._stop())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
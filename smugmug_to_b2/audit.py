@@ -0,0 +1,269 @@
+#
+# File: audit
+#
+
+"""
+Checking that the bucket still matches SmugMug, without downloading it.
+
+An audit walks SmugMug and lists the bucket, both in parallel, the same
+way a backup does, and matches them up by name.  For each image that is
+in both, the MD5 that SmugMug has for the original is compared with the
+archived_md5 stored in the B2 file info when it was uploaded, and the size
+of the B2 file with the size of the content SmugMug would give us, which
+for a video is its LargestVideo.  What it finds is one of:
+
+    MISSING   in SmugMug, but not in the bucket
+    ORPHAN    in the bucket, but not in SmugMug
+    MISMATCH  in both, but the metadata, checksum or size is different
+
+Files uploaded by versions of this program that didn't store archived_md5
+only have their sizes checked.  A video whose LargestVideo wasn't in the
+listing doesn't have its size checked, because finding out the size would
+take a request for each one; if it is sampled, its content is checked.
+
+None of that reads any content.  With a sample rate, that fraction of
+the files that look right is also downloaded from B2, hashed as it
+streams, and checked against the MD5 from SmugMug.  Content that doesn't
+match is CORRUPT, and a sample that couldn't be checked at all is FAILED.
+The downloads run on a pool of workers while the listing goes on.
+"""
+
+import contextlib
+import hashlib
+import random
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from b2sdk.v1 import AbstractDownloadDestination
+
+from .backup import all_b2_images, all_smugmug_images, images_match
+from .exception import AuditError
+from .reconcile import RECONCILE_STREAM, reconciled_zip, top_level_folder
+
+MISSING = 'MISSING '
+ORPHAN = 'ORPHAN  '
+MISMATCH = 'MISMATCH'
+CORRUPT = 'CORRUPT '
+FAILED = 'FAILED  '
+PROBLEM_KINDS = [MISSING, ORPHAN, MISMATCH, CORRUPT, FAILED]
+
+MEGABYTE = 1024 * 1024
+
+
+class AuditReport:
+    """
+    What an audit found.  Problems are printed as they are found, and kept
+    as (kind, b2_path, reason) in problems.  Safe to add to from more than
+    one thread.
+    """
+
+    def __init__(self):
+        self.checked_count = 0
+        self.sampled_count = 0
+        self.sampled_bytes = 0
+        self.problems = []
+        self._lock = threading.Lock()
+
+    def add_problem(self, kind, b2_path, reason=''):
+        print(kind, b2_path, reason)
+        with self._lock:
+            self.problems.append((kind, b2_path, reason))
+
+    def add_sample(self, byte_count):
+        with self._lock:
+            self.sampled_count += 1
+            self.sampled_bytes += byte_count
+
+    def count(self, kind):
+        return sum(1 for (k, _, _) in self.problems if k == kind)
+
+    def print_summary(self):
+        print()
+        print('Audit:')
+        print('   %8d  files in both' % (self.checked_count,))
+        print('   %8d  files sampled, %.1f MB' % (self.sampled_count, self.sampled_bytes / MEGABYTE))
+        for kind in PROBLEM_KINDS:
+            print('   %8d  %s' % (self.count(kind), kind.strip().lower()))
+
+    def raise_if_problems(self):
+        if self.problems:
+            raise AuditError(len(self.problems))
+
+
+def mismatches(a, b):
+    """
+    Returns the ways the B2 file b doesn't match the SmugMug image a, which
+    is empty if it looks right.  Nothing is looked up in SmugMug.
+    """
+    reasons = []
+    if not images_match(a, b):
+        reasons.append('metadata differs')
+    if b.archived_md5 is not None and b.archived_md5 != a.archived_md5:
+        reasons.append('archived MD5 is %s in B2, %s in SmugMug' % (b.archived_md5, a.archived_md5))
+    byte_count = a.listed_content_size
+    if b.size is not None and byte_count is not None and b.size != byte_count:
+        reasons.append('%d bytes in B2, %d in SmugMug' % (b.size, byte_count))
+    return reasons
+
+
+class _HashingWriter:
+    """
+    A file to download into that keeps only the MD5 and size of what is
+    written.  It can't seek, so b2sdk writes it in order.
+    """
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.byte_count = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.byte_count += len(data)
+        return len(data)
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+
+class _HashingDestination(AbstractDownloadDestination):
+    def __init__(self):
+        self.writer = _HashingWriter()
+
+    def make_file_context(
+            self, file_id, file_name, content_length, content_type, content_sha1, file_info, mod_time_millis,
+            range_=None
+    ):
+        return contextlib.nullcontext(self.writer)
+
+
+def hash_b2_file(bucket, b):
+    """
+    Downloads the content of a B2Image, and returns (byte_count, md5) of
+    what was read.
+    """
+    destination = _HashingDestination()
+    bucket.download_file_by_id(b.file_id, destination)
+    return destination.writer.byte_count, destination.writer.md5.hexdigest()
+
+
+class Sampler:
+    """
+    Checks the content of sampled files on a pool of worker threads.
+
+    make_bucket is called once in each worker thread.  When it is not
+    given, workers use the bucket passed in.
+    """
+
+    def __init__(self, bucket, report, worker_count=1, make_bucket=None):
+        assert 1 <= worker_count
+        self._bucket = bucket
+        self._report = report
+        self._make_bucket = make_bucket
+        self._local = threading.local()
+        # Keeps the listing from getting far ahead of the downloads.
+        self._slots = threading.BoundedSemaphore(2 * worker_count)
+        self._executor = ThreadPoolExecutor(
+            max_workers=worker_count,
+            thread_name_prefix='audit',
+            initializer=self._init_worker
+        )
+
+    def _init_worker(self):
+        self._local.bucket = self._make_bucket() if self._make_bucket is not None else self._bucket
+
+    def submit(self, a, b):
+        self._slots.acquire()
+        try:
+            self._executor.submit(self._run, a, b)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _run(self, a, b):
+        try:
+            self._check(a, b)
+        except Exception as e:
+            self._report.add_problem(FAILED, b.b2_path, repr(e))
+        finally:
+            self._slots.release()
+
+    def _check(self, a, b):
+        print('SAMPLE  ', b.b2_path)
+        try:
+            _, expected_size, expected_md5 = a.content_location()
+        except Exception as e:
+            self._report.add_problem(FAILED, b.b2_path, 'SmugMug lookup failed: %r' % (e,))
+            return
+        try:
+            byte_count, md5 = hash_b2_file(self._local.bucket, b)
+        except Exception as e:
+            self._report.add_problem(FAILED, b.b2_path, 'B2 download failed: %r' % (e,))
+            return
+        self._report.add_sample(byte_count)
+        if (byte_count, md5) != (expected_size, expected_md5):
+            self._report.add_problem(
+                CORRUPT, b.b2_path,
+                'read %d bytes with MD5 %s, expected %d bytes with MD5 %s' % (
+                    byte_count, md5, expected_size, expected_md5
+                )
+            )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def audit(
+        top_node,
+        bucket,
+        prefix,
+        crawler=None,
+        list_workers=1,
+        list_page_size=None,
+        sample=0.0,
+        sample_workers=1,
+        make_bucket=None,
+        reconcile=RECONCILE_STREAM,
+        choose=random.random
+):
+    """
+    Compares the bucket with SmugMug, and returns an AuditReport.
+
+    sample is the fraction, from 0 to 1, of the files that look right whose
+    content is downloaded and checked, by sample_workers threads at once.
+    choose() returns a number from 0 to 1 for each file, and the file is
+    sampled if it is less than sample.
+
+    The rest of the arguments are the same as for backup.
+    """
+    report = AuditReport()
+    pairs = reconciled_zip(
+        all_smugmug_images(top_node, prefix, crawler=crawler),
+        all_b2_images(bucket, prefix, list_workers, list_page_size),
+        key=lambda x: x.b2_path,
+        mode=reconcile,
+        group=lambda b2_path: top_level_folder(b2_path, prefix)
+    )
+    with Sampler(bucket, report, sample_workers, make_bucket) as sampler:
+        for a, b in pairs:
+            if b is None:
+                report.add_problem(MISSING, a.b2_path)
+            elif a is None:
+                report.add_problem(ORPHAN, b.b2_path)
+            else:
+                report.checked_count += 1
+                reasons = mismatches(a, b)
+                if reasons:
+                    report.add_problem(MISMATCH, a.b2_path, '; '.join(reasons))
+                elif sample and choose() < sample:
+                    sampler.submit(a, b)
+    return report
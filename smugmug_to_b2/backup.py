@@ -7,8 +7,19 @@ Syncs the contents of SmugMug to a B2 bucket.
 """
 
 import hashlib
+import itertools
+import time
 
-from .util import ordered_zip
+from .crawl import Crawler
+from .dedupe import DEDUPE_OFF, ContentIndex
+from .exception import TransferError
+from .journal import Journal, ResumePoint, read_journal
+from .leases import LEASE_FOLDER
+from .listing import parallel_ls
+from .reconcile import RECONCILE_STREAM, reconciled_zip, top_level_folder
+from .state import AlbumChanges, StateImage
+from .transfer import COPY, HIDE, KEEP, REUPLOAD, UPLOAD, Action, TransferPool
+from .util import all_before
 
 
 def hash_metadata(caption, date, file_name, keywords, title):
@@ -17,19 +28,57 @@ def hash_metadata(caption, date, file_name, keywords, title):
 
 
 class SmugMugImage:
-    def __init__(self, parent_prefix, image):
-        self.image = image
-        self.archived_md5 = image.archived_md5
-        self.archived_url = image.archived_uri
-        self.caption = image.caption
-        self.date = image.date
-        self.file_name = image.file_name
-        self.keywords = image.keywords
-        self.title = image.title
-        parts = self.file_name.split('.')
-        meta_hash = hash_metadata(self.caption, self.date, self.file_name, self.keywords, self.title)
+    """
+    An image in SmugMug, and the path it is backed up to in B2.
+
+    The fields come from an ImageRecord, which is kept instead of copying
+    them, so an album's worth of these takes as little memory as possible.
+    """
+    __slots__ = ('album', 'b2_path', 'record')
+
+    def __init__(self, parent_prefix, record):
+        self.album = parent_prefix
+        self.record = record
+        parts = record.file_name.split('.')
+        meta_hash = hash_metadata(record.caption, record.date, record.file_name, record.keywords, record.title)
         self.b2_path = parent_prefix + '.'.join(parts[:-1]) + '.' + meta_hash + '.' + parts[-1]
 
+    @property
+    def archived_md5(self):
+        return self.record.archived_md5
+
+    @property
+    def byte_count(self):
+        return self.record.byte_count
+
+    @property
+    def caption(self):
+        return self.record.caption
+
+    @property
+    def date(self):
+        return self.record.date
+
+    @property
+    def file_name(self):
+        return self.record.file_name
+
+    @property
+    def image_key(self):
+        return self.record.image_key
+
+    @property
+    def keywords(self):
+        return self.record.keywords
+
+    @property
+    def last_updated(self):
+        return self.record.last_updated
+
+    @property
+    def title(self):
+        return self.record.title
+
     def __repr__(self):
         return 'SM:' + self.b2_path
 
@@ -38,18 +87,101 @@ class SmugMugImage:
 
     @property
     def content(self):
-        return self.image.content
+        return self.record.content
+
+    def open_content(self, session=None):
+        """
+        Returns a stream of the content, using the given session instead of
+        the one the image was listed with, if there is one.
+        """
+        record = self.record if session is None else self.record.with_session(session)
+        return record.open_content()
+
+    def content_location(self, session=None):
+        """
+        Returns (url, byte_count, md5) of the content, which for a video is
+        the LargestVideo, not the archived original.  A video that has to be
+        looked up is looked up with the given session, if there is one, and
+        kept, so that opening the content doesn't look it up again.
+        """
+        record = self.record if session is None else self.record.with_session(session)
+        location = record.content_location()
+        if record is not self.record:
+            self.record.content_url, self.record.content_size, self.record.content_md5 = location
+        return location
 
+    @property
+    def listed_content_size(self):
+        """
+        The size of the content, which for a video is the LargestVideo, if
+        it is known without a request.  None for a video whose LargestVideo
+        wasn't in the listing, until content_location() has been called.
+        """
+        return self.record.content_size
 
-def all_smugmug_images(node, prefix, is_root=True, parent_prefix=''):
+    @property
+    def content_size(self):
+        """
+        The size of the content, or of the archived original if finding out
+        the size of the content would take a request.
+        """
+        size = self.listed_content_size
+        return self.record.byte_count if size is None else size
+
+
+def _prefix_matches(prefix, my_prefix):
+    return prefix.startswith(my_prefix) or my_prefix.startswith(prefix)
+
+
+def _should_list(node, my_prefix, album_changes):
+    """
+    Returns False for an album node whose images don't need to be listed
+    because it hasn't changed.
+    """
+    if album_changes is None or not node.has_album:
+        return True
+    if album_changes.should_list(my_prefix, node.album):
+        return True
+    print(f'Unchanged smugmug: {node}')
+    return False
+
+
+def _is_past(my_prefix, start_after):
+    """
+    Returns True for a folder that was finished before the point a backup is resuming from.
+    """
+    return start_after is not None and all_before(my_prefix, start_after)
+
+
+def all_smugmug_images(
+        node,
+        prefix,
+        is_root=True,
+        parent_prefix='',
+        crawler=None,
+        contents=None,
+        album_changes=None,
+        start_after=None
+):
     """
     Yields all of the SmugMugImages stored in SmugMug
     :param node:
     :param prefix:
     :param is_root:
     :param parent_prefix:
+    :param crawler: a Crawler used to fetch the contents of the next few siblings ahead of time
+    :param contents: a future for the contents of this node, if they have already been asked for
+    :param album_changes: an AlbumChanges that decides which albums to skip
+    :param start_after: only images after this b2_path are yielded, and folders before it are skipped
     :return:
     """
+    if crawler is None:
+        with Crawler() as crawler:
+            yield from all_smugmug_images(
+                node, prefix, is_root, parent_prefix, crawler, contents, album_changes, start_after
+            )
+        return
+
     print(f'Checking smugmug: {node}')
     # Build the file name prefix to use for children
     if is_root:
@@ -64,30 +196,51 @@ def all_smugmug_images(node, prefix, is_root=True, parent_prefix=''):
     assert not (has_children and has_album)
 
     # Only look at these images/folders if the prefix matches
-    if prefix.startswith(my_prefix) or my_prefix.startswith(prefix):
-
-        # Yield all of the images in all children
+    if _prefix_matches(prefix, my_prefix):
+        if contents is None:
+            if not _should_list(node, my_prefix, album_changes):
+                return
+            contents = crawler.submit(node)
+
+        # Yield all of the images in all children, asking for the contents of
+        # the next few children before they are needed.
         if has_children:
-            children = sorted(node.children, key=(lambda c: c.name + '/'))
-            for child in children:
-                for image in all_smugmug_images(child, prefix, False, my_prefix):
+            children = [
+                child
+                for child in sorted(contents.result(), key=(lambda c: c.name + '/'))
+                if _prefix_matches(prefix, my_prefix + child.name + '/') and
+                not _is_past(my_prefix + child.name + '/', start_after) and
+                _should_list(child, my_prefix + child.name + '/', album_changes)
+            ]
+            child_contents = {}
+            for (i, child) in enumerate(children):
+                for j in range(i, min(len(children), i + crawler.distance + 1)):
+                    if j not in child_contents:
+                        child_contents[j] = crawler.submit(children[j])
+                child_images = all_smugmug_images(
+                    child, prefix, False, my_prefix, crawler, child_contents.pop(i), album_changes, start_after
+                )
+                for image in child_images:
                     yield image
 
         # Yield all of the images in an album:
         if has_album:
             images = [
-                SmugMugImage(my_prefix, image)
-                for image in node.album.images
+                SmugMugImage(my_prefix, record)
+                for record in contents.result()
             ]
             images.sort(key=(lambda i: i.b2_path))
             for image in images:
-                yield image
+                if start_after is None or start_after < image.b2_path:
+                    yield image
 
 
 class B2Image:
-    def __init__(self, b2_path, file_info):
+    def __init__(self, b2_path, file_info, file_id=None, size=None):
         self.b2_path = b2_path
         self.file_info = file_info
+        self.file_id = file_id
+        self.size = size
 
     @property
     def file_name(self):
@@ -105,6 +258,11 @@ class B2Image:
     def title(self):
         return self.file_info['title']
 
+    @property
+    def archived_md5(self):
+        """Only files uploaded by newer versions of this program have this."""
+        return self.file_info.get('archived_md5')
+
     def __repr__(self):
         return 'B2:' + self.b2_path
 
@@ -112,9 +270,23 @@ class B2Image:
         return repr(self)
 
 
-def all_b2_images(b2_bucket, prefix):
-    for file_version_info, _ in b2_bucket.ls(prefix, recursive=True):
-        yield B2Image(file_version_info.file_name, file_version_info.file_info)
+def all_b2_images(b2_bucket, prefix, workers=1, page_size=None, start_after=None):
+    """
+    Yields a B2Image for each file under prefix, in b2_path order.  With more
+    than one worker, the top-level folders are listed in parallel.  With
+    start_after, only files after that path are included.  Leases kept in
+    the bucket by distributed backups are left out.
+    """
+    file_version_infos = parallel_ls(b2_bucket, prefix, workers, page_size, start_after)
+    for file_version_info in file_version_infos:
+        if file_version_info.file_name.startswith(LEASE_FOLDER):
+            continue
+        yield B2Image(
+            file_version_info.file_name,
+            file_version_info.file_info,
+            file_version_info.id_,
+            file_version_info.size
+        )
 
 
 def images_match(a: SmugMugImage, b: B2Image):
@@ -127,37 +299,256 @@ def images_match(a: SmugMugImage, b: B2Image):
     )
 
 
-def copy_from_smugmug_to_b2(a: SmugMugImage, bucket, upload_type: str) -> None:
-    print('DOWNLOAD', a.b2_path)
-    image_bytes = a.content
-    print(upload_type, a.b2_path)
-    file_infos = dict(
-        caption=a.caption,
-        date=a.date,
-        file_name=a.file_name,
-        keywords=a.keywords,
-        title=a.title
-    )
-    bucket.upload_bytes(
-        data_bytes=image_bytes,
-        file_name=a.b2_path,
-        file_infos=file_infos
+def state_matches(a: SmugMugImage, b: StateImage):
+    """
+    Checks whether the state database's record of a file whose name matches
+    is up to date.
+
+    Files uploaded by older versions don't have archived_md5 or last_updated
+    in their file info, so rows rebuilt from them don't either.  The name
+    holds a hash of the metadata, which is all those versions compared, so
+    a row that doesn't know the content matches if the name does.
+    """
+    if not state_row_is_complete(b):
+        return True
+    return (
+        a.archived_md5 == b.archived_md5 and
+        a.last_updated == b.last_updated
     )
 
 
-def backup(top_node, bucket, prefix):
-    smugmug_b2_pairs = ordered_zip(
-        all_smugmug_images(top_node, prefix),
-        all_b2_images(bucket, prefix),
-        key=lambda x: x.b2_path
+def state_row_is_complete(b: StateImage):
+    return b.archived_md5 is not None and b.last_updated is not None
+
+
+def backup_actions(
+        top_node,
+        bucket,
+        prefix,
+        crawler=None,
+        state=None,
+        full=False,
+        album_changes=None,
+        list_b2_images=all_b2_images,
+        start_after=None,
+        reconcile=RECONCILE_STREAM
+):
+    """
+    Yields the Actions needed to make the bucket match SmugMug, with a KEEP
+    for each path that already matches, all in b2_path order.
+
+    With a state database, the database is compared with SmugMug instead of
+    listing the bucket, unless full is set.  A full backup lists the bucket,
+    and brings the database up to date with what it finds.
+
+    With album_changes, albums that haven't changed are skipped on both sides.
+
+    list_b2_images(bucket, prefix, start_after) lists the bucket; it can be
+    replaced to change how the listing is done.
+
+    With start_after, only paths after it are looked at, on both sides.
+
+    reconcile says how the two sides are matched up: RECONCILE_STREAM needs
+    both in order, and RECONCILE_SORT sorts each top-level folder on disk first.
+    """
+    if state is not None and not full:
+        other_side = state.images(prefix, start_after)
+        matches = state_matches
+    else:
+        other_side = list_b2_images(bucket, prefix, start_after)
+        matches = images_match
+    smugmug_b2_pairs = reconciled_zip(
+        all_smugmug_images(
+            top_node, prefix, crawler=crawler, album_changes=album_changes, start_after=start_after
+        ),
+        other_side,
+        key=lambda x: x.b2_path,
+        mode=reconcile,
+        group=lambda b2_path: top_level_folder(b2_path, prefix)
     )
     for a, b in smugmug_b2_pairs:
         if a is None:
-            print('HIDE    ', b.b2_path)
-            bucket.hide_file(b.b2_path)
+            # By the time a database row comes out on its own, the album it
+            # is in has been checked, so we know if it was skipped.
+            if album_changes is None or b.album not in album_changes.skipped:
+                yield Action(HIDE, b.b2_path, source=b)
+            else:
+                yield Action(KEEP, b.b2_path, source=b)
         elif b is None:
-            copy_from_smugmug_to_b2(a, bucket, 'UPLOAD  ')
+            yield Action(UPLOAD, a.b2_path, a)
         else:
             # We have both.  Re-upload if they do not match.
-            if not images_match(a, b):
-                copy_from_smugmug_to_b2(a, bucket, 'REUPLOAD')
+            if not matches(a, b):
+                yield Action(REUPLOAD, a.b2_path, a, b)
+            else:
+                if state is not None and (full or not state_row_is_complete(b)):
+                    # Fills in a row rebuilt from a file that didn't record the content.
+                    state.record(a, b.file_id)
+                yield Action(KEEP, a.b2_path, a, b)
+
+
+def album_of(b2_path):
+    return b2_path[:b2_path.rfind('/') + 1]
+
+
+def use_server_side_copies(actions, content_index=None):
+    """
+    Turns uploads into server-side copies when the same content is already
+    in the bucket, in the same album, as a file being replaced or hidden.
+
+    This is what happens when a caption or keywords change: the name
+    changes because the metadata hash is in it, but the content doesn't.
+    The actions for one album come out together, so only one album's worth
+    of actions is held at a time.
+
+    With a content index, uploads of content that is anywhere else in the
+    bucket become copies too.
+    """
+    for _, album_actions in itertools.groupby(actions, key=lambda action: album_of(action.b2_path)):
+        album_actions = list(album_actions)
+        existing = dict(
+            (action.source.archived_md5, action.source)
+            for action in album_actions
+            if action.source is not None and
+            action.source.archived_md5 and
+            action.source.file_id
+        )
+        for action in album_actions:
+            if action.kind not in (UPLOAD, REUPLOAD):
+                yield action
+                continue
+            archived_md5 = action.smugmug_image.archived_md5
+            source = existing.get(archived_md5)
+            if source is not None:
+                yield Action(COPY, action.b2_path, action.smugmug_image, source)
+                continue
+            source = content_index.find(archived_md5) if content_index is not None else None
+            if source is not None:
+                yield Action(COPY, action.b2_path, action.smugmug_image, source)
+            else:
+                yield action
+
+
+def make_content_index(bucket, state, full, dedupe, list_b2_images=all_b2_images):
+    """
+    Returns the ContentIndex to use for dedupe, or None if dedupe is off.
+    Without a state database, or for a full backup, the whole bucket is listed.
+    """
+    if dedupe == DEDUPE_OFF:
+        return None
+    if state is not None and not full:
+        return ContentIndex(state)
+    print('Indexing content in bucket')
+    return ContentIndex.from_b2_images(list_b2_images(bucket, ''), state)
+
+
+def backup(
+        top_node,
+        bucket,
+        prefix,
+        workers=1,
+        make_session=None,
+        make_bucket=None,
+        options=None,
+        crawler=None,
+        state=None,
+        full=False,
+        skip_unchanged_albums=False,
+        dedupe=DEDUPE_OFF,
+        list_workers=1,
+        list_page_size=None,
+        journal_path=None,
+        resume=False,
+        concurrency=None,
+        reconcile=RECONCILE_STREAM,
+        failures=None,
+        content_index=None
+):
+    """
+    Makes the bucket match SmugMug, running the transfers on a pool of workers.
+
+    Failed transfers don't stop the backup.  They are reported at the end,
+    and a TransferError is raised if there were any.  Otherwise, returns
+    (actions done, bytes transferred).
+
+    skip_unchanged_albums needs a state database, and has no effect on a
+    full backup.
+
+    dedupe says what to do with uploads of content that is already somewhere
+    in the bucket.  Without a state database, finding that out means
+    listing the whole bucket first.  A ContentIndex that was already made,
+    with make_content_index, can be passed in as content_index instead.
+
+    list_workers and list_page_size control how the bucket is listed.
+
+    With a journal_path, finished work is recorded there as it happens.  If
+    resume is set, the backup starts from where the journal says the last
+    run got to.  The journal is removed when a backup finishes with no
+    failures.
+
+    concurrency, an AdaptiveLimit, changes how many transfers run at once
+    as the backup goes; workers is ignored when it is given.
+
+    reconcile is passed on to backup_actions.
+
+    With a FailureQueue as failures, failed transfers are recorded there,
+    to be tried again with retry_failed.
+    """
+
+    def list_b2_images(b2_bucket, b2_prefix, start_after=None):
+        return all_b2_images(b2_bucket, b2_prefix, list_workers, list_page_size, start_after)
+
+    started = time.time()
+    resume_point = ResumePoint()
+    if journal_path is not None and resume:
+        resume_point = read_journal(journal_path, prefix)
+        if resume_point.checkpoint is not None:
+            print('Resuming after %s' % (resume_point.checkpoint,))
+    journal = Journal(journal_path, prefix, resume_point) if journal_path is not None else None
+    album_changes = None
+    if skip_unchanged_albums and state is not None and not full:
+        album_changes = AlbumChanges(state, prefix, resume_point.checkpoint)
+    if content_index is None:
+        content_index = make_content_index(bucket, state, full, dedupe, list_b2_images)
+    pool = TransferPool(
+        bucket, workers, make_session, make_bucket, options, state, content_index, journal, concurrency, failures
+    )
+    listed_everything = False
+    try:
+        actions = backup_actions(
+            top_node, bucket, prefix, crawler, state, full, album_changes, list_b2_images, resume_point.checkpoint,
+            reconcile
+        )
+        for action in use_server_side_copies(actions, content_index):
+            if action.kind == KEEP or resume_point.is_done(action):
+                if journal is not None:
+                    journal.reached(action.b2_path)
+            else:
+                pool.submit(action)
+        listed_everything = True
+    finally:
+        errors = pool.close()
+        if journal is not None:
+            journal.close(complete=(listed_everything and not errors))
+    if album_changes is not None:
+        album_changes.save(action.b2_path for (action, _) in errors)
+    if pool.bytes_saved:
+        print('Copied inside B2 instead of transferring: %d bytes' % (pool.bytes_saved,))
+    if state is not None and full and not errors and resume_point.checkpoint is None:
+        # Anything in the database that wasn't seen in the bucket isn't there any more.
+        state.forget_unchecked(prefix, started)
+    report_failures(errors)
+    return pool.done_count, pool.done_bytes
+
+
+def report_failures(errors):
+    """
+    Lists the (action, exception) pairs of failed transfers, and raises
+    TransferError if there are any.
+    """
+    if errors:
+        print()
+        print('FAILURES:')
+        for action, e in errors:
+            print('   ', action, repr(e))
+        raise TransferError(len(errors))
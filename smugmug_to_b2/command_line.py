@@ -3,16 +3,41 @@
 #
 
 import argparse
+import functools
 import json
 import os
 import sys
-import yaml
+import threading
 
-from .backup import all_b2_images, all_smugmug_images, backup
+from .backup import all_b2_images, all_smugmug_images, backup, make_content_index
+from .concurrency import AdaptiveLimit, mbps_to_bytes_per_second, watch_b2_requests
+from .crawl import Crawler
+from .dedupe import DEDUPE_MODES, DEDUPE_OFF
 from .exception import AppError, ConfigReadError
-from .smugmug import get_auth_url, set_pin, get_auth_user
+from .failures import DEFAULT_FAILURES_PATH, FailureQueue, retry_failed
+from .jobs import DEFAULT_PARALLEL_JOBS, find_job, print_job_results, read_jobs, run_jobs
+from .journal import default_journal_path
+from .leases import DEFAULT_LEASE_SECONDS, DEFAULT_POLL_SECONDS, NodeWithChildren, run_prefixes, top_level_prefixes
+from .metrics import METRICS_FORMATS, ProgressReporter, run_metrics
+from .plan import DEFAULT_BIG_FILE_SIZE, apply_plan, make_plan, read_plan, write_plan
+from .smugmug import (
+    DEFAULT_PAGE_WORKERS,
+    PIN_PATH,
+    configure_paging,
+    get_auth_url,
+    set_pin,
+    get_auth_session,
+    get_auth_user,
+    get_image,
+    request_counter,
+)
+from .reconcile import RECONCILE_MODES, RECONCILE_STREAM
+from .state import DEFAULT_STATE_PATH, StateDb, rebuild_state
+from .transfer import TransferOptions, configure_bandwidth
+from .transport import RetryPolicy, b2_request_counter, configure_transport, retry_counter
 
-from b2sdk.v1 import B2Api, InMemoryAccountInfo
+
+MEGABYTE = 1024 * 1024
 
 
 def pj(x):
@@ -34,6 +59,7 @@ def get_config():
             config_text = f.read()
     except Exception as e:
         raise ConfigReadError('ERROR reading ' + config_path + ': ' + str(e))
+    import yaml
     try:
         config = yaml.safe_load(config_text)
     except Exception as e:
@@ -41,11 +67,22 @@ def get_config():
     return config
 
 
+def smugmug_account(config, args):
+    """
+    Returns (smugmug config, access token path) for the account a command
+    is about: a job's, with --job, or the one in the config.
+    """
+    if getattr(args, 'job', None) is not None:
+        job = find_job(config, args.job)
+        return job.smugmug, job.token_path
+    return config['smugmug'], PIN_PATH
+
+
 # noinspection PyUnusedLocal
 def authorize_command(config, args):
     print(config)
-    smug_mug_config = config['smugmug']
-    url = get_auth_url(smug_mug_config['key'], smug_mug_config['secret'])
+    smug_mug_config, pin_path = smugmug_account(config, args)
+    url = get_auth_url(smug_mug_config['key'], smug_mug_config['secret'], pin_path)
     print()
     print('Go to this URL, and get a PIN for accessing SmugMug:')
     print()
@@ -53,27 +90,98 @@ def authorize_command(config, args):
     print()
     print('When you are done, run this command:')
     print()
-    print('     smugmug-to-b2 set-pin <pin>')
+    print('     smugmug-to-b2 set-pin <pin>' + ('' if args.job is None else ' --job ' + args.job))
     print()
 
 
 def set_pin_command(config, args):
-    smug_mug_config = config['smugmug']
-    set_pin(smug_mug_config['key'], smug_mug_config['secret'], args.pin)
+    smug_mug_config, pin_path = smugmug_account(config, args)
+    set_pin(smug_mug_config['key'], smug_mug_config['secret'], args.pin, pin_path)
     print('PIN successfully stored.')
 
 
+def configure_requests(args):
+    """
+    Sets up paging, connection pools and retries from the arguments of
+    commands that have them.  Called once, before any session is made,
+    because sessions get their pools when they are made.
+    """
+    if hasattr(args, 'page_size'):
+        configure_paging(args.page_size, args.page_workers)
+    if hasattr(args, 'pool_size'):
+        configure_transport(args.pool_size, RetryPolicy(max_total_time=args.max_retry_time), shared_pool_size(args))
+
+
+def shared_pool_size(args):
+    """
+    Returns how many connections to SmugMug the jobs of backup --all keep
+    open together, in the pools they share: one for each thread that can
+    make a request, in every job that runs at once.  None for other commands,
+    which don't share pools.
+    """
+    if not getattr(args, 'all', False):
+        return None
+    transfer_workers = max(args.workers, args.max_workers or 0)
+    page_workers = args.page_workers or DEFAULT_PAGE_WORKERS
+    return max(args.jobs * (transfer_workers + args.crawl_workers + page_workers), args.pool_size or 0)
+
+
+def make_crawler(args, make_session=get_auth_session, pin_path=PIN_PATH):
+    if args.async_crawl:
+        from .async_smugmug import DEFAULT_DISTANCE, AsyncCrawler, make_async_session
+        distance = DEFAULT_DISTANCE if args.prefetch is None else args.prefetch
+        return AsyncCrawler(distance, make_session=lambda: make_async_session(args.crawl_workers, pin_path))
+    return Crawler(args.crawl_workers, args.prefetch, make_session=make_session)
+
+
+def print_request_counts():
+    print()
+    print('SmugMug requests:', request_counter.total())
+    for (endpoint, count) in sorted(request_counter.as_dict().items()):
+        print('   %8d  %s' % (count, endpoint))
+    print('SmugMug retries:', retry_counter.total())
+    for (endpoint, count) in sorted(retry_counter.as_dict().items()):
+        print('   %8d  %s' % (count, endpoint))
+    if b2_request_counter.total():
+        print('B2 requests:', b2_request_counter.total())
+        for (endpoint, count) in sorted(b2_request_counter.as_dict().items()):
+            print('   %8d  %s' % (count, endpoint))
+
+
 # noinspection PyUnusedLocal
 def list_smug_mug(config, args):
     user = get_auth_user()
-    for i in all_smugmug_images(user.node, ''):
-        print(i)
+    with make_crawler(args) as crawler:
+        for i in all_smugmug_images(user.node, '', crawler=crawler):
+            print(i)
+    print_request_counts()
+
+
+class BucketCache:
+    """
+    Hands out one bucket object for each B2 account and bucket, so that
+    jobs backing up to the same place share its connections.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def get(self, config):
+        b2_config = config['b2']
+        cache_key = (b2_config['key'], b2_config['bucket'])
+        with self._lock:
+            if cache_key not in self._buckets:
+                self._buckets[cache_key] = get_bucket(config)
+            return self._buckets[cache_key]
 
 
 def get_bucket(config):
+    from b2sdk.v1 import B2Api, InMemoryAccountInfo
     b2_config = config['b2']
     account_info = InMemoryAccountInfo()
     b2_api = B2Api(account_info=account_info)
+    watch_b2_requests(b2_api)
     b2_api.authorize_account('production', b2_config['key'], b2_config['secret'])
     return b2_api.get_bucket_by_name(b2_config['bucket'])
 
@@ -81,26 +189,432 @@ def get_bucket(config):
 # noinspection PyUnusedLocal
 def list_b2(config, args):
     bucket = get_bucket(config)
-    for i in all_b2_images(bucket, ''):
+    for i in all_b2_images(bucket, '', args.list_workers, args.list_page_size):
         print(i)
 
 
+def open_state(args):
+    """
+    Returns the StateDb to use, or None if the command isn't using one.
+    """
+    if args.state is None:
+        return None
+    return StateDb(args.state)
+
+
+def failures_path(args):
+    return args.failures or DEFAULT_FAILURES_PATH
+
+
+# noinspection PyUnusedLocal
+def rebuild_state_command(config, args):
+    bucket = get_bucket(config)
+    with StateDb(args.state) as state:
+        count = rebuild_state(state, all_b2_images(bucket, '', args.list_workers, args.list_page_size))
+    print('Recorded %d files in %s' % (count, args.state))
+
+
 def backup_command(config, args):
+    if args.all:
+        backup_all_command(config, args)
+        return
+    if args.distributed is not None:
+        distributed_backup_command(config, args)
+        return
+    if args.retry_failed:
+        retry_failed_command(config, args)
+        return
     # The 'ls' method on B2 buckets requires that the prefix end with '/'
     assert args.prefix == '' or args.prefix.endswith('/'), 'prefix must end with "/"'
+    if args.skip_unchanged_albums and args.state is None:
+        raise AppError('--skip-unchanged-albums needs --state')
     node = get_auth_user().node
     bucket = get_bucket(config)
-    backup(node, bucket, args.prefix)
+    state = open_state(args)
+    failures = FailureQueue(failures_path(args))
+    progress = ProgressReporter(run_metrics, args.progress) if args.progress else None
+    try:
+        with make_crawler(args) as crawler:
+            backup(
+                node,
+                bucket,
+                args.prefix,
+                workers=args.workers,
+                make_session=get_auth_session,
+                make_bucket=lambda: get_bucket(config),
+                options=transfer_options(args),
+                crawler=crawler,
+                state=state,
+                full=args.full,
+                skip_unchanged_albums=args.skip_unchanged_albums,
+                dedupe=args.dedupe,
+                list_workers=args.list_workers,
+                list_page_size=args.list_page_size,
+                journal_path=args.journal or default_journal_path(config['b2']['bucket'], args.prefix),
+                resume=args.resume,
+                concurrency=make_concurrency(args),
+                reconcile=args.reconcile,
+                failures=failures
+            )
+    finally:
+        if progress is not None:
+            progress.close()
+        if state is not None:
+            state.close()
+        failures.close()
+        if args.metrics is not None:
+            run_metrics.write(
+                args.metrics,
+                args.metrics_format,
+                request_counter.as_dict(),
+                retry_counter.as_dict(),
+                b2_request_counter.as_dict()
+            )
+    print_request_counts()
+    run_metrics.print_summary()
 
 
-def main():
+def retry_failed_command(config, args):
+    """
+    Tries again just the transfers on the failure queue, looking each image
+    up by its key instead of crawling SmugMug.
+    """
+    session = get_auth_session()
+    bucket = get_bucket(config)
+    state = open_state(args)
     try:
-        config = get_config()
-    except AppError as app_error:
-        print()
-        print(str(app_error), file=sys.stderr)
-        return
+        with FailureQueue(failures_path(args)) as failures:
+            print('Retrying %d failed transfers from %s' % (len(failures), failures.path))
+            retry_failed(
+                failures,
+                bucket,
+                lambda image_key: get_image(session, image_key).record(),
+                workers=args.workers,
+                make_session=get_auth_session,
+                make_bucket=lambda: get_bucket(config),
+                options=transfer_options(args),
+                state=state,
+                concurrency=make_concurrency(args)
+            )
+    finally:
+        if state is not None:
+            state.close()
+    print_request_counts()
+    run_metrics.print_summary()
+
+
+def backup_all_command(config, args):
+    """
+    Backs up every job in the config file, a few at a time, with one limit
+    on concurrent transfers and bandwidth for all of them.
+    """
+    jobs = read_jobs(config)
+    if not jobs:
+        raise AppError('--all needs a list of jobs in the config file')
+    if args.prefix != '' or args.state is not None or args.failures is not None:
+        raise AppError('with --all, give each job its own prefix, state and failures in the config file')
+    if args.skip_unchanged_albums and any(job.state is None for job in jobs):
+        raise AppError('--skip-unchanged-albums needs a state for every job')
+    concurrency = make_concurrency(args, always=True)
+    buckets = BucketCache()
+
+    def run(job):
+        make_session = functools.partial(get_auth_session, job.token_path, True)
+        b2_config = {'b2': job.b2}
+        state = StateDb(job.state) if job.state is not None else None
+        try:
+            with FailureQueue(job.failures) as failures:
+                if args.retry_failed:
+                    session = make_session()
+                    return retry_failed(
+                        failures,
+                        buckets.get(b2_config),
+                        lambda image_key: get_image(session, image_key).record(),
+                        workers=args.workers,
+                        make_session=make_session,
+                        make_bucket=lambda: get_bucket(b2_config),
+                        options=transfer_options(args),
+                        state=state,
+                        concurrency=concurrency
+                    )
+                node = get_auth_user(job.token_path, True).node
+                with make_crawler(args, make_session, job.token_path) as crawler:
+                    return backup(
+                        node,
+                        buckets.get(b2_config),
+                        job.prefix,
+                        workers=args.workers,
+                        make_session=make_session,
+                        make_bucket=lambda: get_bucket(b2_config),
+                        options=transfer_options(args),
+                        crawler=crawler,
+                        state=state,
+                        full=args.full,
+                        skip_unchanged_albums=args.skip_unchanged_albums,
+                        dedupe=args.dedupe,
+                        list_workers=args.list_workers,
+                        list_page_size=args.list_page_size,
+                        journal_path=job.journal,
+                        resume=args.resume,
+                        concurrency=concurrency,
+                        reconcile=args.reconcile,
+                        failures=failures
+                    )
+        finally:
+            if state is not None:
+                state.close()
+
+    progress = ProgressReporter(run_metrics, args.progress) if args.progress else None
+    try:
+        results = run_jobs(jobs, run, args.jobs)
+    finally:
+        if progress is not None:
+            progress.close()
+        if args.metrics is not None:
+            run_metrics.write(
+                args.metrics,
+                args.metrics_format,
+                request_counter.as_dict(),
+                retry_counter.as_dict(),
+                b2_request_counter.as_dict()
+            )
+    print_request_counts()
+    run_metrics.print_summary()
+    print_job_results(results)
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise AppError('%d of %d jobs failed' % (len(failed), len(results)))
+
+
+def distributed_backup_command(config, args):
+    """
+    Backs up the top-level folders that this process gets leases on, until
+    the workers sharing the run have done all of them.
+    """
+    if args.prefix != '':
+        raise AppError('--distributed shares out the whole account, so it can\'t have a --prefix')
+    if args.state is not None or args.resume or args.skip_unchanged_albums:
+        # Each host only knows about the folders it backed up itself.
+        raise AppError('--distributed lists the bucket; it can\'t use --state, --skip-unchanged-albums or --resume')
+    if args.retry_failed:
+        # Each host keeps the failures of its own folders.
+        raise AppError('run --retry-failed on each host without --distributed, after the run is done')
+    node = NodeWithChildren(get_auth_user().node)
+    bucket = get_bucket(config)
+    concurrency = make_concurrency(args)
+    # The bucket is indexed once for the whole run, not once for each folder.
+    content_index = make_content_index(
+        bucket,
+        None,
+        True,
+        args.dedupe,
+        lambda b2_bucket, b2_prefix: all_b2_images(b2_bucket, b2_prefix, args.list_workers, args.list_page_size)
+    )
+
+    def run(prefix):
+        with make_crawler(args) as crawler:
+            backup(
+                node,
+                bucket,
+                prefix,
+                workers=args.workers,
+                make_session=get_auth_session,
+                make_bucket=lambda: get_bucket(config),
+                options=transfer_options(args),
+                crawler=crawler,
+                dedupe=args.dedupe,
+                list_workers=args.list_workers,
+                list_page_size=args.list_page_size,
+                concurrency=concurrency,
+                reconcile=args.reconcile,
+                failures=failures,
+                content_index=content_index
+            )
+
+    failures = FailureQueue(failures_path(args))
+    try:
+        run_prefixes(
+            bucket,
+            args.distributed,
+            top_level_prefixes(node, bucket),
+            run,
+            owner=args.worker_name,
+            lease_seconds=args.lease_seconds,
+            poll_seconds=args.poll_seconds
+        )
+    finally:
+        failures.close()
+        print_request_counts()
+        run_metrics.print_summary()
+
+
+def plan_command(config, args):
+    assert args.prefix == '' or args.prefix.endswith('/'), 'prefix must end with "/"'
+    node = get_auth_user().node
+    bucket = get_bucket(config)
+    state = open_state(args)
+    try:
+        with make_crawler(args) as crawler:
+            actions = make_plan(
+                node,
+                bucket,
+                args.prefix,
+                crawler=crawler,
+                state=state,
+                full=args.full,
+                dedupe=args.dedupe,
+                list_workers=args.list_workers,
+                list_page_size=args.list_page_size,
+                reconcile=args.reconcile
+            )
+            count, byte_count = write_plan(args.plan_file, args.prefix, actions)
+    finally:
+        if state is not None:
+            state.close()
+    print('Planned %d actions, %d bytes to transfer, in %s' % (count, byte_count, args.plan_file))
+    print_request_counts()
+
 
+def apply_command(config, args):
+    header, actions = read_plan(args.plan_file)
+    print('Applying %d actions planned for prefix %r' % (len(actions), header['prefix']))
+    bucket = get_bucket(config)
+    state = open_state(args)
+    try:
+        apply_plan(
+            actions,
+            bucket,
+            workers=args.workers,
+            make_session=get_auth_session,
+            make_bucket=lambda: get_bucket(config),
+            options=transfer_options(args),
+            state=state,
+            big_file_size=args.big_file_size * MEGABYTE,
+            concurrency=make_concurrency(args)
+        )
+    finally:
+        if state is not None:
+            state.close()
+    print_request_counts()
+    run_metrics.print_summary()
+
+
+def audit_command(config, args):
+    from .audit import audit
+    assert args.prefix == '' or args.prefix.endswith('/'), 'prefix must end with "/"'
+    if not 0.0 <= args.sample <= 1.0:
+        raise AppError('--sample must be from 0 to 1')
+    node = get_auth_user().node
+    bucket = get_bucket(config)
+    with make_crawler(args) as crawler:
+        report = audit(
+            node,
+            bucket,
+            args.prefix,
+            crawler=crawler,
+            list_workers=args.list_workers,
+            list_page_size=args.list_page_size,
+            sample=args.sample,
+            sample_workers=args.sample_workers,
+            make_bucket=lambda: get_bucket(config),
+            reconcile=args.reconcile
+        )
+    report.print_summary()
+    print_request_counts()
+    report.raise_if_problems()
+
+
+def transfer_options(args):
+    return TransferOptions(
+        part_size=args.part_size * MEGABYTE,
+        large_file_threshold=args.large_file_threshold * MEGABYTE,
+        part_workers=args.part_workers
+    )
+
+
+def make_concurrency(args, always=False):
+    """
+    Sets the bandwidth cap, and returns the AdaptiveLimit to use, or None
+    for a fixed number of workers.  With always, there is a limit even
+    without --max-workers, holding transfers to --workers.
+    """
+    max_bytes_per_second = mbps_to_bytes_per_second(args.max_mbps) if args.max_mbps else None
+    configure_bandwidth(max_bytes_per_second)
+    if args.max_workers is None:
+        if always:
+            return AdaptiveLimit(args.workers, max_bytes_per_second=max_bytes_per_second)
+        return None
+    if args.max_workers < args.workers:
+        raise AppError('--max-workers must be at least --workers')
+    return AdaptiveLimit(args.workers, maximum=args.max_workers, max_bytes_per_second=max_bytes_per_second)
+
+
+def add_transfer_arguments(subparser):
+    subparser.add_argument('--workers', type=int, default=4, help='number of concurrent transfers')
+    subparser.add_argument(
+        '--max-workers', type=int, default=None,
+        help='adjust the number of transfers as they go, starting at --workers, up to this many'
+    )
+    subparser.add_argument(
+        '--max-mbps', type=float, default=None, help='cap on bandwidth used by transfers, in megabits per second'
+    )
+    subparser.add_argument('--part-size', type=int, default=16, help='large file part size, in MB')
+    subparser.add_argument(
+        '--large-file-threshold', type=int, default=100, help='files bigger than this (MB) are uploaded in parts'
+    )
+    subparser.add_argument('--part-workers', type=int, default=4, help='parts uploaded at once, per file')
+
+
+def add_job_argument(subparser):
+    subparser.add_argument('--job', default=None, help='the SmugMug account of this job in the config file')
+
+
+def add_state_argument(subparser):
+    subparser.add_argument(
+        '--state', nargs='?', const=DEFAULT_STATE_PATH, default=None,
+        help='use a local database of what is backed up, instead of listing the bucket'
+    )
+
+
+def add_dedupe_argument(subparser):
+    subparser.add_argument(
+        '--dedupe', choices=DEDUPE_MODES, default=DEDUPE_OFF,
+        help='copy content that is already in the bucket under another name, instead of transferring it'
+    )
+
+
+def add_reconcile_argument(subparser):
+    subparser.add_argument(
+        '--reconcile', choices=RECONCILE_MODES, default=RECONCILE_STREAM,
+        help='"sort" matches SmugMug with the bucket even when names are out of order or duplicated'
+    )
+
+
+def add_crawl_arguments(subparser):
+    subparser.add_argument('--crawl-workers', type=int, default=8, help='concurrent SmugMug listing requests')
+    subparser.add_argument('--prefetch', type=int, default=None, help='how many siblings ahead to list')
+    subparser.add_argument(
+        '--async-crawl', action='store_true',
+        help='list SmugMug with asyncio over --crawl-workers connections (needs aiohttp)'
+    )
+    subparser.add_argument('--page-size', type=int, default=None, help='items per page when listing')
+    subparser.add_argument('--page-workers', type=int, default=None, help='pages of one list fetched at once')
+    add_request_arguments(subparser)
+
+
+def add_request_arguments(subparser):
+    subparser.add_argument('--pool-size', type=int, default=None, help='connections kept open to SmugMug, per session')
+    subparser.add_argument(
+        '--max-retry-time', type=float, default=600.0, help='seconds to keep retrying one failed request'
+    )
+
+
+def add_b2_list_arguments(subparser):
+    subparser.add_argument('--list-workers', type=int, default=4, help='B2 folders listed at once')
+    subparser.add_argument('--list-page-size', type=int, default=None, help='file names per B2 list call (max 10000)')
+
+
+def main():
     parser = argparse.ArgumentParser(
         description='Tool to back up photos from SmugMug to B2',
     )
@@ -108,21 +622,130 @@ def main():
     subparsers.required = True
 
     authorize_subparser = subparsers.add_parser('authorize')
+    add_job_argument(authorize_subparser)
     authorize_subparser.set_defaults(func=authorize_command)
 
     set_pin_subparser = subparsers.add_parser('set-pin')
     set_pin_subparser.add_argument('pin')
+    add_job_argument(set_pin_subparser)
     set_pin_subparser.set_defaults(func=set_pin_command)
 
     list_b2_subparser = subparsers.add_parser('list-b2')
+    add_b2_list_arguments(list_b2_subparser)
     list_b2_subparser.set_defaults(func=list_b2)
 
     list_smug_mug_subparser = subparsers.add_parser('list-smug-mug')
+    add_crawl_arguments(list_smug_mug_subparser)
     list_smug_mug_subparser.set_defaults(func=list_smug_mug)
 
     backup_subparser = subparsers.add_parser('backup')
     backup_subparser.add_argument('--prefix', default='')
+    backup_subparser.add_argument('--all', action='store_true', help='back up every job in the config file')
+    backup_subparser.add_argument(
+        '--jobs', type=int, default=DEFAULT_PARALLEL_JOBS, help='with --all, how many jobs run at once'
+    )
+    add_crawl_arguments(backup_subparser)
+    add_b2_list_arguments(backup_subparser)
+    add_transfer_arguments(backup_subparser)
+    add_state_argument(backup_subparser)
+    backup_subparser.add_argument('--full', action='store_true', help='list the bucket, and update the database')
+    backup_subparser.add_argument(
+        '--skip-unchanged-albums', action='store_true',
+        help='do not list albums that have not changed since they were last backed up'
+    )
+    add_dedupe_argument(backup_subparser)
+    add_reconcile_argument(backup_subparser)
+    backup_subparser.add_argument(
+        '--journal', default=None,
+        help='file that records progress, so a backup can be resumed (default: one for each bucket and prefix)'
+    )
+    backup_subparser.add_argument(
+        '--resume', action='store_true', help='carry on from where an interrupted backup got to'
+    )
+    backup_subparser.add_argument(
+        '--failures', default=None,
+        help='file that records failed transfers, to be tried again (with --all, each job has its own)'
+    )
+    backup_subparser.add_argument(
+        '--retry-failed', action='store_true',
+        help='only try again the transfers recorded as failed, looking them up without listing SmugMug'
+    )
+    backup_subparser.add_argument(
+        '--distributed', default=None, metavar='RUN',
+        help='share the top-level folders with other processes running the same RUN, using leases in the bucket'
+    )
+    backup_subparser.add_argument(
+        '--worker-name', default=None, help='with --distributed, what this process is called (default host:pid)'
+    )
+    backup_subparser.add_argument(
+        '--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+        help='with --distributed, how long a folder stays taken by a process that stops renewing it'
+    )
+    backup_subparser.add_argument(
+        '--poll-seconds', type=float, default=DEFAULT_POLL_SECONDS,
+        help='with --distributed, how often to look again at folders other processes hold'
+    )
+    backup_subparser.add_argument('--metrics', default=None, help='write timings and counts for the run to this file')
+    backup_subparser.add_argument(
+        '--metrics-format', choices=METRICS_FORMATS, default='json', help='JSON, or a Prometheus textfile'
+    )
+    backup_subparser.add_argument(
+        '--progress', type=float, default=None, metavar='SECONDS', help='print progress and an ETA this often'
+    )
     backup_subparser.set_defaults(func=backup_command)
 
+    plan_subparser = subparsers.add_parser('plan')
+    plan_subparser.add_argument('plan_file', help='where to write the plan')
+    plan_subparser.add_argument('--prefix', default='')
+    add_crawl_arguments(plan_subparser)
+    add_b2_list_arguments(plan_subparser)
+    add_state_argument(plan_subparser)
+    plan_subparser.add_argument('--full', action='store_true', help='list the bucket, and update the database')
+    add_dedupe_argument(plan_subparser)
+    add_reconcile_argument(plan_subparser)
+    plan_subparser.set_defaults(func=plan_command)
+
+    apply_subparser = subparsers.add_parser('apply')
+    apply_subparser.add_argument('plan_file', help='a plan written by the plan command')
+    add_transfer_arguments(apply_subparser)
+    add_state_argument(apply_subparser)
+    apply_subparser.add_argument(
+        '--big-file-size', type=int, default=DEFAULT_BIG_FILE_SIZE // MEGABYTE,
+        help='files at least this big (MB) are spread out among the small ones'
+    )
+    add_request_arguments(apply_subparser)
+    apply_subparser.set_defaults(func=apply_command)
+
+    audit_subparser = subparsers.add_parser('audit')
+    audit_subparser.add_argument('--prefix', default='')
+    add_crawl_arguments(audit_subparser)
+    add_b2_list_arguments(audit_subparser)
+    add_reconcile_argument(audit_subparser)
+    audit_subparser.add_argument(
+        '--sample', type=float, default=0.0, metavar='RATE',
+        help='fraction of files, from 0 to 1, to download from B2 and check against the MD5 from SmugMug'
+    )
+    audit_subparser.add_argument('--sample-workers', type=int, default=4, help='sampled files downloaded at once')
+    audit_subparser.set_defaults(func=audit_command)
+
+    rebuild_state_subparser = subparsers.add_parser('rebuild-state')
+    rebuild_state_subparser.add_argument('--state', default=DEFAULT_STATE_PATH)
+    add_b2_list_arguments(rebuild_state_subparser)
+    rebuild_state_subparser.set_defaults(func=rebuild_state_command)
+
+    # Read the config after the arguments, so --help works without one.
     args = parser.parse_args()
-    args.func(config['config'], args)
+    try:
+        config = get_config()
+    except AppError as app_error:
+        print()
+        print(str(app_error), file=sys.stderr)
+        return
+
+    configure_requests(args)
+    try:
+        args.func(config['config'], args)
+    except AppError as app_error:
+        print()
+        print(str(app_error), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,218 @@
+#
+# File: concurrency
+#
+
+"""
+Adjusts how many transfers run at once, and caps the bandwidth they use.
+
+No fixed number of workers is right all the time: too many, and SmugMug
+or B2 start answering with 429s and 503s; too few, and the link sits idle
+at night.  An AdaptiveLimit works like TCP's congestion control, AIMD:
+
+  * Every interval, if transfers were waiting for a turn, and throughput
+    is holding up, one more is allowed at once (additive increase).
+
+  * When either service says to slow down, with a 429 or a 5xx, the
+    number allowed is halved (multiplicative decrease), at most once per
+    interval, because one overloaded moment tends to fail many requests.
+
+  * When throughput drops and latency per byte goes up compared with the
+    interval before, adding transfers made things worse, so one is taken
+    away.
+
+A RateLimiter paces reads from SmugMug to stay under a number of bytes
+per second.  Everything read is uploaded, so that caps both directions.
+"""
+
+import threading
+import time
+
+from .metrics import B2_LIST, run_metrics
+from .transport import RETRY_STATUSES, b2_endpoint_name, b2_request_counter, report_throttle
+
+# The B2 APIs that list a bucket.
+B2_LIST_ENDPOINTS = frozenset(['b2_list_file_names', 'b2_list_file_versions'])
+
+# Seconds between adjustments.
+ADJUST_INTERVAL = 10.0
+
+# Throughput below this fraction of the interval before, along with
+# latency above LATENCY_RISE times it, counts as congestion.
+THROUGHPUT_DROP = 0.8
+LATENCY_RISE = 1.5
+
+# Don't add transfers once throughput is this close to the bandwidth cap.
+CAP_FRACTION = 0.9
+
+
+def mbps_to_bytes_per_second(mbps):
+    return mbps * 1000 * 1000 / 8
+
+
+class AdaptiveLimit:
+    """
+    A limit on how many transfers run at once, which changes with how the
+    transfers are going.  Safe to use from many threads.
+
+    Each transfer calls acquire() before starting, and release() with the
+    bytes moved and the seconds taken when done.  throttled() is called
+    when a service says to slow down.
+    """
+
+    def __init__(
+            self,
+            initial,
+            minimum=1,
+            maximum=None,
+            interval=ADJUST_INTERVAL,
+            max_bytes_per_second=None,
+            clock=time.monotonic
+    ):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        assert 1 <= minimum <= initial <= self.maximum
+        self._limit = initial
+        self._interval = interval
+        self._max_bytes_per_second = max_bytes_per_second
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._active = 0
+        self._last_decrease = None
+        self._previous = None
+        self._start_window(clock())
+
+    def _start_window(self, now):
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_seconds = 0.0
+        self._waited = False
+        self._throttled = False
+
+    @property
+    def limit(self):
+        with self._condition:
+            return self._limit
+
+    def acquire(self):
+        with self._condition:
+            while self._limit <= self._active:
+                self._waited = True
+                self._condition.wait()
+            self._active += 1
+
+    def release(self, byte_count=0, seconds=0.0):
+        with self._condition:
+            self._active -= 1
+            # Latency is per byte, so only transfers that move bytes count.
+            if byte_count:
+                self._window_bytes += byte_count
+                self._window_seconds += seconds
+            now = self._clock()
+            if self._interval <= now - self._window_start:
+                self._adjust(now)
+            self._condition.notify_all()
+
+    def throttled(self, service=None, status=None):
+        with self._condition:
+            now = self._clock()
+            self._throttled = True
+            if self._last_decrease is not None and now - self._last_decrease < self._interval:
+                return
+            self._last_decrease = now
+            self._set_limit(max(self.minimum, self._limit // 2), 'throttled by %s (%s)' % (service, status))
+
+    def _adjust(self, now):
+        rate = self._window_bytes / (now - self._window_start)
+        latency = self._window_seconds / self._window_bytes if self._window_bytes else None
+        previous = self._previous
+        capped = self._max_bytes_per_second is not None and CAP_FRACTION * self._max_bytes_per_second <= rate
+        if self._throttled:
+            pass
+        elif (
+                previous is not None and
+                latency is not None and previous[1] is not None and
+                rate < THROUGHPUT_DROP * previous[0] and
+                LATENCY_RISE * previous[1] < latency
+        ):
+            self._set_limit(max(self.minimum, self._limit - 1), 'slower with more transfers')
+        elif self._waited and not capped:
+            self._set_limit(min(self.maximum, self._limit + 1), 'transfers waiting')
+        self._previous = (rate, latency)
+        self._start_window(now)
+
+    def _set_limit(self, limit, reason):
+        if limit != self._limit:
+            print('WORKERS ', self._limit, '->', limit, reason)
+            self._limit = limit
+            self._condition.notify_all()
+
+
+class RateLimiter:
+    """
+    Paces a stream of bytes to an average rate.  Each call to consume()
+    reserves the next stretch of time for its bytes, and waits for it.
+    Safe to use from many threads, which then share the rate.
+    """
+
+    def __init__(self, bytes_per_second, clock=time.monotonic, sleep=time.sleep):
+        assert 0 < bytes_per_second
+        self.bytes_per_second = bytes_per_second
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._available_at = clock()
+
+    def consume(self, byte_count):
+        with self._lock:
+            now = self._clock()
+            start = max(now, self._available_at)
+            self._available_at = start + byte_count / self.bytes_per_second
+        if now < start:
+            self._sleep(start - now)
+
+
+class ThrottledReader:
+    """
+    Wraps a stream, so that reads from it are paced by a RateLimiter.
+    """
+
+    def __init__(self, stream, rate_limiter):
+        self._stream = stream
+        self._rate_limiter = rate_limiter
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._rate_limiter.consume(len(data))
+        return data
+
+
+def watch_b2_requests(b2_api):
+    """
+    Counts the requests b2sdk makes to B2, by API, and times each listing
+    call as one operation in the b2_list phase.  Reports 429s and 5xx
+    responses to the throttle listeners.  b2sdk retries those itself, so
+    they'd otherwise never be seen.
+    """
+    from b2sdk.v1 import HttpCallback
+
+    # b2sdk calls both hooks on the thread making the request.
+    started = threading.local()
+
+    class B2RequestCallback(HttpCallback):
+        def pre_request(self, method, url, headers):
+            b2_request_counter.count(b2_endpoint_name(url))
+            started.at = time.monotonic()
+
+        def post_request(self, method, url, headers, response):
+            if b2_endpoint_name(url) in B2_LIST_ENDPOINTS:
+                if response.status_code < 400:
+                    run_metrics.phase(B2_LIST).observe(time.monotonic() - started.at)
+                else:
+                    run_metrics.phase(B2_LIST).error()
+            if response.status_code in RETRY_STATUSES:
+                report_throttle('b2', response.status_code)
+
+    b2_http = getattr(b2_api.session.raw_api, 'b2_http', None)
+    if b2_http is not None:
+        b2_http.add_callback(B2RequestCallback())
+    return b2_api
@@ -0,0 +1,92 @@
+#
+# File: crawl
+#
+
+"""
+Fetches the contents of SmugMug nodes ahead of when they are needed.
+
+Walking the tree is almost all waiting on round trips to SmugMug.  The
+Crawler lets the walk ask for the contents of the next few siblings before
+it gets to them, so that those requests run while the current one is being
+processed.  The walk itself still visits nodes in order.
+"""
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import CRAWL, run_metrics
+
+
+def node_contents(node):
+    """
+    Returns the list of child nodes of a folder, or the list of ImageRecords
+    of an album node.  Nodes with neither have no contents.
+    """
+    with run_metrics.timed(CRAWL):
+        if node.has_children:
+            return node.children
+        elif node.has_album:
+            return node.album.image_records()
+        else:
+            return []
+
+
+class _Deferred:
+    """
+    Looks like a Future, but does the work when the result is asked for.
+    """
+    def __init__(self, node):
+        self._node = node
+
+    def result(self):
+        return node_contents(self._node)
+
+
+class Crawler:
+    """
+    Fetches node contents on a pool of threads.
+
+    With no workers, nothing is fetched ahead of time, and contents are
+    fetched when asked for.  make_session, if given, is called once in each
+    worker thread to make the session that thread's requests go through.
+    """
+
+    def __init__(self, workers=0, distance=None, make_session=None):
+        self.distance = workers if distance is None else distance
+        self._make_session = make_session
+        self._local = threading.local()
+        self._executor = None
+        if 0 < workers:
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='crawl',
+                initializer=self._init_worker
+            )
+
+    def _init_worker(self):
+        self._local.session = self._make_session() if self._make_session is not None else None
+
+    def _fetch(self, node):
+        session = self._local.session
+        if session is not None:
+            node = node.with_session(session)
+        return node_contents(node)
+
+    def submit(self, node):
+        """
+        Starts fetching the contents of a node, and returns a Future for them.
+        """
+        if self._executor is None:
+            return _Deferred(node)
+        return self._executor.submit(self._fetch, node)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,73 @@
+#
+# File: dedupe
+#
+
+"""
+Finds content that is already in the bucket, so it doesn't have to be sent again.
+
+The same original often shows up in several albums.  A ContentIndex maps
+the ArchivedMD5 of each file in the bucket to the file, so that an upload
+of content that is already there can become a server-side copy instead
+of a download and an upload.
+
+A copy is a file of its own, so hiding the file it was copied from, when
+that image goes away, doesn't take the content of the copy with it.
+"""
+
+import threading
+
+# What to do with an upload of content that is already in the bucket.
+DEDUPE_OFF = 'off'
+DEDUPE_COPY = 'copy'
+DEDUPE_MODES = [DEDUPE_OFF, DEDUPE_COPY]
+
+
+class IndexedFile:
+    def __init__(self, b2_path, file_id):
+        self.b2_path = b2_path
+        self.file_id = file_id
+
+    def __repr__(self):
+        return 'IX:' + self.b2_path
+
+
+class ContentIndex:
+    """
+    ArchivedMD5 -> a file in the bucket with that content.
+
+    Files can be added from a listing of the bucket, and are added as they
+    are uploaded.  When there is a state database, it is asked about any
+    MD5 that isn't in memory.  Safe to use from many threads.
+    """
+
+    def __init__(self, state=None):
+        self._state = state
+        self._lock = threading.Lock()
+        self._files = {}
+
+    @classmethod
+    def from_b2_images(cls, b2_images, state=None):
+        """
+        Builds an index from a listing of the bucket.  Only files with an
+        archived_md5 in their file info can be indexed.
+        """
+        index = cls(state)
+        for b2_image in b2_images:
+            if b2_image.archived_md5:
+                index.add(b2_image.archived_md5, b2_image.b2_path, b2_image.file_id)
+        return index
+
+    def add(self, archived_md5, b2_path, file_id):
+        with self._lock:
+            self._files.setdefault(archived_md5, IndexedFile(b2_path, file_id))
+
+    def find(self, archived_md5):
+        """
+        Returns an IndexedFile with the given content, or None.
+        """
+        with self._lock:
+            found = self._files.get(archived_md5)
+        if found is None and self._state is not None:
+            found = self._state.find_by_md5(archived_md5)
+        return found
+
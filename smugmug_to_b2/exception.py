@@ -39,3 +39,26 @@ class CredentialsError(AppError):
 
 class HttpError(AppError):
     pass
+
+
+class NotFoundError(HttpError):
+    pass
+
+
+class ContentError(AppError):
+    pass
+
+
+class JournalInUseError(AppError):
+    def __init__(self, path):
+        super(JournalInUseError, self).__init__('Another backup is using the journal %s' % (path,))
+
+
+class TransferError(AppError):
+    def __init__(self, failure_count):
+        super(TransferError, self).__init__('%d transfers failed' % (failure_count,))
+
+
+class AuditError(AppError):
+    def __init__(self, problem_count):
+        super(AuditError, self).__init__('%d problems found in the bucket' % (problem_count,))
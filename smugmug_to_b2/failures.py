@@ -0,0 +1,247 @@
+#
+# File: failures
+#
+
+"""
+A queue of transfers that failed, kept on disk, so they can be tried
+again on their own.
+
+A failed download or upload doesn't stop a backup; the transfer pool
+carries on with the rest.  With a FailureQueue, each failure is recorded
+with the image's key, the reason, and how many times it has failed.  A
+later transfer of the same path that works takes it off the queue.
+
+retry_failed tries just the queued items again.  Each image is looked up
+in SmugMug by its key, which is one request, instead of crawling the
+whole account to find it.  A copy that failed is retried as an
+upload, because the file it came from may have changed since.  If an
+image's metadata changed, it goes to its new path, and the old file it
+was replacing, if there was one, is hidden.  An image that has been
+deleted from SmugMug is taken off the queue, and the file it was going
+to replace is hidden.
+"""
+
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+from .backup import SmugMugImage, album_of, report_failures
+from .exception import NotFoundError, TransferError
+from .transfer import COPY, HIDE, REUPLOAD, UPLOAD, Action, TransferPool
+
+DEFAULT_FAILURES_PATH = Path.home() / '.smugmug-to-b2-failures.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS failures (
+    b2_path TEXT PRIMARY KEY,
+    image_key TEXT,
+    album TEXT,
+    kind TEXT,
+    reason TEXT,
+    attempts INTEGER,
+    first_failed REAL,
+    last_failed REAL
+);
+"""
+
+FAILURE_COLUMNS = 'b2_path, image_key, album, kind, reason, attempts, first_failed, last_failed'
+
+
+class FailedItem:
+    """
+    One row of the failures table.
+    """
+
+    def __init__(self, b2_path, image_key, album, kind, reason, attempts, first_failed, last_failed):
+        self.b2_path = b2_path
+        self.image_key = image_key
+        self.album = album
+        self.kind = kind
+        self.reason = reason
+        self.attempts = attempts
+        self.first_failed = first_failed
+        self.last_failed = last_failed
+
+    def __repr__(self):
+        return 'FAILED:' + self.b2_path
+
+    def __str__(self):
+        return repr(self)
+
+
+class FailureQueue:
+    """
+    The failures table, usable from any number of threads.  Failures are
+    rare, so each change is committed as it is made.
+    """
+
+    def __init__(self, path=DEFAULT_FAILURES_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+            self._conn.commit()
+            # Paths on the queue, so that successes that aren't on it cost nothing.
+            self._queued = set(row[0] for row in self._conn.execute('SELECT b2_path FROM failures'))
+
+    def _write(self, sql, params=()):
+        self._conn.execute(sql, params)
+        self._conn.commit()
+
+    def record(self, action, error):
+        """
+        Adds a failed Action to the queue, or counts another attempt if it
+        is already there.  An action without an image keeps the image key
+        that was recorded before.  A copy that was replacing the file at
+        its own path is recorded as a REUPLOAD, so that a retry knows there
+        is a file there.
+        """
+        a = action.smugmug_image
+        kind = action.kind
+        if kind == COPY and action.source is not None and action.source.b2_path == action.b2_path:
+            kind = REUPLOAD
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT image_key, attempts, first_failed FROM failures WHERE b2_path = ?', (action.b2_path,)
+            ).fetchone()
+            image_key, attempts, first_failed = (row[0], row[1] + 1, row[2]) if row is not None else (None, 1, now)
+            self._write(
+                'INSERT OR REPLACE INTO failures (' + FAILURE_COLUMNS + ') VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    action.b2_path,
+                    a.image_key if a is not None else image_key,
+                    album_of(action.b2_path),
+                    kind.strip(),
+                    repr(error),
+                    attempts,
+                    first_failed,
+                    now
+                )
+            )
+            self._queued.add(action.b2_path)
+
+    def failed_again(self, item, error):
+        """
+        Counts another attempt at a FailedItem that didn't get as far as
+        an Action, keeping its kind and image key.
+        """
+        with self._lock:
+            self._write(
+                'UPDATE failures SET reason = ?, attempts = attempts + 1, last_failed = ? WHERE b2_path = ?',
+                (repr(error), time.time(), item.b2_path)
+            )
+
+    def succeeded(self, b2_path):
+        """
+        Takes a path off the queue, if it is there.
+        """
+        with self._lock:
+            if b2_path in self._queued:
+                self._write('DELETE FROM failures WHERE b2_path = ?', (b2_path,))
+                self._queued.discard(b2_path)
+
+    def moved(self, old_b2_path, new_b2_path):
+        """
+        Keeps the record of an item whose path changed, under its new path.
+        """
+        with self._lock:
+            if old_b2_path in self._queued:
+                self._write('DELETE FROM failures WHERE b2_path = ?', (new_b2_path,))
+                self._write('UPDATE failures SET b2_path = ? WHERE b2_path = ?', (new_b2_path, old_b2_path))
+                self._queued.discard(old_b2_path)
+                self._queued.add(new_b2_path)
+
+    def items(self):
+        """
+        Returns all of the FailedItems, sorted by b2_path.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT ' + FAILURE_COLUMNS + ' FROM failures ORDER BY b2_path').fetchall()
+        return [FailedItem(*row) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._queued)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def retry_actions(failures, get_record):
+    """
+    Yields an Action for each item on the queue.  get_record(image_key)
+    returns the ImageRecord of an image from SmugMug.
+
+    Images that can't be looked up are counted as failing again, and
+    images that are gone from SmugMug are taken off the queue.  An item
+    that was replacing a file is retried as a REUPLOAD, so that if it
+    fails again it is still known to be replacing one.
+    """
+    for item in failures.items():
+        print('REDO    ', item.b2_path, 'attempt', item.attempts + 1, 'after', item.reason)
+        if item.kind == HIDE.strip():
+            yield Action(HIDE, item.b2_path)
+            continue
+        replacing = item.kind == REUPLOAD.strip()
+        try:
+            image = SmugMugImage(item.album, get_record(item.image_key))
+        except NotFoundError:
+            print('GONE    ', item.b2_path)
+            failures.succeeded(item.b2_path)
+            if replacing:
+                # The file it was replacing was deleted from SmugMug too.
+                yield Action(HIDE, item.b2_path)
+            continue
+        except Exception as e:
+            print('FAILED  ', item.b2_path, repr(e))
+            failures.failed_again(item, e)
+            continue
+        if image.b2_path != item.b2_path:
+            failures.moved(item.b2_path, image.b2_path)
+            if replacing:
+                # The file the upload was going to replace is at the old path.
+                yield Action(HIDE, item.b2_path)
+                replacing = False
+        yield Action(REUPLOAD if replacing else UPLOAD, image.b2_path, image)
+
+
+def retry_failed(
+        failures,
+        bucket,
+        get_record,
+        workers=1,
+        make_session=None,
+        make_bucket=None,
+        options=None,
+        state=None,
+        concurrency=None
+):
+    """
+    Transfers just the items on the failure queue, and returns (actions
+    done, bytes transferred), like backup.  Items that work are taken off
+    the queue.  The rest stay on it, and TransferError is raised.
+    """
+    pool = TransferPool(
+        bucket, workers, make_session, make_bucket, options, state, concurrency=concurrency, failures=failures
+    )
+    try:
+        for action in retry_actions(failures, get_record):
+            pool.submit(action)
+    finally:
+        errors = pool.close()
+    report_failures(errors)
+    if len(failures):
+        # Images that couldn't be looked up.
+        raise TransferError(len(failures))
+    return pool.done_count, pool.done_bytes
@@ -0,0 +1,180 @@
+#
+# File: jobs
+#
+
+"""
+Backing up many SmugMug accounts, each to its own bucket, in one process.
+
+The config file can have a list of jobs, each with a name, the SmugMug
+account and the B2 bucket, and optionally a prefix, a state database, a
+journal and a failure queue:
+
+    config:
+      smugmug:
+        key: <API key>
+        secret: <API secret>
+      jobs:
+        - name: alice
+          b2:
+            key: ...
+            secret: ...
+            bucket: alice-photos
+          state: ~/alice.sqlite
+
+Each job's SmugMug access token is kept in a file of its own, written by
+`authorize --job` and `set-pin --job`.  The API key and secret can be
+given once for all jobs, or in a job's own smugmug section.
+
+run_jobs runs a few jobs at a time.  The transfers of all of them share
+one concurrency limit and one bandwidth cap, so adding jobs doesn't add
+load on SmugMug or B2, and a failure in one job doesn't stop the others.
+"""
+
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .exception import AppError, ConfigReadError
+from .failures import DEFAULT_FAILURES_PATH
+from .journal import DEFAULT_JOURNAL_PATH
+from .smugmug import PIN_PATH
+
+# Jobs run at once.
+DEFAULT_PARALLEL_JOBS = 4
+
+MEGABYTE = 1024 * 1024
+
+
+def _with_suffix(path, name):
+    path = Path(path)
+    return path.with_name(path.stem + '-' + name + path.suffix)
+
+
+class Job:
+    """
+    One SmugMug account to back up to one bucket.
+    """
+
+    def __init__(self, name, smugmug, b2, prefix='', state=None, journal=None, token_path=None, failures=None):
+        self.name = name
+        self.smugmug = smugmug
+        self.b2 = b2
+        self.prefix = prefix
+        self.state = state
+        self.journal = journal if journal is not None else _with_suffix(DEFAULT_JOURNAL_PATH, name)
+        self.token_path = token_path if token_path is not None else _with_suffix(PIN_PATH, name)
+        self.failures = failures if failures is not None else _with_suffix(DEFAULT_FAILURES_PATH, name)
+
+    def __repr__(self):
+        return 'Job(%r)' % (self.name,)
+
+
+def _expand(path):
+    return None if path is None else Path(path).expanduser()
+
+
+def read_jobs(config):
+    """
+    Returns the list of Jobs in a config, which is empty if there are none.
+    """
+    jobs = []
+    names = set()
+    for entry in config.get('jobs') or []:
+        name = entry.get('name')
+        if not name:
+            raise ConfigReadError('ERROR: every job needs a name')
+        if name in names:
+            raise ConfigReadError('ERROR: more than one job named ' + name)
+        names.add(name)
+        smugmug = dict(config.get('smugmug') or {})
+        smugmug.update(entry.get('smugmug') or {})
+        if 'key' not in smugmug or 'secret' not in smugmug:
+            raise ConfigReadError('ERROR: no SmugMug key and secret for job ' + name)
+        b2 = entry.get('b2')
+        if not b2 or not all(field in b2 for field in ('key', 'secret', 'bucket')):
+            raise ConfigReadError('ERROR: job %s needs a b2 section with key, secret and bucket' % (name,))
+        prefix = entry.get('prefix', '')
+        if prefix != '' and not prefix.endswith('/'):
+            raise ConfigReadError('ERROR: prefix of job %s must end with "/"' % (name,))
+        jobs.append(Job(
+            name,
+            smugmug,
+            b2,
+            prefix,
+            _expand(entry.get('state')),
+            _expand(entry.get('journal')),
+            _expand(smugmug.get('token_file')),
+            _expand(entry.get('failures'))
+        ))
+    return jobs
+
+
+def find_job(config, name):
+    for job in read_jobs(config):
+        if job.name == name:
+            return job
+    raise AppError('no job named ' + name)
+
+
+class JobResult:
+    """
+    How one job went: how long it took, what it did, and what went wrong, if anything.
+    """
+
+    def __init__(self, name, seconds, action_count=0, byte_count=0, error=None):
+        self.name = name
+        self.seconds = seconds
+        self.action_count = action_count
+        self.byte_count = byte_count
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        return '%-20s %-6s %8.1f s  %8d actions  %10.1f MB  %s' % (
+            self.name,
+            'ok' if self.ok else 'FAILED',
+            self.seconds,
+            self.action_count,
+            self.byte_count / MEGABYTE,
+            self.error or ''
+        )
+
+
+def run_job(job, run):
+    """
+    Calls run(job), which returns (actions done, bytes transferred), and returns a JobResult.
+    """
+    print('JOB     ', job.name, 'started')
+    start = time.monotonic()
+    try:
+        action_count, byte_count = run(job)
+    except Exception as e:
+        if not isinstance(e, AppError):
+            traceback.print_exc()
+        result = JobResult(job.name, time.monotonic() - start, error=str(e) or repr(e))
+    else:
+        result = JobResult(job.name, time.monotonic() - start, action_count, byte_count)
+    print('JOB     ', result)
+    return result
+
+
+def run_jobs(jobs, run, parallel=DEFAULT_PARALLEL_JOBS):
+    """
+    Runs run(job) for each job, a few at a time, and returns a JobResult
+    for each one, in the same order as the jobs.
+    """
+    assert 1 <= parallel
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='job') as executor:
+        return list(executor.map(lambda job: run_job(job, run), jobs))
+
+
+def print_job_results(results):
+    print()
+    print('Jobs:')
+    for result in results:
+        print('   ', result)
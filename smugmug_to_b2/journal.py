@@ -0,0 +1,210 @@
+#
+# File: journal
+#
+
+"""
+A journal of finished work, so that an interrupted backup can pick up
+where it left off.
+
+The journal is a file of JSON lines, appended to as actions finish, and
+flushed to disk in batches.  Now and then it also records a checkpoint:
+a b2_path such that everything up to and including it has been
+reconciled.  A backup run with --resume skips everything up to the last
+checkpoint without listing it, and skips the actions after it that the
+journal says are already done.
+
+Each bucket and prefix gets a journal of its own by default, and a
+journal is locked while a backup writes it, so two backups that overlap,
+such as one from cron and one started by hand, can't overwrite each
+other's place.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+from pathlib import Path
+
+from .exception import JournalInUseError
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: journals aren't locked.
+    fcntl = None
+
+DEFAULT_JOURNAL_PATH = Path.home() / '.smugmug-to-b2-journal'
+
+# How many records to write between flushes to disk.
+SYNC_EVERY = 50
+
+# Longest time between checkpoints, when the checkpoint is moving.
+CHECKPOINT_SECONDS = 10.0
+
+
+def default_journal_path(bucket_name, prefix=''):
+    """
+    Returns where the journal for backups of prefix to a bucket goes.
+    """
+    key = hashlib.md5((bucket_name + '/' + prefix).encode('utf-8')).hexdigest()[:8]
+    return DEFAULT_JOURNAL_PATH.with_name('%s-%s-%s' % (DEFAULT_JOURNAL_PATH.name, bucket_name, key))
+
+
+def _lock(path):
+    """
+    Takes the lock for a journal, and returns the open lock file, or raises
+    JournalInUseError if another process has it.
+    """
+    lock_file = path.with_name(path.name + '.lock').open('a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise JournalInUseError(path)
+    return lock_file
+
+
+class ResumePoint:
+    """
+    What a journal says about an earlier run: the last checkpoint, and the
+    (kind, b2_path) of actions finished after it.
+    """
+    def __init__(self, checkpoint=None, done=None):
+        self.checkpoint = checkpoint
+        self.done = done or set()
+
+    def is_done(self, action):
+        return (action.kind, action.b2_path) in self.done
+
+    def is_past(self, b2_path):
+        return self.checkpoint is not None and b2_path <= self.checkpoint
+
+
+def read_journal(path, prefix):
+    """
+    Returns the ResumePoint from a journal, or an empty one if there is no
+    journal, or it was for a different prefix.
+    """
+    path = Path(path)
+    if not path.exists():
+        return ResumePoint()
+    resume_point = ResumePoint()
+    with path.open('r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A partly written last line from a crash.
+                break
+            if 'prefix' in record and record['prefix'] != prefix:
+                print('Journal is for prefix %r, not %r; starting over' % (record['prefix'], prefix))
+                return ResumePoint()
+            if 'checkpoint' in record:
+                checkpoint = record['checkpoint']
+                resume_point.checkpoint = checkpoint
+                # Actions past the checkpoint can finish before it moves, and are still done.
+                resume_point.done = set(
+                    (kind, b2_path) for (kind, b2_path) in resume_point.done if checkpoint < b2_path
+                )
+            elif 'done' in record:
+                resume_point.done.add((record['done'], record['path']))
+    return resume_point
+
+
+class Journal:
+    """
+    Records finished actions and checkpoints.  Safe to use from many threads.
+
+    The backup loop calls started() for each action it submits, and
+    reached() for each path that needs no action, in b2_path order.  Workers
+    call finished() when an action is done.  The checkpoint moves forward
+    over everything at the front that has finished successfully; a failed
+    action holds it back, so that a resumed run tries it again.
+
+    The journal is locked until it is closed, and JournalInUseError is
+    raised if another backup has it.
+    """
+
+    def __init__(self, path, prefix, resume_point=None):
+        self.path = Path(path)
+        self._lock_file = _lock(self.path)
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        # Paths in the order they were reached, with whether they're done.
+        self._in_order = collections.deque()
+        self._done = {}
+        self._checkpoint = None
+        self._written_checkpoint = None
+        self._checkpoint_time = time.monotonic()
+        self._file = self.path.open('w')
+        self._write({'prefix': prefix})
+        if resume_point is not None:
+            # Carry over what the earlier run did, in case this one is interrupted too.
+            if resume_point.checkpoint is not None:
+                self._write({'checkpoint': resume_point.checkpoint})
+            for (kind, b2_path) in sorted(resume_point.done):
+                self._write({'done': kind, 'path': b2_path})
+        self._sync()
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._unsynced += 1
+        if SYNC_EVERY <= self._unsynced:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def started(self, action):
+        with self._lock:
+            entry = [action.b2_path, None]
+            self._in_order.append(entry)
+            self._done[id(action)] = entry
+
+    def reached(self, b2_path):
+        with self._lock:
+            self._in_order.append([b2_path, True])
+            self._advance()
+
+    def finished(self, action, succeeded):
+        with self._lock:
+            self._done.pop(id(action))[1] = succeeded
+            if succeeded:
+                self._write({'done': action.kind, 'path': action.b2_path})
+            self._advance()
+
+    def _advance(self):
+        while self._in_order and self._in_order[0][1] is True:
+            self._checkpoint = self._in_order.popleft()[0]
+        if self._checkpoint == self._written_checkpoint:
+            return
+        # A checkpoint goes at the end of each batch, or after a while if
+        # there isn't much else being written.
+        now = time.monotonic()
+        if SYNC_EVERY - 1 <= self._unsynced or CHECKPOINT_SECONDS <= now - self._checkpoint_time:
+            self._write({'checkpoint': self._checkpoint})
+            if self._unsynced:
+                self._sync()
+            self._written_checkpoint = self._checkpoint
+            self._checkpoint_time = now
+
+    def close(self, complete=False):
+        """
+        Writes the last checkpoint and closes the journal.  When the backup
+        is complete, there's nothing to resume, and the journal is removed.
+        """
+        with self._lock:
+            if self._checkpoint != self._written_checkpoint:
+                self._write({'checkpoint': self._checkpoint})
+            self._sync()
+            self._file.close()
+            if complete:
+                self.path.unlink()
+            # Closing the lock file releases the lock.
+            self._lock_file.close()
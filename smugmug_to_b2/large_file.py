@@ -0,0 +1,125 @@
+#
+# File: large_file
+#
+
+"""
+Uploads big files to B2 as large files, several parts at a time.
+
+The download from SmugMug is still read in order, so that its MD5 can be
+checked, but each part is uploaded on its own thread as soon as it has been
+read.  When an upload of the same file with the same file info was started
+before and never finished, its parts are reused: a part is only uploaded
+again if its length or SHA1 differs from what B2 already has.
+"""
+
+import hashlib
+import io
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+# B2 does not allow parts smaller than this, except for the last one.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# How many times to try uploading one part before giving up on the file.
+PART_ATTEMPTS = 3
+
+
+def _read_part(stream, part_size):
+    """
+    Reads up to part_size bytes, stopping early only at the end of the stream.
+    """
+    buffer = bytearray()
+    while len(buffer) < part_size:
+        data = stream.read(part_size - len(buffer))
+        if not data:
+            break
+        buffer += data
+    return bytes(buffer)
+
+
+def _find_unfinished_large_file(bucket, file_name, file_infos):
+    """
+    Returns (file_id, {part_number: (content_length, sha1)}) for an earlier,
+    unfinished upload of this file, or (None, {}) if there isn't one.
+    """
+    for unfinished in bucket.list_unfinished_large_files(prefix=file_name):
+        if unfinished.file_name == file_name and unfinished.file_info == file_infos:
+            finished_parts = dict(
+                (part.part_number, (part.content_length, part.content_sha1))
+                for part in bucket.list_parts(unfinished.file_id)
+            )
+            return unfinished.file_id, finished_parts
+    return None, {}
+
+
+def _upload_part(b2_session, file_id, part_number, data, sha1):
+    for attempt in range(1, PART_ATTEMPTS + 1):
+        try:
+            b2_session.upload_part(file_id, part_number, len(data), sha1, io.BytesIO(data))
+            return
+        except Exception as e:
+            if attempt == PART_ATTEMPTS:
+                raise
+            print('RETRY   ', 'part', part_number, repr(e))
+
+
+def upload_large_stream(bucket, stream, file_name, file_infos, part_size, part_workers):
+    """
+    Uploads everything read from the stream as a B2 large file.
+
+    At most part_workers parts are uploaded at once, and only a couple more
+    than that are held in memory while they wait.  If
+    reading the stream fails, the large file is left unfinished, so that a
+    later attempt can pick up the parts that were already uploaded.
+
+    B2 large files need at least two parts, so a stream that turns out to
+    fit in one part is uploaded as a normal file.
+
+    Returns the ID of the new B2 file.
+    """
+    assert MIN_PART_SIZE <= part_size
+    assert 1 <= part_workers
+    first_part = _read_part(stream, part_size)
+    second_part = _read_part(stream, part_size) if len(first_part) == part_size else b''
+    if not second_part:
+        return bucket.upload_bytes(first_part, file_name, file_info=file_infos).id_
+
+    file_id, finished_parts = _find_unfinished_large_file(bucket, file_name, file_infos)
+    if file_id is None:
+        file_id = bucket.start_large_file(file_name, None, file_infos).file_id
+    else:
+        print('RESUME  ', file_name, len(finished_parts), 'parts already uploaded')
+
+    b2_session = bucket.api.session
+    part_sha1s = []
+    futures = []
+    errors = []
+    slots = threading.BoundedSemaphore(part_workers)
+
+    def part_done(future):
+        if future.exception() is not None:
+            errors.append(future.exception())
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=part_workers, thread_name_prefix='part') as executor:
+        data = first_part
+        next_data = second_part
+        while data and not errors:
+            part_number = len(part_sha1s) + 1
+            sha1 = hashlib.sha1(data).hexdigest()
+            part_sha1s.append(sha1)
+            # Waiting for a slot before reading the next part bounds the number of parts in memory.
+            slots.acquire()
+            if finished_parts.get(part_number) == (len(data), sha1):
+                slots.release()
+            else:
+                future = executor.submit(_upload_part, b2_session, file_id, part_number, data, sha1)
+                future.add_done_callback(part_done)
+                futures.append(future)
+            data = next_data
+            next_data = _read_part(stream, part_size) if data else b''
+    for future in futures:
+        future.result()
+    b2_session.finish_large_file(file_id, part_sha1s)
+    return file_id
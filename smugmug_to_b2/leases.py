@@ -0,0 +1,340 @@
+#
+# File: leases
+#
+
+"""
+Sharing a backup between several machines, using leases kept in the
+bucket itself.
+
+A full backup of a big account is limited by one machine's bandwidth.
+With leases, any number of processes, on any number of hosts, can work
+on the same backup run.  The work is divided up by the top-level folders
+in SmugMug: each process takes a lease on a folder, backs it up, marks
+it done, and goes on to the next one that nobody holds, until all of
+them are done.  No other service is needed to coordinate them.
+
+B2 can't create a file only if it doesn't exist, so a lease is the
+history of a file whose versions are claims.  Every claim says who made
+it, how long it lasts, and whether the folder is held, released, done or
+failed.  Going through the versions from oldest to newest, using B2's
+upload times, a claim takes the lease unless someone else held it at
+that time.  Everybody reading the same versions agrees on who holds the
+lease, without comparing clocks:
+
+    * To take a lease, a process uploads a claim and reads the versions
+      back.  If it lost, it deletes its claim, which didn't count.
+
+    * The holder renews its claim while it works.  If it stops, because
+      the process or the host died, the lease runs out, and the next
+      claim after that takes it over.  A renewal deletes the holder's
+      older claims that nobody else's came between, because those make
+      no difference, so the versions don't pile up.
+
+    * A done or failed claim by the holder finishes the lease for good.
+
+If a holder is cut off from B2 for longer than a lease, two processes
+can end up backing up the same folder.  That costs some duplicate work,
+but nothing else, because a backup only makes the bucket match SmugMug.
+
+The folders shared out are the ones at the top of SmugMug, and the ones
+at the top of the bucket, so that folders deleted from SmugMug are hidden.
+The leases for a run are kept under LEASE_FOLDER, which backups and
+audits don't look at.  A new run, with a new name, does everything again.
+"""
+
+import os
+import socket
+import threading
+import time
+import zlib
+
+from .exception import AppError
+
+LEASE_FOLDER = '.smugmug-to-b2/leases/'
+
+LEASE_CONTENT_TYPE = 'application/x-smugmug-to-b2-lease'
+
+# What a claim says about the folder.
+HELD = 'held'
+RELEASED = 'released'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED = (DONE, FAILED)
+
+# How long a claim lasts, unless it is renewed.
+DEFAULT_LEASE_SECONDS = 600.0
+
+# How long to wait before looking again at folders that others hold.
+DEFAULT_POLL_SECONDS = 60.0
+
+# Room for a failure message in B2 file info.
+MAX_REASON_LENGTH = 200
+
+
+def default_owner():
+    """
+    A name for this process that no other worker has.
+    """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def lease_name(run, prefix):
+    return LEASE_FOLDER + run + '/' + prefix.rstrip('/') + '.lease'
+
+
+class LeaseState:
+    """
+    Who holds a lease, until when, in B2's milliseconds, and what they said
+    about the folder.  holder is None if nobody has ever claimed it.
+    """
+
+    def __init__(self, holder=None, expires=0, status=RELEASED, reason=''):
+        self.holder = holder
+        self.expires = expires
+        self.status = status
+        self.reason = reason
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    def holds(self, owner):
+        return self.holder == owner and self.status == HELD
+
+
+def lease_state(claims):
+    """
+    Returns the LeaseState after a list of (upload timestamp, file ID, file
+    info) claims, which can be in any order.  Claims uploaded in the same
+    millisecond are put in order by ID, so that everybody agrees.
+    """
+    state = LeaseState()
+    for (timestamp, _, info) in sorted(claims, key=lambda claim: claim[:2]):
+        if state.finished:
+            break
+        owner = info['owner']
+        if state.status == HELD and state.holder != owner and timestamp < state.expires:
+            # Someone else held it then, so this claim doesn't count.
+            continue
+        state = LeaseState(owner, timestamp + int(info['duration_ms']), info['status'], info.get('reason', ''))
+    return state
+
+
+class PrefixLease:
+    """
+    The lease on one top-level folder, for one run, as seen by one worker.
+    """
+
+    def __init__(self, bucket, run, prefix, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.owner = owner
+        self.name = lease_name(run, prefix)
+        self._duration_ms = int(lease_seconds * 1000)
+
+    def _versions(self):
+        return [
+            version
+            for version in self.bucket.list_file_versions(self.name)
+            if version.file_name == self.name and version.action == 'upload'
+        ]
+
+    def read(self):
+        return self._state(self._versions())
+
+    @staticmethod
+    def _state(versions):
+        return lease_state((version.upload_timestamp, version.id_, version.file_info) for version in versions)
+
+    def _claim(self, status, duration_ms, reason=''):
+        info = dict(owner=self.owner, status=status, duration_ms=str(duration_ms))
+        if reason:
+            info['reason'] = reason[:MAX_REASON_LENGTH]
+        return self.bucket.upload_bytes(b'', self.name, content_type=LEASE_CONTENT_TYPE, file_info=info)
+
+    def acquire(self):
+        """
+        Tries to take the lease, and returns True if this worker holds it.
+        """
+        state = self.read()
+        if state.finished:
+            return False
+        if state.holds(self.owner):
+            return self.renew()
+        claim = self._claim(HELD, self._duration_ms)
+        if self.read().holds(self.owner):
+            print('LEASE   ', self.prefix, 'taken by', self.owner)
+            return True
+        # A claim that lost is never counted, so it can go.
+        self.bucket.delete_file_version(claim.id_, self.name)
+        return False
+
+    def renew(self):
+        """
+        Extends the lease, and returns True if this worker still holds it.
+        """
+        self._claim(HELD, self._duration_ms)
+        versions = self._versions()
+        if not self._state(versions).holds(self.owner):
+            return False
+        self._delete_superseded(versions)
+        return True
+
+    def _delete_superseded(self, versions):
+        """
+        Deletes this worker's held claims that are followed by another of
+        its own, with nobody else's in between.  The lease is the same
+        without them.  The claim before the newest one is always kept, in
+        case somebody else's claim made just before the newest isn't listed
+        yet.
+        """
+        ordered = sorted(versions, key=lambda version: (version.upload_timestamp, version.id_))
+        for (version, following) in zip(ordered[:-2], ordered[1:-1]):
+            if self._is_mine(version) and version.file_info['status'] == HELD and self._is_mine(following):
+                self.bucket.delete_file_version(version.id_, self.name)
+
+    def _is_mine(self, version):
+        return version.file_info.get('owner') == self.owner
+
+    def finish(self, status, reason=''):
+        """
+        Marks the folder DONE or FAILED, or RELEASED for somebody else to do.
+        """
+        self._claim(status, 0, reason)
+
+
+class LeaseKeeper:
+    """
+    Renews a lease on a thread of its own, a few times per lease, while a
+    folder is backed up.
+    """
+
+    def __init__(self, lease, interval):
+        self._lease = lease
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                if not self._lease.renew():
+                    print('LEASE   ', self._lease.prefix, 'lost by', self._lease.owner)
+            except Exception as e:
+                print('LEASE   ', self._lease.prefix, 'renewal failed:', repr(e))
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class NodeWithChildren:
+    """
+    Wraps the node at the top of SmugMug, fetching its children just once,
+    so that the backup of each top-level folder doesn't fetch them again.
+    """
+
+    def __init__(self, node):
+        self._node = node
+        self.children = node.children if node.has_children else None
+
+    def __getattr__(self, name):
+        return getattr(self._node, name)
+
+    def __str__(self):
+        return str(self._node)
+
+
+def top_level_prefixes(top_node, bucket=None):
+    """
+    Returns the prefixes of the folders and albums at the top of SmugMug,
+    in order.  With a bucket, the folders at the top of it are included
+    too, except for the one leases are kept in, so that folders that are
+    gone from SmugMug are hidden.
+    """
+    prefixes = set()
+    if top_node.has_children:
+        prefixes.update(child.name + '/' for child in top_node.children)
+    if bucket is not None:
+        prefixes.update(
+            folder_name
+            for (_, folder_name) in bucket.ls('', recursive=False)
+            if folder_name is not None and not LEASE_FOLDER.startswith(folder_name)
+        )
+    return sorted(prefixes)
+
+
+def _starting_at(prefixes, owner):
+    """
+    Rotates the list, by an amount that depends on the owner, so that
+    workers starting together don't all claim the same folder first.
+    """
+    if not prefixes:
+        return prefixes
+    start = zlib.crc32(owner.encode('utf-8')) % len(prefixes)
+    return prefixes[start:] + prefixes[:start]
+
+
+def run_prefixes(
+        bucket,
+        run_name,
+        prefixes,
+        run,
+        owner=None,
+        lease_seconds=DEFAULT_LEASE_SECONDS,
+        poll_seconds=DEFAULT_POLL_SECONDS,
+        sleep=time.sleep
+):
+    """
+    Calls run(prefix) for each prefix that this worker gets the lease on,
+    until every prefix in the run is done or failed, by this worker or
+    another one.  Returns the prefixes this worker did.
+
+    A failure in run(prefix) is recorded in the lease, and doesn't stop
+    the worker.  It is raised as an AppError once everything has finished,
+    by whichever workers see it.
+    """
+    owner = owner or default_owner()
+    done_here = []
+    while True:
+        waiting = []
+        for prefix in _starting_at(prefixes, owner):
+            lease = PrefixLease(bucket, run_name, prefix, owner, lease_seconds)
+            if lease.read().finished:
+                continue
+            if not lease.acquire():
+                waiting.append(prefix)
+                continue
+            try:
+                with LeaseKeeper(lease, lease_seconds / 3):
+                    run(prefix)
+            except Exception as e:
+                print('LEASE   ', prefix, 'failed:', repr(e))
+                lease.finish(FAILED, str(e) or repr(e))
+            except BaseException:
+                # Interrupted: let another worker have it straight away.
+                lease.finish(RELEASED)
+                raise
+            else:
+                lease.finish(DONE)
+            done_here.append(prefix)
+        if not waiting:
+            break
+        print('LEASE   ', 'waiting for', ', '.join(waiting))
+        sleep(poll_seconds)
+    failed = []
+    for prefix in prefixes:
+        state = PrefixLease(bucket, run_name, prefix, owner).read()
+        print('LEASE   ', '%-8s %-30s %s %s' % (state.status, prefix, state.holder, state.reason))
+        if state.status == FAILED:
+            failed.append(prefix)
+    if failed:
+        raise AppError('%d of %d folders failed: %s' % (len(failed), len(prefixes), ', '.join(failed)))
+    return done_here
@@ -0,0 +1,122 @@
+#
+# File: listing
+#
+
+"""
+Lists a B2 bucket with several folders being listed at once.
+
+One recursive listing of a big bucket is a long chain of list calls, each
+waiting for the one before.  Instead, the top level of the prefix is
+listed first, which is quick because B2 skips over the contents of each
+folder.  Then each folder is listed recursively on its own thread, a few
+folders ahead of the one being read.
+
+Folder names come back in sorted order and don't overlap, so reading the
+folders one after another gives the same order as a single recursive
+listing.
+"""
+
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import all_before
+
+# How many file versions a folder listing can get ahead of the reader.
+QUEUE_SIZE = 10000
+
+_END = object()
+
+
+class _Failed:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class _FolderListing:
+    """
+    Lists one folder into a bounded queue on a worker thread.
+    """
+
+    def __init__(self, bucket, folder, fetch_count, stopped, start_after=None):
+        self._bucket = bucket
+        self._start_after = start_after
+        self._folder = folder
+        self._fetch_count = fetch_count
+        self._stopped = stopped
+        self._queue = queue.Queue(QUEUE_SIZE)
+
+    def _put(self, item):
+        # Gives up if the reader has gone away, so the worker can finish.
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            for file_version_info, _ in self._bucket.ls(self._folder, recursive=True, fetch_count=self._fetch_count):
+                if self._start_after is not None and file_version_info.file_name <= self._start_after:
+                    continue
+                if not self._put(file_version_info):
+                    return
+        except Exception as e:
+            self._put(_Failed(e))
+        self._put(_END)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failed):
+                raise item.exception
+            yield item
+
+
+def parallel_ls(bucket, prefix, workers=4, fetch_count=None, start_after=None):
+    """
+    Yields the FileVersionInfo of every file under prefix, in name order,
+    listing up to `workers` top-level folders at once.
+
+    With start_after, only files after that name are yielded, and top-level
+    folders that come entirely before it are not listed.
+    """
+    if workers <= 1:
+        for file_version_info, _ in bucket.ls(prefix, recursive=True, fetch_count=fetch_count):
+            if start_after is None or start_after < file_version_info.file_name:
+                yield file_version_info
+        return
+
+    stopped = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='b2-list')
+    try:
+        # Each entry is either a file at the top level, or a folder listing.
+        entries = []
+        for file_version_info, folder_name in bucket.ls(prefix, recursive=False, fetch_count=fetch_count):
+            if folder_name is None:
+                if start_after is None or start_after < file_version_info.file_name:
+                    entries.append(file_version_info)
+            elif start_after is None or not all_before(folder_name, start_after):
+                entries.append(_FolderListing(bucket, folder_name, fetch_count, stopped, start_after))
+        listings = [entry for entry in entries if isinstance(entry, _FolderListing)]
+
+        # Start the first few folders, and another each time one is reached.
+        next_to_start = 0
+        listing_index = 0
+        for entry in entries:
+            if isinstance(entry, _FolderListing):
+                while next_to_start < min(len(listings), listing_index + workers):
+                    executor.submit(listings[next_to_start].run)
+                    next_to_start += 1
+                listing_index += 1
+                yield from entry
+            else:
+                yield entry
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False)
@@ -0,0 +1,368 @@
+#
+# File: metrics
+#
+
+"""
+Timing and throughput of each phase of a backup.
+
+The phases are: crawling SmugMug, listing B2, downloading, uploading,
+copying inside B2, and hiding.  Each one counts operations, bytes and
+errors, and keeps a histogram of how long operations took, so that after
+a run it's clear which side was the bottleneck.
+
+A download and its upload happen together, with the upload reading from
+the download as it goes.  Time spent waiting for reads is counted as
+download time, and the rest as upload time.
+
+At the end of a run, a summary can be written as JSON, or as a Prometheus
+textfile for node_exporter's textfile collector.  A ProgressReporter
+prints progress, with an ETA, while the run goes.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+CRAWL = 'crawl'
+B2_LIST = 'b2_list'
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+COPY = 'copy'
+HIDE = 'hide'
+PHASES = [CRAWL, B2_LIST, DOWNLOAD, UPLOAD, COPY, HIDE]
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+METRICS_FORMATS = ['json', 'prometheus']
+
+PROMETHEUS_PREFIX = 'smugmug_to_b2_'
+
+
+class Histogram:
+    """
+    Counts of observations in each bucket, Prometheus style: each count
+    includes everything in the buckets below it.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                self._counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        Returns [(upper_bound, count)], ending with ('+Inf', total count).
+        """
+        return list(zip(self.buckets, self._counts)) + [('+Inf', self.count)]
+
+
+class PhaseStats:
+    """
+    What happened in one phase.  Safe to use from many threads.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.count = 0
+        self.byte_count = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def observe(self, seconds, byte_count=0):
+        with self._lock:
+            self.count += 1
+            self.byte_count += byte_count
+            self.latency.observe(seconds)
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(
+                count=self.count,
+                bytes=self.byte_count,
+                errors=self.errors,
+                seconds=self.latency.sum,
+                bytes_per_second=(self.byte_count / self.latency.sum) if self.latency.sum else 0.0,
+                latency_buckets=[[str(bound), count] for (bound, count) in self.latency.cumulative_counts()]
+            )
+
+
+class TimedReader:
+    """
+    Wraps a stream, adding up the time spent in read() and the bytes read.
+    failed is set if a read raised an exception.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.seconds = 0.0
+        self.byte_count = 0
+        self.failed = False
+
+    def read(self, size=-1):
+        start = time.monotonic()
+        try:
+            data = self._stream.read(size)
+        except BaseException:
+            self.failed = True
+            raise
+        finally:
+            self.seconds += time.monotonic() - start
+        self.byte_count += len(data)
+        return data
+
+
+class RunMetrics:
+    """
+    The stats for every phase of a run, and the progress of the transfers:
+    how many actions and bytes have been handed to the workers, and how
+    many of those are done, or have failed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._phases = dict((name, PhaseStats(name)) for name in PHASES)
+            self.planned_count = 0
+            self.planned_bytes = 0
+            self.done_count = 0
+            self.done_bytes = 0
+            self.failed_count = 0
+            self.failed_bytes = 0
+            self.duplicate_count = 0
+
+    def phase(self, name):
+        return self._phases[name]
+
+    @contextlib.contextmanager
+    def timed(self, name, byte_count=0):
+        """
+        Times the body of a with statement as one operation in a phase.
+        Exceptions are counted as errors.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.phase(name).error()
+            raise
+        self.phase(name).observe(time.monotonic() - start, byte_count)
+
+    def plan(self, byte_count):
+        with self._lock:
+            self.planned_count += 1
+            self.planned_bytes += byte_count
+
+    def finish(self, byte_count):
+        with self._lock:
+            self.done_count += 1
+            self.done_bytes += byte_count
+
+    def fail(self, byte_count):
+        with self._lock:
+            self.failed_count += 1
+            self.failed_bytes += byte_count
+
+    def duplicate(self):
+        """
+        Counts a path that was listed more than once, of which only the first is used.
+        """
+        with self._lock:
+            self.duplicate_count += 1
+
+    def progress(self):
+        """
+        Returns (done_count, failed_count, planned_count, done_bytes, planned_bytes, bytes_per_second,
+        eta_seconds).  The ETA is only for the work planned so far, and is None before anything is done.
+        Failed transfers are not counted as done, and have nothing left to do.
+        """
+        with self._lock:
+            elapsed = time.time() - self.started
+            rate = self.done_bytes / elapsed if 0 < elapsed else 0.0
+            remaining = self.planned_bytes - self.done_bytes - self.failed_bytes
+            eta = remaining / rate if 0 < rate else None
+            return (
+                self.done_count,
+                self.failed_count,
+                self.planned_count,
+                self.done_bytes,
+                self.planned_bytes,
+                rate,
+                eta
+            )
+
+    def summary(self, requests=None, retries=None, b2_requests=None):
+        """
+        Returns a dict of everything, for writing out.  requests and retries
+        are the SmugMug request counts by endpoint, and b2_requests the B2
+        request counts by API.
+        """
+        return dict(
+            started=self.started,
+            seconds=time.time() - self.started,
+            phases=dict((name, stats.as_dict()) for (name, stats) in self._phases.items()),
+            transfers=dict(
+                planned=self.planned_count,
+                done=self.done_count,
+                failed=self.failed_count,
+                planned_bytes=self.planned_bytes,
+                done_bytes=self.done_bytes,
+                failed_bytes=self.failed_bytes
+            ),
+            duplicates=self.duplicate_count,
+            smugmug_requests=requests or {},
+            smugmug_retries=retries or {},
+            b2_requests=b2_requests or {}
+        )
+
+    def print_summary(self):
+        print()
+        print('Phases:')
+        for name in PHASES:
+            stats = self.phase(name).as_dict()
+            print('    %-8s %8d ops %12d bytes %8.1f s %8.2f MB/s %6d errors' % (
+                name,
+                stats['count'],
+                stats['bytes'],
+                stats['seconds'],
+                stats['bytes_per_second'] / (1024 * 1024),
+                stats['errors']
+            ))
+        if self.duplicate_count:
+            print('Duplicate paths skipped: %d' % (self.duplicate_count,))
+
+    def write(self, path, metrics_format='json', requests=None, retries=None, b2_requests=None):
+        """
+        Writes the summary to a file.  The file is replaced all at once, so
+        a collector never reads half of it.
+        """
+        summary = self.summary(requests, retries, b2_requests)
+        if metrics_format == 'json':
+            text = json.dumps(summary, indent=4, sort_keys=True) + '\n'
+        else:
+            text = prometheus_text(summary)
+        temp_path = str(path) + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, str(path))
+
+
+def prometheus_text(summary):
+    """
+    Formats a summary in the Prometheus text exposition format.
+    """
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append('# HELP %s%s %s' % (PROMETHEUS_PREFIX, name, help_text))
+        lines.append('# TYPE %s%s %s' % (PROMETHEUS_PREFIX, name, metric_type))
+        for (suffix, labels, value) in samples:
+            label_text = ','.join('%s="%s"' % (k, v) for (k, v) in labels)
+            lines.append('%s%s%s{%s} %s' % (PROMETHEUS_PREFIX, name, suffix, label_text, _number(value)))
+
+    phases = sorted(summary['phases'].items())
+    histogram_samples = []
+    for (name, stats) in phases:
+        for (bound, count) in stats['latency_buckets']:
+            histogram_samples.append(('_bucket', [('phase', name), ('le', bound)], count))
+        histogram_samples.append(('_sum', [('phase', name)], stats['seconds']))
+        histogram_samples.append(('_count', [('phase', name)], stats['count']))
+    metric('phase_seconds', 'histogram', 'Time taken by each operation in a phase.', histogram_samples)
+    metric(
+        'phase_bytes_total', 'counter', 'Bytes moved in a phase.',
+        [('', [('phase', name)], stats['bytes']) for (name, stats) in phases]
+    )
+    metric(
+        'phase_errors_total', 'counter', 'Failed operations in a phase.',
+        [('', [('phase', name)], stats['errors']) for (name, stats) in phases]
+    )
+    metric(
+        'smugmug_requests_total', 'counter', 'Requests made to SmugMug.',
+        [('', [('endpoint', k)], v) for (k, v) in sorted(summary['smugmug_requests'].items())]
+    )
+    metric(
+        'smugmug_retries_total', 'counter', 'Requests to SmugMug that were retried.',
+        [('', [('endpoint', k)], v) for (k, v) in sorted(summary['smugmug_retries'].items())]
+    )
+    metric(
+        'b2_requests_total', 'counter', 'Requests made to B2, including retries.',
+        [('', [('endpoint', k)], v) for (k, v) in sorted(summary['b2_requests'].items())]
+    )
+    metric(
+        'duplicate_paths_total', 'counter', 'Paths listed more than once, of which only the first was used.',
+        [('', [], summary['duplicates'])]
+    )
+    metric('run_seconds', 'gauge', 'How long the run took.', [('', [], summary['seconds'])])
+    metric('run_started_timestamp_seconds', 'gauge', 'When the run started.', [('', [], summary['started'])])
+    return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressReporter:
+    """
+    Prints a progress line every `interval` seconds, on a thread of its own,
+    until it is closed.
+    """
+
+    def __init__(self, metrics, interval):
+        self._metrics = metrics
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            print(self.line())
+
+    def line(self):
+        done_count, failed_count, planned_count, done_bytes, planned_bytes, rate, eta = self._metrics.progress()
+        return 'PROGRESS %d/%d transfers  %d failed  %.1f/%.1f MB  %.2f MB/s  ETA %s' % (
+            done_count,
+            planned_count,
+            failed_count,
+            done_bytes / (1024 * 1024),
+            planned_bytes / (1024 * 1024),
+            rate / (1024 * 1024),
+            '-' if eta is None else _format_duration(eta)
+        )
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+run_metrics = RunMetrics()
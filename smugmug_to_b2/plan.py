@@ -0,0 +1,278 @@
+#
+# File: plan
+#
+
+"""
+Splits a backup into two steps: making a plan, and applying it.
+
+Making a plan does all of the comparing of SmugMug with the bucket, and
+writes the actions that are needed to a file, one compact JSON line per
+action, gzipped.  Each action carries what is needed to carry it out
+later: the image's metadata and where to download its content from, and
+the B2 file it replaces, hides or copies.
+
+Applying a plan does the transfers, and can be tuned and run again without
+another crawl.  Instead of going in path order, big files are spread out
+among the small ones, so that the workers are kept busy with a mix of
+both, and one album full of videos doesn't hold up everything else.
+
+Download URLs in a plan come from SmugMug when the plan is made, so a plan
+should be applied while they are still good.
+"""
+
+import gzip
+import json
+import threading
+import time
+
+from .backup import all_b2_images, backup_actions, make_content_index, report_failures, use_server_side_copies
+from .dedupe import DEDUPE_OFF
+from .reconcile import RECONCILE_STREAM
+from .smugmug import stream_from_url
+from .transfer import COPY, HIDE, KEEP, REUPLOAD, UPLOAD, Action, TransferPool, transfer_byte_count
+from .transport import mount_pools
+
+PLAN_VERSION = 2
+
+# Files at least this big are scheduled apart from the rest.
+DEFAULT_BIG_FILE_SIZE = 50 * 1024 * 1024
+
+# Every action costs a request, even one that moves no bytes.  When
+# scheduling, each one counts as if it moved this many bytes as well.
+REQUEST_COST = 256 * 1024
+
+KINDS = dict((kind.strip(), kind) for kind in [UPLOAD, REUPLOAD, HIDE, COPY])
+
+IMAGE_FIELDS = [
+    'album', 'archived_md5', 'byte_count', 'caption', 'date', 'file_name', 'image_key', 'keywords', 'last_updated',
+    'title', 'b2_path', 'url', 'size', 'md5'
+]
+SOURCE_FIELDS = ['b2_path', 'file_id', 'archived_md5']
+
+_local = threading.local()
+
+
+def _plain_session():
+    """
+    Returns a session with no credentials, one for each thread, for reading
+    content when a plan is applied without a session.
+    """
+    if not hasattr(_local, 'session'):
+        import requests
+        _local.session = mount_pools(requests.Session())
+    return _local.session
+
+
+class PlannedImage:
+    """
+    Stands in for a SmugMugImage when a plan is applied.  url, size and md5
+    say where the content is, which for a video is the LargestVideo.
+    """
+    def __init__(
+            self, album, archived_md5, byte_count, caption, date, file_name, image_key, keywords, last_updated,
+            title, b2_path, url, size, md5
+    ):
+        self.album = album
+        self.archived_md5 = archived_md5
+        self.byte_count = byte_count
+        self.caption = caption
+        self.date = date
+        self.file_name = file_name
+        self.image_key = image_key
+        self.keywords = keywords
+        self.last_updated = last_updated
+        self.title = title
+        self.b2_path = b2_path
+        self.url = url
+        self.size = size
+        self.md5 = md5
+
+    @classmethod
+    def from_smugmug_image(cls, a):
+        url, size, md5 = a.content_location()
+        return cls(
+            a.album, a.archived_md5, a.byte_count, a.caption, a.date, a.file_name, a.image_key, a.keywords,
+            a.last_updated, a.title, a.b2_path, url, size, md5
+        )
+
+    @property
+    def content_size(self):
+        return self.size
+
+    def content_location(self, session=None):
+        return self.url, self.size, self.md5
+
+    def open_content(self, session=None):
+        """
+        Returns a stream of the content.  Without a session, a plain one is
+        used, with no credentials.
+        """
+        return stream_from_url(session or _plain_session(), self.url, self.size, self.md5)
+
+    def __repr__(self):
+        return 'PLAN:' + self.b2_path
+
+
+class PlannedFile:
+    """
+    Stands in for the B2Image or StateImage of a file already in the bucket.
+    """
+    def __init__(self, b2_path, file_id, archived_md5):
+        self.b2_path = b2_path
+        self.file_id = file_id
+        self.archived_md5 = archived_md5
+
+    def __repr__(self):
+        return 'PLAN:' + self.b2_path
+
+
+def _fields(obj, names):
+    return [getattr(obj, name, None) for name in names]
+
+
+def planned_action(action):
+    """
+    Returns the action with its image replaced by a PlannedImage, which
+    knows the size of what will be downloaded.
+    """
+    image = action.smugmug_image
+    if image is None or isinstance(image, PlannedImage):
+        return action
+    return Action(action.kind, action.b2_path, PlannedImage.from_smugmug_image(image), action.source)
+
+
+def action_to_json(action):
+    record = {'k': action.kind.strip(), 'p': action.b2_path}
+    if action.smugmug_image is not None:
+        record['i'] = _fields(planned_action(action).smugmug_image, IMAGE_FIELDS)
+    if action.source is not None:
+        record['s'] = _fields(action.source, SOURCE_FIELDS)
+    return json.dumps(record, separators=(',', ':'))
+
+
+def action_from_json(line):
+    record = json.loads(line)
+    image = PlannedImage(*record['i']) if 'i' in record else None
+    source = PlannedFile(*record['s']) if 's' in record else None
+    return Action(KINDS[record['k']], record['p'], image, source)
+
+
+def make_plan(
+        top_node,
+        bucket,
+        prefix,
+        crawler=None,
+        state=None,
+        full=False,
+        dedupe=DEDUPE_OFF,
+        list_workers=1,
+        list_page_size=None,
+        reconcile=RECONCILE_STREAM
+):
+    """
+    Yields the actions a backup with the same settings would do, except
+    that the content index isn't updated with uploads as they happen.
+    """
+    def list_b2_images(b2_bucket, b2_prefix, start_after=None):
+        return all_b2_images(b2_bucket, b2_prefix, list_workers, list_page_size, start_after)
+
+    content_index = make_content_index(bucket, state, full, dedupe, list_b2_images)
+    actions = backup_actions(
+        top_node, bucket, prefix, crawler, state, full, None, list_b2_images, reconcile=reconcile
+    )
+    for action in use_server_side_copies(actions, content_index):
+        if action.kind != KEEP:
+            yield action
+
+
+def write_plan(path, prefix, actions):
+    """
+    Writes actions to a plan file, and returns (action count, bytes to transfer).
+    """
+    count = 0
+    byte_count = 0
+    with gzip.open(str(path), 'wt', encoding='utf-8') as f:
+        f.write(json.dumps({'plan': PLAN_VERSION, 'prefix': prefix, 'created': time.time()}) + '\n')
+        for action in actions:
+            action = planned_action(action)
+            f.write(action_to_json(action) + '\n')
+            count += 1
+            byte_count += transfer_byte_count(action)
+    return count, byte_count
+
+
+def read_plan(path):
+    """
+    Returns (header, actions) from a plan file.
+    """
+    with gzip.open(str(path), 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('plan') != PLAN_VERSION:
+            raise ValueError('not a version %d plan: %s' % (PLAN_VERSION, path))
+        return header, [action_from_json(line) for line in f if line.strip()]
+
+
+def action_cost(action):
+    return transfer_byte_count(action) + REQUEST_COST
+
+
+def size_aware_order(actions, big_file_size=DEFAULT_BIG_FILE_SIZE):
+    """
+    Returns the actions in the order to do them: big files, biggest first,
+    mixed in with the rest, which stay in path order.
+
+    The two lists are merged so that each is always about the same fraction
+    of the way through its bytes.  That way, while a few workers are busy
+    with big files, the rest have small ones to do, and the big files don't
+    all end up at the beginning or the end.
+    """
+    big = sorted(
+        (action for action in actions if big_file_size <= transfer_byte_count(action)),
+        key=transfer_byte_count,
+        reverse=True
+    )
+    small = [action for action in actions if transfer_byte_count(action) < big_file_size]
+    big_total = sum(action_cost(action) for action in big)
+    small_total = sum(action_cost(action) for action in small)
+    result = []
+    big_done = small_done = 0
+    i = j = 0
+    while i < len(big) or j < len(small):
+        take_big = j == len(small) or (i < len(big) and big_done * small_total <= small_done * big_total)
+        if take_big:
+            result.append(big[i])
+            big_done += action_cost(big[i])
+            i += 1
+        else:
+            result.append(small[j])
+            small_done += action_cost(small[j])
+            j += 1
+    return result
+
+
+def apply_plan(
+        actions,
+        bucket,
+        workers=1,
+        make_session=None,
+        make_bucket=None,
+        options=None,
+        state=None,
+        big_file_size=DEFAULT_BIG_FILE_SIZE,
+        concurrency=None
+):
+    """
+    Does the actions from a plan on a pool of workers, in size_aware_order.
+
+    As with backup, failures don't stop the others, and a TransferError is
+    raised at the end if there were any.  concurrency is as for backup.
+    """
+    pool = TransferPool(bucket, workers, make_session, make_bucket, options, state, concurrency=concurrency)
+    try:
+        for action in size_aware_order(actions, big_file_size):
+            pool.submit(action)
+    finally:
+        errors = pool.close()
+    if pool.bytes_saved:
+        print('Copied inside B2 instead of transferring: %d bytes' % (pool.bytes_saved,))
+    report_failures(errors)
@@ -0,0 +1,194 @@
+#
+# File: reconcile
+#
+
+"""
+Matching SmugMug with the bucket when the two sides don't come out in the
+same order.
+
+Normally, both sides are streamed in b2_path order and matched up with
+ordered_zip, which needs each side to be strictly increasing.  SmugMug's
+side is only in order if the names of folders and albums sort the way we
+expect, and two albums with the same name in one folder give the same
+paths twice.  When that happens, ordered_zip stops the run.
+
+The "sort" mode copies both sides into a temporary SQLite database, which
+sorts them on disk, and then matches them up from there.  Memory use stays
+small however big the account is.  Duplicate paths are counted, and only
+the first one is backed up.
+
+Sorting is done one group at a time, usually a top-level folder.  Folders
+are crawled in name order, so the groups come out in order on both sides,
+even when the paths inside them don't, and the actions for one folder are
+handed to the transfer workers as soon as both sides of it have been listed.
+"""
+
+import io
+import itertools
+import os
+import pickle
+import sqlite3
+import tempfile
+
+from .metrics import run_metrics
+from .util import ordered_zip
+
+RECONCILE_STREAM = 'stream'
+RECONCILE_SORT = 'sort'
+RECONCILE_MODES = [RECONCILE_STREAM, RECONCILE_SORT]
+
+# Rows inserted between commits while spilling.
+INSERT_BATCH = 1000
+
+# Pages of SQLite cache, which bounds the memory used by the sort.
+CACHE_PAGES = 2000
+
+SIDE_A = 0
+SIDE_B = 1
+
+
+class _Pickler(pickle.Pickler):
+    """
+    Pickles items, leaving sessions in memory: they hold connections and
+    locks, and there are only a few of them, shared by many items.
+    """
+
+    def __init__(self, file, objects, session_class):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self._objects = objects
+        self._session_class = session_class
+
+    def persistent_id(self, obj):
+        if isinstance(obj, self._session_class):
+            self._objects[id(obj)] = obj
+            return id(obj)
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, objects):
+        super().__init__(file)
+        self._objects = objects
+
+    def persistent_load(self, pid):
+        return self._objects[pid]
+
+
+class SpillSort:
+    """
+    Sorts the items of two sides by key, in a temporary SQLite database.
+    Use as a context manager; the database is removed when done.
+    """
+
+    def __init__(self, directory=None):
+        import requests
+        fd, self.path = tempfile.mkstemp(prefix='smugmug-to-b2-', suffix='.sqlite', dir=directory)
+        os.close(fd)
+        self._objects = {}
+        self._buffer = io.BytesIO()
+        self._pickler = _Pickler(self._buffer, self._objects, requests.Session)
+        self._indexed = False
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('PRAGMA journal_mode=OFF')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._conn.execute('PRAGMA cache_size=%d' % (CACHE_PAGES,))
+        self._conn.execute('CREATE TABLE items (side INTEGER, key TEXT, seq INTEGER, item BLOB)')
+
+    def _dumps(self, item):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._pickler.clear_memo()
+        self._pickler.dump(item)
+        return self._buffer.getvalue()
+
+    def _loads(self, data):
+        return _Unpickler(io.BytesIO(data), self._objects).load()
+
+    def add_all(self, side, iterable, key):
+        batch = []
+        for (seq, item) in enumerate(iterable):
+            batch.append((side, key(item), seq, self._dumps(item)))
+            if INSERT_BATCH <= len(batch):
+                self._insert(batch)
+                batch = []
+        self._insert(batch)
+
+    def _insert(self, batch):
+        self._conn.executemany('INSERT INTO items VALUES (?, ?, ?, ?)', batch)
+        self._conn.commit()
+
+    def unique(self, side):
+        """
+        Yields the items of one side in key order, skipping all but the
+        first of each key, which are counted as duplicates.
+        """
+        if not self._indexed:
+            self._conn.execute('CREATE INDEX items_by_key ON items (side, key, seq)')
+            self._indexed = True
+        previous_key = None
+        cursor = self._conn.execute('SELECT key, item FROM items WHERE side = ? ORDER BY key, seq', (side,))
+        for (key, data) in cursor:
+            if key == previous_key:
+                print('DUPLICATE', key)
+                run_metrics.duplicate()
+                continue
+            previous_key = key
+            yield self._loads(data)
+
+    def close(self):
+        self._conn.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def top_level_folder(path, prefix=''):
+    """
+    Returns path up to the end of the first folder name after prefix, or
+    all of it if it isn't in a folder.  Paths in order have their top-level
+    folders in order too.
+    """
+    end = path.find('/', len(prefix))
+    return path if end == -1 else path[:end + 1]
+
+
+def _groups(iterable, key, group):
+    for (group_key, items) in itertools.groupby(iterable, key=lambda item: group(key(item))):
+        yield group_key, items
+
+
+def sorted_zip(iterable_a, iterable_b, key=None, directory=None, group=None):
+    """
+    Like ordered_zip, but the inputs can be in any order, and can have
+    more than one item with the same key, of which only the first is used.
+
+    With group, a function of the key, the items of each group must come
+    together, and the groups in order, on both sides.  Each group is sorted
+    by itself, and its pairs are yielded before the next group is read.
+    Without it, both inputs are read to the end before the first pair is
+    yielded.  directory is where the temporary database goes.
+    """
+    key = key or (lambda x: x)
+    group = group or (lambda k: '')
+    groups = ordered_zip(_groups(iterable_a, key, group), _groups(iterable_b, key, group), key=lambda g: g[0])
+    for (group_a, group_b) in groups:
+        with SpillSort(directory) as spill:
+            if group_a is not None:
+                spill.add_all(SIDE_A, group_a[1], key)
+            if group_b is not None:
+                spill.add_all(SIDE_B, group_b[1], key)
+            yield from ordered_zip(spill.unique(SIDE_A), spill.unique(SIDE_B), key)
+
+
+def reconciled_zip(iterable_a, iterable_b, key=None, mode=RECONCILE_STREAM, group=None):
+    """
+    Matches up two sides by key, with ordered_zip or sorted_zip depending
+    on the mode.  group is passed on to sorted_zip.
+    """
+    if mode == RECONCILE_SORT:
+        return sorted_zip(iterable_a, iterable_b, key, group=group)
+    return ordered_zip(iterable_a, iterable_b, key)
@@ -5,15 +5,16 @@
 import json
 import hashlib
 import os
-import requests_oauthlib
+import threading
 import urllib
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from rauth import OAuth1Service
 from typing import Dict
 from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
-from .exception import AppError, HttpError
+from .exception import AppError, ContentError, HttpError, NotFoundError
+from .transport import RequestCounter, mount_pools, send_with_retry, session_for_thread
 
 # From https://api.smugmug.com/api/v2/doc/tutorial/oauth/non-web.html:
 OAUTH_ORIGIN = 'https://secure.smugmug.com'
@@ -22,6 +23,15 @@ ACCESS_TOKEN_URL = OAUTH_ORIGIN + '/services/oauth/1.0a/getAccessToken'
 AUTHORIZE_URL = OAUTH_ORIGIN + '/services/oauth/1.0a/authorize'
 API_ORIGIN = 'https://api.smugmug.com'
 
+# How many bytes to read from a download at a time
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Paging of lists.  SmugMug won't return more than MAX_PAGE_SIZE items in one page.
+MAX_PAGE_SIZE = 100
+DEFAULT_PAGE_WORKERS = 4
+_page_size = MAX_PAGE_SIZE
+_page_workers = DEFAULT_PAGE_WORKERS
+
 # PIN path
 PIN_PATH = Path(os.getenv('HOME'), '.smugmug-to-b2-access-token')
 
@@ -61,6 +71,8 @@ def _make_service(key, secret):
     """
     Creates an OAUTH service.
     """
+    # rauth is only used to authorize, so it isn't imported when the program starts.
+    from rauth import OAuth1Service
     service = OAuth1Service(
         name='smugmug-to-b2',
         consumer_key=key,
@@ -73,7 +85,7 @@ def _make_service(key, secret):
     return service
 
 
-def get_auth_url(key, secret):
+def get_auth_url(key, secret, pin_path=PIN_PATH):
     """
     Returns the URL to visit to authorize access to a smugmug account.
     """
@@ -85,91 +97,277 @@ def get_auth_url(key, secret):
     rt, rts = service.get_request_token(params={'oauth_callback': 'oob'})
 
     # Save the request token, because we'll need it after getting the PIN.
-    _write_json_dict(PIN_PATH, dict(key=key, secret=secret, request_token=rt, request_token_secret=rts))
+    _write_json_dict(pin_path, dict(key=key, secret=secret, request_token=rt, request_token_secret=rts))
 
     # Second, we need to give the user the web URL where they can authorize our
     # application.
     return _add_auth_params(service.get_authorize_url(rt), access='Full', permissions='Modify')
 
 
-def set_pin(key, secret, pin):
+def set_pin(key, secret, pin, pin_path=PIN_PATH):
     """
     Uses the PIN from visiting the auth page to create key/secret.
     """
     # Get the request token and secret that was saved before.
-    info = _read_json_dict(PIN_PATH)
+    info = _read_json_dict(pin_path)
     rt = info['request_token']
     rts = info['request_token_secret']
     service = _make_service(key, secret)
     at, ats = service.get_access_token(rt, rts, params={'oauth_verifier': pin})
-    _write_json_dict(PIN_PATH, dict(key=key, secret=secret, access_token=at, access_token_secret=ats))
+    _write_json_dict(pin_path, dict(key=key, secret=secret, access_token=at, access_token_secret=ats))
+
+
+request_counter = RequestCounter()
+
+
+def endpoint_name(path):
+    """
+    Returns the name of the kind of request a path is, without the IDs in
+    it, so that counts of similar requests can be added up.
+
+    For example: /api/v2/node/XwLd6!children?count=100 -> node!children
+    """
+    path = urlsplit(path).path
+    if path.startswith('/api/v2'):
+        path = path[len('/api/v2'):]
+    segments = path.strip('/').split('/')
+    object_type = segments[0]
+    if '!' in object_type:
+        return object_type
+    method = segments[-1].partition('!')[2]
+    return object_type + '!' + method if method else object_type
+
+
+def configure_paging(page_size=None, page_workers=None):
+    """
+    Sets how many items to ask for in each page of a list, and how many
+    pages to fetch at once.
+    """
+    global _page_size, _page_workers
+    if page_size is not None:
+        assert 1 <= page_size <= MAX_PAGE_SIZE, 'page size must be between 1 and %d' % (MAX_PAGE_SIZE,)
+        _page_size = page_size
+    if page_workers is not None:
+        assert 1 <= page_workers
+        _page_workers = page_workers
+
+
+def _with_query(path, **params):
+    parts = urlsplit(path)
+    query = parse_qsl(parts.query, True)
+    query.extend((k, str(v)) for (k, v) in params.items())
+    return urlunsplit((
+        parts.scheme,
+        parts.netloc,
+        parts.path,
+        urlencode(query, True, safe=','),
+        parts.fragment))
 
 
 def _get_json(session, path):
-    response = session.get(API_ORIGIN + path, headers={'Accept': 'application/json'})
+    endpoint = endpoint_name(path)
+    request_counter.count(endpoint)
+    response = send_with_retry(session, API_ORIGIN + path, endpoint, headers={'Accept': 'application/json'})
     if response.status_code != 200:
-        if response.status_code == 401:
-            message = json.loads(response.text)['Message']
-            print(urllib.parse.unquote(message))
-        raise HttpError('status %d: %s' % (response.status_code, response.text,))
-    else:
-        return response.json()['Response']
+        _raise_http_error(response.status_code, response.text)
+    return _unpack_response(response.json())
+
+
+def _raise_http_error(status_code, text):
+    if status_code == 401:
+        message = json.loads(text)['Message']
+        print(urllib.parse.unquote(message))
+    if status_code == 404:
+        raise NotFoundError('status %d: %s' % (status_code, text,))
+    raise HttpError('status %d: %s' % (status_code, text,))
+
+
+def _unpack_response(body):
+    """
+    Returns the Response from the body of a reply to an API request.
+    """
+    # Expanded objects come alongside the Response, not in it.
+    result = body['Response']
+    if 'Expansions' in body:
+        result['Expansions'] = body['Expansions']
+    return result
+
+
+def _remaining_page_starts(result):
+    """
+    Takes the first page of a list, and returns (page size, start index of
+    each of the pages after it).  The Pages are removed from the result.
+    """
+    pages = result.pop('Pages', None)
+    if pages is None or pages.get('NextPage') is None:
+        return None, []
+    page_count = pages['Count']
+    return page_count, list(range(pages['Start'] + page_count, pages['Total'] + 1, page_count))
+
+
+def _add_page(result, one_batch):
+    """
+    Adds the items in one page of a list onto the result, which is the first page.
+    """
+    list_field = result['Locator']
+    result.setdefault(list_field, []).extend(one_batch.get(list_field, []))
+    if 'Expansions' in one_batch:
+        result.setdefault('Expansions', {}).update(one_batch['Expansions'])
+
+
+def _iter_paged_json(session, path):
+    """
+    Yields the pages of a list, in order, as they arrive.
+
+    The first page says how many items there are in all.  The rest of the
+    pages are then fetched a few at a time, so that no more than that many
+    are held in memory waiting to be used.  Each page thread has its own
+    copy of the session, sharing its connection pools.
+    """
+    page_size = _page_size
+    first = _get_json(session, _with_query(path, start=1, count=page_size))
+    page_count, starts = _remaining_page_starts(first)
+    yield first
+    if not starts:
+        return
+    local = threading.local()
+
+    def init_page_thread():
+        local.session = session_for_thread(session)
+
+    def get_page(start):
+        return _get_json(local.session, _with_query(path, start=start, count=page_count))
+
+    with ThreadPoolExecutor(
+            max_workers=_page_workers, thread_name_prefix='page', initializer=init_page_thread
+    ) as executor:
+        for i in range(0, len(starts), _page_workers):
+            yield from executor.map(get_page, starts[i:i + _page_workers])
 
 
 def _get_paged_json(session, path):
-    result = None
-    next_path = path + '?count=20'
-    while next_path is not None:
-        one_batch = _get_json(session, next_path)
-        if result is None:
-            result = one_batch
-        else:
-            list_field = result['Locator']
-            result[list_field].extend(one_batch[list_field])
-        if 'Pages' not in one_batch:
-            break
-        pages = one_batch['Pages']
-        next_path = pages.get('NextPage')
-    if 'Pages' in result:
-        del result['Pages']
+    """
+    Gets all of the pages of a list, and returns them as one response.
+    """
+    pages = _iter_paged_json(session, path)
+    result = next(pages)
+    for one_batch in pages:
+        _add_page(result, one_batch)
     return result
 
 
+# Query parameters to use when following each kind of URI.  _filter and
+# _filteruri ask for only the fields and URIs that this module reads, and
+# _expand asks for the object that will be needed next to be included in the
+# same response, saving a request for each one.
+NODE_FIELDS = 'HasChildren,Name,Type,Uri'
+NODE_URIS = 'Album,ChildNodes'
+ALBUM_IMAGE_FIELDS = (
+    'ArchivedMD5,ArchivedSize,ArchivedUri,Caption,Date,FileName,Format,ImageKey,Keywords,LastUpdated,Title,Uri'
+)
+URI_QUERY_PARAMS = {
+    'Node': dict(_filter=NODE_FIELDS, _filteruri=NODE_URIS),
+    'ChildNodes': dict(_filter=NODE_FIELDS, _filteruri=NODE_URIS, _expand='Album'),
+    'Album': dict(_filter='ImagesLastUpdated,LastUpdated,Uri', _filteruri='AlbumImages'),
+    'AlbumImages': dict(_filter=ALBUM_IMAGE_FIELDS, _filteruri='LargestVideo', _expand='LargestVideo'),
+    'LargestVideo': dict(_filter='MD5,Size,Uri,Url'),
+}
+
+
+def _unpack_expansion(expansion, expected_type):
+    """
+    Returns (object_type, object_data) from one entry in the Expansions of a
+    response, or None if it doesn't hold the expected type of object.
+    Entries can carry other keys besides the object, so it is picked out by
+    name: the entry's Locator, if it has one, or else the expected type.
+    """
+    object_type = expansion.get('Locator', expected_type)
+    if object_type not in expansion:
+        return None
+    return object_type, expansion[object_type]
+
+
 class BaseObject:
-    def __init__(self, session, data):
+    def __init__(self, session, data, expansions=None):
         self.session = session
         self.data = data
+        # Objects that SmugMug included in the response this object came
+        # from, keyed by URI.  Shared by all of the objects in one response.
+        self.expansions = expansions or {}
 
     def _get_from_my_uri(self, uri_name):
+        expanded = self._expanded(uri_name)
+        if expanded is not None:
+            return expanded
+        return self._objects_from(_get_paged_json(self.session, self._query_path(uri_name)))
+
+    def _iter_from_my_uri(self, uri_name):
+        """
+        Yields the objects in a list at one of my URIs, a page at a time, so
+        that each page can be let go of once its objects are used.
+        """
+        for page in _iter_paged_json(self.session, self._query_path(uri_name)):
+            yield from self._objects_from(page)
+
+    def _expanded(self, uri_name):
+        """
+        Returns the object at one of my URIs if it came in the same response
+        as I did, or None if it has to be fetched.
+        """
         uris = self.data['Uris']
         if uri_name not in uris:
             pj(self.data)
         path = uris[uri_name]['Uri']
-        data = _get_paged_json(self.session, path)
+        if path not in self.expansions:
+            return None
+        unpacked = _unpack_expansion(self.expansions[path], uris[uri_name].get('Locator', uri_name))
+        if unpacked is None:
+            return None
+        object_type, object_data = unpacked
+        return self.make_object(self.session, object_type, object_data)
+
+    def _query_path(self, uri_name):
+        """
+        Returns the path to fetch one of my URIs, with the query parameters to use.
+        """
+        return _with_query(self.data['Uris'][uri_name]['Uri'], **URI_QUERY_PARAMS.get(uri_name, {}))
+
+    def _objects_from(self, data):
+        """
+        Returns the object, or list of objects, in a response.
+        """
+        expansions = data.get('Expansions')
         object_type = data['Locator']
         if data['LocatorType'] == 'Object':
-            return self.make_object(self.session, object_type, data[object_type])
+            return self.make_object(self.session, object_type, data[object_type], expansions)
         elif data['LocatorType'] == 'Objects':
             return list(
-                self.make_object(self.session, object_type, object_data)
+                self.make_object(self.session, object_type, object_data, expansions)
                 for object_data in data.get(object_type, [])
             )
 
     def __str__(self):
         return self.data['Uri']
 
+    def with_session(self, session):
+        """
+        Returns a copy of this object that makes its requests through another session.
+        """
+        return type(self)(session, self.data, self.expansions)
+
     @classmethod
-    def make_object(cls, session, object_type, object_data):
+    def make_object(cls, session, object_type, object_data, expansions=None):
         if object_type == 'Album':
-            return Album(session, object_data)
-        elif object_type == 'AlbumImage':
-            return AlbumImage(session, object_data)
+            return Album(session, object_data, expansions)
+        elif object_type in ('AlbumImage', 'Image'):
+            # An Image, fetched on its own, has the same fields as an AlbumImage.
+            return AlbumImage(session, object_data, expansions)
         elif object_type == 'LargestVideo':
-            return LargestVideo(session, object_data)
+            return LargestVideo(session, object_data, expansions)
         elif object_type == 'Node':
-            return Node(session, object_data)
+            return Node(session, object_data, expansions)
         elif object_type == 'User':
-            return User(session, object_data)
+            return User(session, object_data, expansions)
         else:
             raise AppError('unknown object type: ' + object_type)
 
@@ -217,21 +415,112 @@ class Album(BaseObject):
     def images(self):
         return self._get_from_my_uri('AlbumImages')
 
+    def iter_images(self):
+        """
+        Yields the AlbumImages a page at a time.
+        """
+        return self._iter_from_my_uri('AlbumImages')
+
+    def image_records(self):
+        """
+        Returns an ImageRecord for each image, without keeping the JSON of
+        more than a few pages at once.
+        """
+        return [image.record() for image in self.iter_images()]
+
+    @property
+    def last_updated(self):
+        return self._get_required('LastUpdated')
+
+    @property
+    def images_last_updated(self):
+        return self._get_required('ImagesLastUpdated')
+
 
 def bytes_from_url(session, url, expected_byte_count=None, expected_md5=None):
-    response = session.get(url)
+    request_counter.count('download')
+    response = send_with_retry(session, url, 'download')
     if response.status_code != 200:
         raise HttpError('status = %d %s' % (response.status_code, response.text,))
     response.raw.decode_content = True  # force undo transport encoding (like gzip)
     content_bytes = response.content
     md5_hash = hashlib.md5(content_bytes).hexdigest()
-    if expected_byte_count is not None:
-        assert len(content_bytes) == expected_byte_count
-    if expected_md5 is not None:
-        assert md5_hash == expected_md5
+    if expected_byte_count is not None and len(content_bytes) != expected_byte_count:
+        raise ContentError('expected %d bytes, got %d: %s' % (expected_byte_count, len(content_bytes), url))
+    if expected_md5 is not None and md5_hash != expected_md5:
+        raise ContentError('expected MD5 %s, got %s: %s' % (expected_md5, md5_hash, url))
     return content_bytes
 
 
+class VerifyingStream:
+    """
+    A read-only stream of the body of a download.
+
+    Bytes are pulled from the response one chunk at a time, and hashed as
+    they go by.  When the end is reached, the size and MD5 are checked, and
+    ContentError is raised if they don't match.
+    """
+
+    def __init__(self, response, url, expected_byte_count=None, expected_md5=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self._response = response
+        self._url = url
+        self._expected_byte_count = expected_byte_count
+        self._expected_md5 = expected_md5
+        self._chunks = response.iter_content(chunk_size)
+        self._md5 = hashlib.md5()
+        self._byte_count = 0
+        self._buffer = bytearray()
+        self._done = False
+
+    def read(self, size=-1):
+        while not self._done and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._finish()
+            else:
+                self._md5.update(chunk)
+                self._byte_count += len(chunk)
+                self._buffer += chunk
+        if size is None or size < 0:
+            size = len(self._buffer)
+        result = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return result
+
+    def _finish(self):
+        self._done = True
+        self.close()
+        if self._expected_byte_count is not None and self._byte_count != self._expected_byte_count:
+            raise ContentError(
+                'expected %d bytes, got %d: %s' % (self._expected_byte_count, self._byte_count, self._url)
+            )
+        md5_hash = self._md5.hexdigest()
+        if self._expected_md5 is not None and md5_hash != self._expected_md5:
+            raise ContentError('expected MD5 %s, got %s: %s' % (self._expected_md5, md5_hash, self._url))
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def stream_from_url(session, url, expected_byte_count=None, expected_md5=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Like bytes_from_url, but returns a VerifyingStream instead of reading
+    the whole body into memory.
+    """
+    request_counter.count('download')
+    response = send_with_retry(session, url, 'download', stream=True)
+    if response.status_code != 200:
+        response.close()
+        raise HttpError('status = %d %s' % (response.status_code, response.text,))
+    return VerifyingStream(response, url, expected_byte_count, expected_md5, chunk_size)
+
+
 class AlbumImage(BaseObject):
 
     @property
@@ -249,6 +538,50 @@ class AlbumImage(BaseObject):
             pj(self.data)
             raise
 
+    def open_content(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Returns a VerifyingStream of the content.
+        """
+        fmt = self.data['Format']
+        if fmt == 'JPG':
+            return stream_from_url(self.session, self.archived_uri, self.byte_count, self.archived_md5, chunk_size)
+        elif fmt == 'MP4':
+            return self.largest_video.open_content(chunk_size)
+        else:
+            raise AppError('unknown format: ' + fmt)
+
+    def record(self):
+        """
+        Returns an ImageRecord with what a backup needs from this image.
+        """
+        fmt = self.data['Format']
+        url = size = md5 = video_uri = None
+        if fmt == 'JPG':
+            url, size, md5 = self.archived_uri, self.byte_count, self.archived_md5
+        elif fmt == 'MP4':
+            largest_video = self._expanded('LargestVideo')
+            if largest_video is not None:
+                url, size, md5 = largest_video.url, largest_video.size, largest_video.md5
+            else:
+                video_uri = self.data['Uris']['LargestVideo']['Uri']
+        return ImageRecord(
+            self.session, self.archived_md5, self.byte_count, self.caption, self.date, self.file_name,
+            self.image_key, self.keywords, self.last_updated, self.title, fmt, url, size, md5, video_uri
+        )
+
+    def content_location(self):
+        """
+        Returns (url, byte_count, md5) of the content that open_content() reads.
+        """
+        fmt = self.data['Format']
+        if fmt == 'JPG':
+            return self.archived_uri, self.byte_count, self.archived_md5
+        elif fmt == 'MP4':
+            largest_video = self.largest_video
+            return largest_video.url, largest_video.size, largest_video.md5
+        else:
+            raise AppError('unknown format: ' + fmt)
+
     @property
     def archived_md5(self):
         return self._get_required('ArchivedMD5')
@@ -273,6 +606,14 @@ class AlbumImage(BaseObject):
     def file_name(self):
         return self._get_required('FileName')
 
+    @property
+    def image_key(self):
+        return self._get_required('ImageKey')
+
+    @property
+    def last_updated(self):
+        return self._get_required('LastUpdated')
+
     @property
     def largest_video(self):
         return self._get_from_my_uri('LargestVideo')
@@ -296,6 +637,9 @@ class LargestVideo(BaseObject):
     def content(self):
         return bytes_from_url(self.session, self.url, self.size, self.md5)
 
+    def open_content(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        return stream_from_url(self.session, self.url, self.size, self.md5, chunk_size)
+
     @property
     def url(self):
         return self._get_required('Url')
@@ -309,16 +653,101 @@ class LargestVideo(BaseObject):
         return self._get_required('MD5')
 
 
-def get_auth_user():
-    info = _read_json_dict(PIN_PATH)
+class ImageRecord:
+    """
+    The fields of an AlbumImage that a backup uses, and where to get its
+    content, without the rest of the JSON.  An album with tens of thousands
+    of images is held as these while it is sorted.
+
+    For a video whose LargestVideo wasn't expanded in the listing, only its
+    URI is kept, and it is fetched when the content is needed.
+    """
+    __slots__ = (
+        'session', 'archived_md5', 'byte_count', 'caption', 'date', 'file_name', 'image_key', 'keywords',
+        'last_updated', 'title', 'format', 'content_url', 'content_size', 'content_md5', 'video_uri'
+    )
+
+    def __init__(
+            self, session, archived_md5, byte_count, caption, date, file_name, image_key, keywords, last_updated,
+            title, format, content_url, content_size, content_md5, video_uri=None
+    ):
+        self.session = session
+        self.archived_md5 = archived_md5
+        self.byte_count = byte_count
+        self.caption = caption
+        self.date = date
+        self.file_name = file_name
+        self.image_key = image_key
+        self.keywords = keywords
+        self.last_updated = last_updated
+        self.title = title
+        self.format = format
+        self.content_url = content_url
+        self.content_size = content_size
+        self.content_md5 = content_md5
+        self.video_uri = video_uri
+
+    def with_session(self, session):
+        """
+        Returns a copy of this record that makes its requests through another session.
+        """
+        return ImageRecord(*([session] + [getattr(self, name) for name in self.__slots__[1:]]))
+
+    def content_location(self):
+        """
+        Returns (url, byte_count, md5) of the content that open_content() reads.
+        """
+        if self.format not in ('JPG', 'MP4'):
+            raise AppError('unknown format: ' + self.format)
+        if self.content_url is None:
+            data = _get_json(self.session, _with_query(self.video_uri, **URI_QUERY_PARAMS['LargestVideo']))
+            largest_video = LargestVideo(self.session, data['LargestVideo'])
+            self.content_url, self.content_size, self.content_md5 = (
+                largest_video.url, largest_video.size, largest_video.md5
+            )
+        return self.content_url, self.content_size, self.content_md5
+
+    @property
+    def content(self):
+        return bytes_from_url(self.session, *self.content_location())
+
+    def open_content(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        url, byte_count, md5 = self.content_location()
+        return stream_from_url(self.session, url, byte_count, md5, chunk_size)
+
+
+def get_image(session, image_key):
+    """
+    Returns one image, looked up by its key, as an AlbumImage, without
+    listing the album it is in.
+    """
+    path = _with_query('/api/v2/image/' + image_key, **URI_QUERY_PARAMS['AlbumImages'])
+    data = _get_json(session, path)
+    return BaseObject.make_object(session, data['Locator'], data[data['Locator']], data.get('Expansions'))
+
+
+def get_auth_session(pin_path=PIN_PATH, shared_pools=False):
+    """
+    Returns a new OAUTH session using the access token saved by set_pin.
+
+    Sessions are not shared between threads, so each transfer worker makes
+    its own.  With shared_pools, their connections are shared, though.
+    """
+    info = _read_json_dict(pin_path)
     key = info['key']
     secret = info['secret']
     access_token = info['access_token']
     access_token_secret = info['access_token_secret']
-    session = requests_oauthlib.OAuth1Session(
+    # Imported here, so that commands that don't talk to SmugMug start quickly.
+    import requests_oauthlib
+    return mount_pools(requests_oauthlib.OAuth1Session(
         client_key=key,
         client_secret=secret,
         resource_owner_key=access_token,
         resource_owner_secret=access_token_secret
-    )
+    ), shared_pools)
+
+
+def get_auth_user(pin_path=PIN_PATH, shared_pools=False):
+    session = get_auth_session(pin_path, shared_pools)
     return BaseObject.make_object(session, 'User', _get_json(session, '/api/v2!authuser')['User'])
@@ -0,0 +1,283 @@
+#
+# File: state
+#
+
+"""
+A local SQLite database of what has been backed up.
+
+There is one row per image in the bucket, recording where it came from in
+SmugMug and the B2 file it was uploaded to.  When a backup uses the
+database, it stands in for listing the bucket: images whose row matches
+what SmugMug says are skipped without asking B2 about them.
+
+The database can always be rebuilt from the bucket, either with the
+rebuild-state command or by running a backup with --full.
+"""
+
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+DEFAULT_STATE_PATH = Path.home() / '.smugmug-to-b2-state.sqlite'
+
+# Writes are committed in batches, because a commit waits for the disk.
+COMMIT_EVERY = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    b2_path TEXT PRIMARY KEY,
+    image_key TEXT,
+    album TEXT,
+    archived_md5 TEXT,
+    last_updated TEXT,
+    file_id TEXT,
+    checked_at REAL
+);
+CREATE INDEX IF NOT EXISTS images_by_md5 ON images (archived_md5);
+CREATE TABLE IF NOT EXISTS albums (
+    prefix TEXT PRIMARY KEY,
+    last_updated TEXT,
+    images_last_updated TEXT
+);
+"""
+
+class StateImage:
+    """
+    One row of the images table.  Takes the place of a B2Image in a backup.
+    """
+    def __init__(self, b2_path, image_key, album, archived_md5, last_updated, file_id, checked_at):
+        self.b2_path = b2_path
+        self.image_key = image_key
+        self.album = album
+        self.archived_md5 = archived_md5
+        self.last_updated = last_updated
+        self.file_id = file_id
+        self.checked_at = checked_at
+
+    def __repr__(self):
+        return 'DB:' + self.b2_path
+
+    def __str__(self):
+        return repr(self)
+
+
+IMAGE_COLUMNS = 'b2_path, image_key, album, archived_md5, last_updated, file_id, checked_at'
+
+
+def _starts_with(column):
+    return 'substr(%s, 1, ?) = ?' % (column,)
+
+
+class StateDb:
+    """
+    Access to the state database, from any number of threads.
+
+    Writes go through one connection, under a lock.  Listing uses its own
+    connection, so that it can run while the transfer workers are writing.
+    """
+
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = self._connect()
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+            self._conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _write(self, sql, params=()):
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._pending += 1
+            if COMMIT_EVERY <= self._pending:
+                self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self._pending = 0
+
+    def images(self, prefix='', start_after=None):
+        """
+        Yields the StateImages whose paths start with prefix, sorted by
+        b2_path.  With start_after, only paths after that one are included.
+
+        SQLite compares text as UTF-8 bytes, which is the same order as
+        comparing Python strings and as B2 listings.
+        """
+        # The listing connection can't see writes that haven't been committed.
+        with self._lock:
+            self._commit()
+        where = _starts_with('b2_path')
+        params = (len(prefix), prefix)
+        if start_after is not None:
+            where += ' AND b2_path > ?'
+            params += (start_after,)
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                'SELECT ' + IMAGE_COLUMNS + ' FROM images WHERE ' + where + ' ORDER BY b2_path',
+                params
+            )
+            for row in cursor:
+                yield StateImage(*row)
+        finally:
+            conn.close()
+
+    def find_by_md5(self, archived_md5):
+        """
+        Returns a StateImage for a file with the given content, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT ' + IMAGE_COLUMNS + ' FROM images WHERE archived_md5 = ? LIMIT 1',
+                (archived_md5,)
+            ).fetchone()
+        return None if row is None else StateImage(*row)
+
+    def record(self, image, file_id, checked_at=None):
+        """
+        Records that a SmugMugImage is in the bucket, as the given B2 file.
+        """
+        self._write(
+            'INSERT OR REPLACE INTO images (' + IMAGE_COLUMNS + ') VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                image.b2_path,
+                image.image_key,
+                image.album,
+                image.archived_md5,
+                image.last_updated,
+                file_id,
+                time.time() if checked_at is None else checked_at
+            )
+        )
+
+    def record_b2_file(self, b2_image, checked_at=None):
+        """
+        Records a file found in the bucket, using what is in its file info.
+        """
+        file_info = b2_image.file_info
+        album = b2_image.b2_path[:b2_image.b2_path.rfind('/') + 1]
+        self._write(
+            'INSERT OR REPLACE INTO images (' + IMAGE_COLUMNS + ') VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                b2_image.b2_path,
+                file_info.get('image_key'),
+                album,
+                file_info.get('archived_md5'),
+                file_info.get('last_updated'),
+                b2_image.file_id,
+                time.time() if checked_at is None else checked_at
+            )
+        )
+
+    def forget(self, b2_path):
+        self._write('DELETE FROM images WHERE b2_path = ?', (b2_path,))
+
+    def forget_unchecked(self, prefix, checked_since):
+        """
+        Deletes the rows under a prefix that were not checked since the given time.
+        """
+        self._write(
+            'DELETE FROM images WHERE ' + _starts_with('b2_path') + ' AND checked_at < ?',
+            (len(prefix), prefix, checked_since)
+        )
+
+    def albums(self, prefix=''):
+        """
+        Returns {album_prefix: (last_updated, images_last_updated)} for the
+        albums under prefix that were completely backed up.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                'SELECT prefix, last_updated, images_last_updated FROM albums WHERE ' + _starts_with('prefix'),
+                (len(prefix), prefix)
+            )
+            return dict((row[0], (row[1], row[2])) for row in cursor)
+
+    def record_album(self, album_prefix, last_updated, images_last_updated):
+        self._write(
+            'INSERT OR REPLACE INTO albums (prefix, last_updated, images_last_updated) VALUES (?, ?, ?)',
+            (album_prefix, last_updated, images_last_updated)
+        )
+
+    def forget_album(self, album_prefix):
+        self._write('DELETE FROM albums WHERE prefix = ?', (album_prefix,))
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AlbumChanges:
+    """
+    Decides which albums can be skipped because they haven't changed since
+    they were last completely backed up.
+
+    An album is skipped when its LastUpdated and ImagesLastUpdated are the
+    same as when it was recorded.  The images of a skipped album are not
+    listed in SmugMug, and its rows in the state database are left alone.
+
+    When a backup is resumed, albums up to start_after were taken care of
+    by the earlier run, and are left alone too.
+    """
+
+    def __init__(self, state, prefix='', start_after=None):
+        self._state = state
+        self._prefix = prefix
+        self._start_after = start_after
+        self._known = state.albums(prefix)
+        self._listed = {}
+        self.skipped = set()
+
+    def should_list(self, album_prefix, album):
+        stamps = (album.last_updated, album.images_last_updated)
+        if self._known.get(album_prefix) == stamps:
+            self.skipped.add(album_prefix)
+            return False
+        self._listed[album_prefix] = stamps
+        return True
+
+    def save(self, failed_paths):
+        """
+        Records the albums that were listed, except for ones where a transfer
+        failed, so that they will be skipped next time.  Albums that have
+        gone away are forgotten.
+        """
+        failed_albums = set(path[:path.rfind('/') + 1] for path in failed_paths)
+        for (album_prefix, stamps) in self._listed.items():
+            if album_prefix in failed_albums:
+                self._state.forget_album(album_prefix)
+            else:
+                self._state.record_album(album_prefix, *stamps)
+        for album_prefix in self._known:
+            if self._start_after is not None and album_prefix <= self._start_after:
+                continue
+            if album_prefix not in self._listed and album_prefix not in self.skipped:
+                self._state.forget_album(album_prefix)
+
+
+def rebuild_state(state, b2_images, prefix=''):
+    """
+    Replaces the rows under prefix with what is actually in the bucket.
+    """
+    started = time.time()
+    count = 0
+    for b2_image in b2_images:
+        state.record_b2_file(b2_image, started)
+        count += 1
+    state.forget_unchecked(prefix, started)
+    return count
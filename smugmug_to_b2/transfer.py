@@ -0,0 +1,364 @@
+#
+# File: transfer
+#
+
+"""
+Carries out the uploads and hides decided on by the backup.
+
+The backup loop only decides what needs doing.  The actual work is handed
+to a pool of worker threads, each of which has its own SmugMug session and
+B2 bucket, because neither is safe to share between threads.
+"""
+
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .concurrency import RateLimiter, ThrottledReader
+from .large_file import MIN_PART_SIZE, upload_large_stream
+from .metrics import (
+    COPY as COPY_PHASE,
+    DOWNLOAD,
+    HIDE as HIDE_PHASE,
+    UPLOAD as UPLOAD_PHASE,
+    TimedReader,
+    run_metrics,
+)
+from .transport import add_throttle_listener, remove_throttle_listener
+
+UPLOAD = 'UPLOAD  '
+REUPLOAD = 'REUPLOAD'
+HIDE = 'HIDE    '
+COPY = 'COPY    '
+# Nothing to do: the bucket already matches.  Never submitted to a pool.
+KEEP = 'KEEP    '
+
+# Uploads are buffered one part at a time, so memory used by a transfer
+# is a small multiple of this, no matter how big the file is.
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+
+# Files bigger than this are uploaded as B2 large files, with parts in parallel.
+DEFAULT_LARGE_FILE_THRESHOLD = 100 * 1024 * 1024
+
+DEFAULT_PART_WORKERS = 4
+
+# Paces downloads from SmugMug, when there is a bandwidth cap.
+_rate_limiter = None
+
+
+def configure_bandwidth(max_bytes_per_second=None):
+    """
+    Caps the bytes per second read from SmugMug by all transfers together.
+    None means no cap.
+    """
+    global _rate_limiter
+    _rate_limiter = RateLimiter(max_bytes_per_second) if max_bytes_per_second else None
+
+
+class TransferOptions:
+    """
+    Settings that control how each transfer is done.
+    """
+    def __init__(
+            self,
+            part_size=DEFAULT_PART_SIZE,
+            large_file_threshold=DEFAULT_LARGE_FILE_THRESHOLD,
+            part_workers=DEFAULT_PART_WORKERS
+    ):
+        assert MIN_PART_SIZE <= part_size, 'part size must be at least %d' % (MIN_PART_SIZE,)
+        assert 1 <= part_workers
+        self.part_size = part_size
+        self.large_file_threshold = large_file_threshold
+        self.part_workers = part_workers
+
+
+class Action:
+    """
+    One thing to do to the bucket.
+
+    smugmug_image is the image for UPLOAD, REUPLOAD and COPY, and is None
+    for HIDE.  source is the file already in the bucket, if there is one:
+    the file being replaced or hidden, or the file to COPY from.
+    """
+    def __init__(self, kind, b2_path, smugmug_image=None, source=None):
+        self.kind = kind
+        self.b2_path = b2_path
+        self.smugmug_image = smugmug_image
+        self.source = source
+
+    def __repr__(self):
+        return self.kind + ' ' + self.b2_path
+
+    def __str__(self):
+        return repr(self)
+
+
+def smugmug_file_infos(a):
+    """
+    Returns the B2 file info to store with a SmugMugImage.
+    """
+    return dict(
+        archived_md5=a.archived_md5,
+        caption=a.caption,
+        date=a.date,
+        file_name=a.file_name,
+        image_key=a.image_key,
+        keywords=a.keywords,
+        last_updated=a.last_updated,
+        title=a.title
+    )
+
+
+def copy_from_smugmug_to_b2(a, bucket, upload_type: str, session=None, options: TransferOptions = None) -> str:
+    """
+    Streams the content from SmugMug into B2, without holding the whole file
+    in memory, and returns the ID of the new B2 file.
+
+    The stream checks the size and MD5 when it reaches the end, so a bad
+    download fails the upload before it is finished.  Files over the large
+    file threshold are uploaded in parts, in parallel.  The threshold is
+    compared with the size of what is streamed, which for a video is the
+    LargestVideo, not the archived original.
+    """
+    options = options or TransferOptions()
+    print('DOWNLOAD', a.b2_path)
+    file_infos = smugmug_file_infos(a)
+    start = time.monotonic()
+    reader = None
+    try:
+        _, content_size, _ = a.content_location(session)
+        with a.open_content(session) as stream:
+            reader = TimedReader(stream if _rate_limiter is None else ThrottledReader(stream, _rate_limiter))
+            print(upload_type, a.b2_path)
+            if options.large_file_threshold < content_size:
+                file_id = upload_large_stream(
+                    bucket,
+                    reader,
+                    a.b2_path,
+                    file_infos,
+                    options.part_size,
+                    options.part_workers
+                )
+            else:
+                file_id = bucket.upload_unbound_stream(
+                    reader,
+                    a.b2_path,
+                    file_info=file_infos,
+                    recommended_upload_part_size=options.part_size,
+                    buffer_size=options.part_size
+                ).id_
+    except BaseException:
+        run_metrics.phase(DOWNLOAD if reader is None or reader.failed else UPLOAD_PHASE).error()
+        raise
+    run_metrics.phase(DOWNLOAD).observe(reader.seconds, reader.byte_count)
+    run_metrics.phase(UPLOAD_PHASE).observe(time.monotonic() - start - reader.seconds, reader.byte_count)
+    return file_id
+
+
+def copy_within_b2(a, source, bucket) -> str:
+    """
+    Makes a new B2 file for a SmugMugImage by copying a file already in the
+    bucket that has the same content, and returns the ID of the new file.
+
+    B2 does the copy on the server, so nothing is downloaded or uploaded.
+    """
+    print(COPY, source.b2_path, '->', a.b2_path)
+    with run_metrics.timed(COPY_PHASE, a.byte_count):
+        return bucket.copy(
+            source.file_id,
+            a.b2_path,
+            content_type='b2/x-auto',
+            file_info=smugmug_file_infos(a)
+        ).id_
+
+
+def transfer_byte_count(action: Action) -> int:
+    """
+    Returns the number of bytes that an action moves from SmugMug to B2:
+    the size of the content, which for a video is the LargestVideo.
+    """
+    if action.kind in (UPLOAD, REUPLOAD):
+        return action.smugmug_image.content_size
+    return 0
+
+
+def perform_action(
+        action: Action,
+        bucket,
+        session=None,
+        options: TransferOptions = None,
+        state=None,
+        content_index=None
+) -> None:
+    a = action.smugmug_image
+    if action.kind == HIDE:
+        print(HIDE, action.b2_path)
+        with run_metrics.timed(HIDE_PHASE):
+            bucket.hide_file(action.b2_path)
+        if state is not None:
+            state.forget(action.b2_path)
+    elif action.kind == COPY:
+        file_id = copy_within_b2(a, action.source, bucket)
+        if state is not None:
+            state.record(a, file_id)
+    else:
+        file_id = copy_from_smugmug_to_b2(a, bucket, action.kind, session, options)
+        if state is not None:
+            state.record(a, file_id)
+        if content_index is not None:
+            content_index.add(a.archived_md5, a.b2_path, file_id)
+
+
+class TransferPool:
+    """
+    Runs actions on a pool of worker threads.
+
+    make_session and make_bucket are called once in each worker thread.  When
+    they are not given, workers use the session the image was fetched with,
+    and the bucket passed in.
+
+    Failures do not stop the pool.  They are collected and returned by close().
+    When there is a state database, it is updated after each successful
+    action, and uploads are added to the content index, if there is one.
+
+    done_count and done_bytes count the actions that worked, and
+    failed_count the ones that didn't.  bytes_saved adds up the sizes of
+    images that were copied inside B2 instead of being transferred.
+
+    With a journal, each action is recorded as started when it is submitted,
+    and as finished when it is done.
+
+    With an AdaptiveLimit as concurrency, there are threads for up to its
+    maximum, but only as many transfers as its current limit run at once,
+    and it hears about throttling from SmugMug and B2.
+
+    With a FailureQueue as failures, failed actions are added to it, and
+    actions that work are taken off it.
+    """
+
+    def __init__(
+            self,
+            bucket,
+            worker_count=1,
+            make_session=None,
+            make_bucket=None,
+            options=None,
+            state=None,
+            content_index=None,
+            journal=None,
+            concurrency=None,
+            failures=None
+    ):
+        if concurrency is not None:
+            worker_count = concurrency.maximum
+        assert 1 <= worker_count
+        self._bucket = bucket
+        self._options = options or TransferOptions()
+        self._state = state
+        self._content_index = content_index
+        self._journal = journal
+        self._concurrency = concurrency
+        self._failures = failures
+        if concurrency is not None:
+            add_throttle_listener(concurrency.throttled)
+        self.bytes_saved = 0
+        self.done_count = 0
+        self.done_bytes = 0
+        self.failed_count = 0
+        self._make_session = make_session
+        self._make_bucket = make_bucket
+        self._local = threading.local()
+        self._errors = []
+        self._lock = threading.Lock()
+        # Limits how far the backup loop can get ahead of the workers, so
+        # that pending actions don't pile up in memory.
+        self._slots = threading.BoundedSemaphore(2 * worker_count)
+        self._executor = ThreadPoolExecutor(
+            max_workers=worker_count,
+            thread_name_prefix='transfer',
+            initializer=self._init_worker
+        )
+
+    def _init_worker(self):
+        self._local.session = self._make_session() if self._make_session is not None else None
+        self._local.bucket = self._make_bucket() if self._make_bucket is not None else self._bucket
+
+    def submit(self, action: Action) -> None:
+        self._slots.acquire()
+        # The size is taken once, so that a video looked up while it is
+        # transferred is counted the same when it is done as when it started.
+        byte_count = transfer_byte_count(action)
+        run_metrics.plan(byte_count)
+        if self._journal is not None:
+            self._journal.started(action)
+        try:
+            future = self._executor.submit(self._run, action, byte_count)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def _run(self, action: Action, byte_count: int) -> None:
+        if self._concurrency is not None:
+            self._concurrency.acquire()
+        start = time.monotonic()
+        try:
+            self._perform(action, byte_count)
+        finally:
+            if self._concurrency is not None:
+                self._concurrency.release(byte_count, time.monotonic() - start)
+
+    def _perform(self, action: Action, byte_count: int) -> None:
+        try:
+            perform_action(
+                action,
+                self._local.bucket,
+                self._local.session,
+                self._options,
+                self._state,
+                self._content_index
+            )
+        except Exception as e:
+            print('FAILED  ', action.b2_path, repr(e))
+            traceback.print_exc()
+            with self._lock:
+                self._errors.append((action, e))
+                self.failed_count += 1
+            run_metrics.fail(byte_count)
+            if self._journal is not None:
+                self._journal.finished(action, False)
+            if self._failures is not None:
+                self._failures.record(action, e)
+        else:
+            with self._lock:
+                self.done_count += 1
+                self.done_bytes += byte_count
+                if action.kind == COPY:
+                    self.bytes_saved += action.smugmug_image.byte_count
+            run_metrics.finish(byte_count)
+            if self._journal is not None:
+                self._journal.finished(action, True)
+            if self._failures is not None:
+                self._failures.succeeded(action.b2_path)
+
+    def close(self):
+        """
+        Waits for all submitted actions to finish, and returns a list of
+        (action, exception) for the ones that failed.
+        """
+        self._shutdown()
+        return list(self._errors)
+
+    def _shutdown(self):
+        self._executor.shutdown(wait=True)
+        if self._concurrency is not None:
+            remove_throttle_listener(self._concurrency.throttled)
+            self._concurrency = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._shutdown()
@@ -0,0 +1,250 @@
+#
+# File: transport
+#
+
+"""
+Sending requests to SmugMug: connection pools, retries, and counting.
+Requests that b2sdk makes to B2 are counted here too.
+
+A backup makes hundreds of thousands of requests over many hours, so some
+of them are going to fail for reasons that have nothing to do with us.
+Requests that fail with a connection error, a rate limit (429), or a
+server error are tried again after a jittered, exponentially growing
+delay.  A Retry-After header from the server takes priority over the
+computed delay.  Each request gives up once it has spent max_total_time
+retrying, so a real outage still stops the run.
+"""
+
+import copy
+import email.utils
+import random
+import threading
+import time
+
+from collections import Counter
+
+# Status codes that mean "try again later".
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class RequestCounter:
+    """
+    Counts requests by endpoint.  Safe to use from many threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def count(self, endpoint):
+        with self._lock:
+            self._counts[endpoint] += 1
+
+    def total(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+retry_counter = RequestCounter()
+
+# Requests made to B2, by API.  b2sdk makes them; concurrency.watch_b2_requests counts them.
+b2_request_counter = RequestCounter()
+
+
+def b2_endpoint_name(url):
+    """
+    Returns the name of the B2 API a URL calls, like 'b2_list_file_names'.
+    Downloads by name have URLs under /file/ instead.
+    """
+    parts = url.split('?')[0].split('/')[3:]
+    for part in parts:
+        if part.startswith('b2_'):
+            return part
+    if parts and parts[0] == 'file':
+        return 'b2_download_file_by_name'
+    return 'other'
+
+# Functions called with (service, status) whenever a service says to slow down.
+_throttle_listeners = []
+_throttle_lock = threading.Lock()
+
+
+def add_throttle_listener(listener):
+    with _throttle_lock:
+        _throttle_listeners.append(listener)
+
+
+def remove_throttle_listener(listener):
+    with _throttle_lock:
+        _throttle_listeners.remove(listener)
+
+
+def report_throttle(service, status):
+    """
+    Tells the listeners that a service answered with a rate limit or server error.
+    """
+    with _throttle_lock:
+        listeners = list(_throttle_listeners)
+    for listener in listeners:
+        listener(service, status)
+
+
+class RetryPolicy:
+    """
+    How long to wait between attempts, and when to give up.
+    """
+
+    def __init__(self, base_delay=1.0, max_delay=60.0, max_total_time=600.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_total_time = max_total_time
+
+    def delay(self, attempt, response=None):
+        """
+        Returns the number of seconds to wait after the given (1-based) failed attempt.
+        """
+        retry_after = _retry_after_seconds(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # "Full jitter": a random time up to the exponential limit, so that
+        # many threads that failed together don't all come back together.
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+_retry_policy = DEFAULT_RETRY_POLICY
+
+# Connections kept open to each host.  Should be at least the number of
+# threads that make requests through one session.
+DEFAULT_POOL_SIZE = 16
+_pool_size = DEFAULT_POOL_SIZE
+
+# Connections kept open to each host by the pools that sessions share.
+# They are used by every thread of every session that shares them, so
+# None, which means the same as _pool_size, is only right for one session.
+_shared_pool_size = None
+
+
+def configure_transport(pool_size=None, retry_policy=None, shared_pool_size=None):
+    global _pool_size, _retry_policy, _shared_pool_size
+    if pool_size is not None:
+        assert 1 <= pool_size
+        _pool_size = pool_size
+    if retry_policy is not None:
+        _retry_policy = retry_policy
+    if shared_pool_size is not None:
+        assert 1 <= shared_pool_size
+        _shared_pool_size = shared_pool_size
+
+
+def retry_policy():
+    """
+    Returns the RetryPolicy set by configure_transport.
+    """
+    return _retry_policy
+
+
+def _retry_after_seconds(response):
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+# One adapter for every session that shares pools.
+_shared_adapter = None
+_shared_adapter_lock = threading.Lock()
+
+
+def _make_adapter(pool_size):
+    from requests.adapters import HTTPAdapter
+    return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+
+
+def mount_pools(session, shared=False):
+    """
+    Gives a session connection pools big enough for the threads that use it.
+
+    With shared, the session uses the same pools as every other shared
+    session, so that sessions for different accounts on the same host
+    reuse each other's connections.  The pools are safe to share between
+    threads; the sessions are not.
+
+    Retries are done by send_with_retry, not by the adapter.
+    """
+    global _shared_adapter
+    if shared:
+        with _shared_adapter_lock:
+            if _shared_adapter is None:
+                _shared_adapter = _make_adapter(_shared_pool_size or _pool_size)
+            adapter = _shared_adapter
+    else:
+        adapter = _make_adapter(_pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def session_for_thread(session):
+    """
+    Returns a copy of a session for another thread to use.  The copy has
+    its own auth, cookies and headers, and the same connection pools,
+    which are safe to share.  Anything that isn't a requests session is
+    just copied.
+    """
+    thread_session = copy.copy(session)
+    if hasattr(session, 'adapters'):
+        thread_session.auth = copy.deepcopy(session.auth)
+        thread_session.cookies = session.cookies.copy()
+        thread_session.headers = session.headers.copy()
+        thread_session.adapters = session.adapters.copy()
+    return thread_session
+
+
+def send_with_retry(session, url, endpoint, sleep=time.sleep, **kwargs):
+    """
+    Does session.get(url, **kwargs), retrying failures that might go away.
+
+    Returns the last response, which may be an error response if retrying
+    didn't help.  Connection errors are raised once time runs out.  The
+    sleep function can be replaced for testing.
+    """
+    import requests  # not needed until there is a session, so not imported at startup
+    policy = _retry_policy
+    deadline = time.monotonic() + policy.max_total_time
+    attempt = 1
+    while True:
+        response = None
+        error = None
+        try:
+            response = session.get(url, **kwargs)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            report_throttle('smugmug', response.status_code)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        delay = policy.delay(attempt, response)
+        if deadline < time.monotonic() + delay:
+            if error is not None:
+                raise error
+            return response
+        if response is not None:
+            response.close()
+        retry_counter.count(endpoint)
+        print('RETRY   ', endpoint, response.status_code if response is not None else repr(error))
+        sleep(delay)
+        attempt += 1
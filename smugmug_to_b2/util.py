@@ -92,3 +92,10 @@ def ordered_zip(
             else:
                 yield None, b.current
                 b.advance()
+
+
+def all_before(prefix: str, name: str) -> bool:
+    """
+    Returns True if every name that starts with prefix sorts before the given name.
+    """
+    return prefix != '' and prefix < name and not name.startswith(prefix)
@@ -0,0 +1,130 @@
+import asyncio
+import json
+
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+
+from benchmarks.fake_smugmug import FakeSmugMug, FakeTree, content_chunks
+from smugmug_to_b2 import smugmug
+from smugmug_to_b2.async_smugmug import AsyncCrawler, AsyncResponse, AsyncSession, AsyncSmugMug
+from smugmug_to_b2.backup import all_smugmug_images
+from smugmug_to_b2.exception import AppError
+
+
+class FakeAsyncSession:
+    """
+    Answers requests straight from a FakeSmugMug, without a server.
+    """
+    connection_errors = ()
+
+    def __init__(self, fake, busy_count=0):
+        self.fake = fake
+        self.busy_count = busy_count
+        self.urls = []
+
+    async def get(self, url, headers=None):
+        self.urls.append(url)
+        if self.busy_count:
+            self.busy_count -= 1
+            return AsyncResponse(503, {'Retry-After': '0'}, b'busy')
+        parts = urlsplit(url)
+        if parts.path.startswith('/download/'):
+            image = self.fake.tree.images[parts.path[len('/download/'):]]
+            return AsyncResponse(200, {}, b''.join(content_chunks(image.key, image.size)))
+        body = self.fake.respond(parts.path, dict(parse_qsl(parts.query)))
+        return AsyncResponse(200 if body is not None else 404, {}, json.dumps(body).encode('utf-8'))
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def fake():
+    tree = FakeTree(folders=2, albums=2, images=3, image_size=100, video_every=2, video_size=200)
+    with FakeSmugMug(tree) as fake:
+        yield fake
+
+
+def test_awaitable_children_images_and_content(fake):
+    async def run():
+        client = AsyncSmugMug(FakeAsyncSession(fake))
+        node = await client.node(await client.auth_user())
+        [folder, _] = await client.children(node)
+        [album_node, _] = await client.children(folder)
+        images = await client.images(await client.album(album_node))
+        return [(image.file_name, len(await client.content(image))) for image in images]
+
+    assert [('IMG_0000.jpg', 100), ('IMG_0001.mp4', 200), ('IMG_0002.jpg', 100)] == asyncio.run(run())
+
+
+def test_busy_responses_are_retried(fake):
+    session = FakeAsyncSession(fake, busy_count=2)
+
+    async def run():
+        async def no_sleep(seconds):
+            pass
+        client = AsyncSmugMug(session, sleep=no_sleep)
+        return await client.auth_user()
+
+    assert 'bench' == asyncio.run(run()).data['Name']
+    assert 3 == len(session.urls)
+
+
+def test_crawler_facade_walks_the_tree(fake):
+    with AsyncCrawler(make_session=lambda: FakeAsyncSession(fake)) as crawler:
+        node = crawler.run(crawler.client.node(crawler.run(crawler.client.auth_user())))
+        paths = [image.b2_path for image in all_smugmug_images(node, '', crawler=crawler)]
+    assert fake.tree.image_count == len(paths)
+    assert sorted(paths) == paths
+
+
+def test_album_images_come_a_page_at_a_time(fake, monkeypatch):
+    monkeypatch.setattr(smugmug, '_page_size', 1)
+    monkeypatch.setattr(smugmug, '_page_workers', 1)
+    session = FakeAsyncSession(fake)
+
+    async def run():
+        client = AsyncSmugMug(session)
+        node = await client.node(await client.auth_user())
+        [folder, _] = await client.children(node)
+        [album_node, _] = await client.children(folder)
+        album = await client.album(album_node)
+        requests_before = len(session.urls)
+        requests_seen = []
+        async for image in client.iter_images(album):
+            requests_seen.append(len(session.urls) - requests_before)
+        records = await client.node_contents(album_node)
+        return requests_seen, [record.file_name for record in records]
+
+    requests_seen, file_names = asyncio.run(run())
+    # Each page is asked for when the images before it have been used.
+    assert [1, 2, 3] == requests_seen
+    assert ['IMG_0000.jpg', 'IMG_0001.mp4', 'IMG_0002.jpg'] == file_names
+
+
+def test_crawler_bounds_contents_fetched_ahead(fake):
+    session = FakeAsyncSession(fake)
+    with AsyncCrawler(distance=1, make_session=lambda: session) as crawler:
+        node = crawler.run(crawler.client.node(crawler.run(crawler.client.auth_user())))
+        [folder, _] = crawler.submit(node).result()
+        albums = crawler.run(crawler.client.children(folder))
+        requests_before = len(session.urls)
+        futures = [crawler.submit(album) for album in albums]
+        first_contents = futures[0].result()
+        # The second album wasn't fetched until it was asked for.
+        assert 1 == len(session.urls) - requests_before
+        assert 3 == len(futures[1].result())
+        assert 3 == len(first_contents)
+        paths = [image.b2_path for image in all_smugmug_images(node, '', crawler=crawler)]
+    assert fake.tree.image_count == len(paths)
+
+
+def test_session_needs_aiohttp():
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        with pytest.raises(AppError):
+            AsyncSession()
+    else:
+        pytest.skip('aiohttp is installed')
@@ -0,0 +1,98 @@
+from benchmarks.memory_bucket import simulator_bucket
+from smugmug_to_b2.audit import CORRUPT, FAILED, MISMATCH, MISSING, ORPHAN, audit
+from smugmug_to_b2.backup import all_b2_images, backup
+from smugmug_to_b2.dedupe import DEDUPE_COPY
+from smugmug_to_b2.transfer import smugmug_file_infos
+
+from test_backup import FakeNode, make_tree
+from test_plan import image_with_content
+
+
+def backed_up(*images):
+    bucket = simulator_bucket()
+    backup(make_tree(*images), bucket, '')
+    return bucket
+
+
+def test_audit_of_a_good_backup():
+    images = [image_with_content('a.jpg', b'aaa'), image_with_content('b.jpg', b'bbbb')]
+    bucket = backed_up(*images)
+    report = audit(make_tree(*images), bucket, '', sample=1.0, sample_workers=2)
+    assert [] == report.problems
+    assert (2, 2, 7) == (report.checked_count, report.sampled_count, report.sampled_bytes)
+
+
+def test_audit_of_a_copy_after_the_original_is_deleted():
+    one = image_with_content('1.jpg', b'one')
+    bucket = simulator_bucket()
+    backup(FakeNode('', children=[FakeNode('a', images=[one])]), bucket, '')
+    both = FakeNode('', children=[FakeNode('a', images=[one]), FakeNode('b', images=[one])])
+    backup(both, bucket, '', dedupe=DEDUPE_COPY)
+    only_b = FakeNode('', children=[FakeNode('b', images=[one])])
+    backup(only_b, bucket, '', dedupe=DEDUPE_COPY)
+    # The simulator can't download copies by ID, so only sizes and checksums are compared.
+    report = audit(only_b, bucket, '')
+    assert [] == report.problems
+    assert 1 == report.checked_count
+
+
+def test_audit_of_a_sample_that_cant_be_downloaded():
+    images = [image_with_content('a.jpg', b'aaa')]
+    bucket = backed_up(*images)
+
+    def download_file_by_id(file_id, destination):
+        raise IOError('B2 is down')
+
+    bucket.download_file_by_id = download_file_by_id
+    report = audit(make_tree(*images), bucket, '', sample=1.0)
+    [(kind, _, reason)] = report.problems
+    # The content may be fine; it just couldn't be checked.
+    assert FAILED == kind
+    assert 'B2 is down' in reason
+    assert 0 == report.sampled_count
+
+
+def test_audit_finds_problems():
+    b, c = image_with_content('b.jpg', b'bbbb'), image_with_content('c.jpg', b'c')
+    bucket = backed_up(image_with_content('a.jpg', b'aaa'), b, c)
+    [b_path] = [image.b2_path for image in all_b2_images(bucket, '') if image.file_name == 'b.jpg']
+    # Same size, different bytes.
+    bucket.upload_bytes(b'bbbx', b_path, file_info=smugmug_file_infos(b))
+    bucket.upload_bytes(b'old', 'album/old.jpg', file_info={})
+    # SmugMug has a new original for a, and a new image d.
+    changed_a = image_with_content('a.jpg', b'AAA')
+    d = image_with_content('d.jpg', b'dd')
+
+    report = audit(make_tree(changed_a, b, c, d), bucket, '', sample=1.0)
+    found = sorted((kind, path.split('.')[0]) for (kind, path, _) in report.problems)
+    assert [(CORRUPT, 'album/b'), (MISMATCH, 'album/a'), (MISSING, 'album/d'), (ORPHAN, 'album/old')] == found
+    assert 1 == report.count(MISMATCH)
+    assert (3, 2) == (report.checked_count, report.sampled_count)
+
+
+def test_audit_without_sampling_reads_nothing():
+    images = [image_with_content('a.jpg', b'aaa')]
+    bucket = backed_up(*images)
+    report = audit(make_tree(*images), bucket, '', choose=lambda: 0.5, sample=0.25)
+    assert ([], 0) == (report.problems, report.sampled_count)
+
+
+def test_audit_of_a_video_that_has_to_be_looked_up():
+    video = image_with_content('v.mp4', b'vvv')
+    bucket = backed_up(video)
+    lookups = []
+
+    def content_location():
+        lookups.append(video.file_name)
+        raise IOError('SmugMug is down')
+
+    # The LargestVideo wasn't in the listing.
+    video.content_size = None
+    video.content_location = content_location
+    report = audit(make_tree(video), bucket, '')
+    assert ([], []) == (report.problems, lookups)
+
+    report = audit(make_tree(video), bucket, '', sample=1.0)
+    [(kind, _, reason)] = report.problems
+    assert FAILED == kind
+    assert 'SmugMug is down' in reason
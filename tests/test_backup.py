@@ -0,0 +1,183 @@
+import io
+import pytest
+
+from smugmug_to_b2.backup import all_smugmug_images, backup
+from smugmug_to_b2.crawl import Crawler
+from smugmug_to_b2.dedupe import DEDUPE_COPY
+from smugmug_to_b2.exception import TransferError
+
+
+class FakeImage:
+    def __init__(self, file_name, content=b'abc', caption='', keywords='', title=''):
+        self.archived_md5 = 'md5-' + file_name
+        self.archived_uri = 'https://example.com/' + file_name
+        self.byte_count = len(content) if isinstance(content, bytes) else 0
+        self.content_size = self.byte_count
+        self.caption = caption
+        self.date = '2020-01-01'
+        self.file_name = file_name
+        self.keywords = keywords
+        self.title = title
+        self.image_key = 'key-' + file_name
+        self.last_updated = '2020-01-02'
+        self._content = content
+
+    def open_content(self):
+        if isinstance(self._content, Exception):
+            raise self._content
+        return io.BytesIO(self._content)
+
+    def with_session(self, session):
+        return self
+
+    def content_location(self):
+        return self.archived_uri, self.byte_count, self.archived_md5
+
+
+class FakeAlbum:
+    def __init__(self, images, last_updated='2020-01-01'):
+        self.images = images
+        self.last_updated = last_updated
+        self.images_last_updated = last_updated
+
+    def image_records(self):
+        return list(self.images)
+
+
+class FakeNode:
+    def __init__(self, name, children=None, images=None, last_updated='2020-01-01'):
+        self.name = name
+        self.has_children = children is not None
+        self.has_album = images is not None
+        self.children = children
+        self.album = FakeAlbum(images, last_updated)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeFileVersionInfo:
+    def __init__(self, file_name, file_info, size=0):
+        self.id_ = 'id-' + file_name
+        self.file_name = file_name
+        self.file_info = file_info
+        self.size = size
+
+
+class FakeBucket:
+    def __init__(self):
+        self.files = {}
+        self.hidden = []
+        self.copies = []
+        self.ls_count = 0
+        self.contents_by_id = {}
+
+    def ls(self, prefix, recursive=False, fetch_count=None):
+        self.ls_count += 1
+        for name in sorted(self.files):
+            if name.startswith(prefix):
+                yield FakeFileVersionInfo(name, self.files[name][1], len(self.files[name][0])), None
+
+    def upload_unbound_stream(self, stream, file_name, file_info, **kwargs):
+        return self._add(file_name, stream.read(), file_info)
+
+    def upload_bytes(self, data_bytes, file_name, content_type=None, file_info=None):
+        return self._add(file_name, data_bytes, file_info)
+
+    def copy(self, file_id, new_file_name, content_type, file_info):
+        self.copies.append((file_id, new_file_name))
+        return self._add(new_file_name, self.contents_by_id[file_id], file_info)
+
+    def _add(self, file_name, data, file_info):
+        self.files[file_name] = (data, file_info)
+        file_version = FakeFileVersionInfo(file_name, file_info)
+        self.contents_by_id[file_version.id_] = data
+        return file_version
+
+    def hide_file(self, file_name):
+        self.hidden.append(file_name)
+        del self.files[file_name]
+
+
+def make_tree(*images):
+    return FakeNode('', children=[FakeNode('album', images=list(images))])
+
+
+def test_backup_uploads_and_hides():
+    bucket = FakeBucket()
+    backup(make_tree(FakeImage('a.jpg'), FakeImage('b.jpg')), bucket, '', workers=3)
+    assert 2 == len(bucket.files)
+    old_names = sorted(bucket.files)
+
+    backup(make_tree(FakeImage('a.jpg', caption='new')), bucket, '', workers=3)
+    assert 1 == len(bucket.files)
+    assert sorted(bucket.hidden) == old_names
+
+
+def test_backup_copies_when_only_metadata_changes():
+    bucket = FakeBucket()
+    backup(make_tree(FakeImage('a.jpg', content=b'a'), FakeImage('b.jpg', content=b'b')), bucket, '')
+    [old_a, old_b] = sorted(bucket.files)
+
+    new_tree = make_tree(
+        FakeImage('a.jpg', content=IOError('no download'), caption='new'),
+        FakeImage('b.jpg', content=b'b')
+    )
+    backup(new_tree, bucket, '')
+    [(copied_id, new_a)] = bucket.copies
+    assert 'id-' + old_a == copied_id
+    assert [old_a] == bucket.hidden
+    assert b'a' == bucket.files[new_a][0]
+    assert 'new' == bucket.files[new_a][1]['caption']
+
+
+def test_backup_collects_errors():
+    bucket = FakeBucket()
+    tree = make_tree(FakeImage('a.jpg', content=IOError('boom')), FakeImage('b.jpg'))
+    with pytest.raises(TransferError):
+        backup(tree, bucket, '', workers=2)
+    assert [name.split('.')[0] for name in bucket.files] == ['album/b']
+
+
+def test_all_smugmug_images_with_prefetch_keeps_order():
+    tree = FakeNode('', children=[
+        FakeNode('b', children=[FakeNode('y', images=[FakeImage('2.jpg'), FakeImage('1.jpg')])]),
+        FakeNode('a', images=[FakeImage('z.jpg')]),
+        FakeNode('a b', images=[FakeImage('q.jpg')]),
+        FakeNode('c', children=[]),
+    ])
+    expected = [i.b2_path for i in all_smugmug_images(tree, '')]
+    assert sorted(expected) == expected
+    assert 4 == len(expected)
+    with Crawler(workers=3, distance=2) as crawler:
+        assert expected == [i.b2_path for i in all_smugmug_images(tree, '', crawler=crawler)]
+    assert [p for p in expected if p.startswith('a/')] == [i.b2_path for i in all_smugmug_images(tree, 'a/')]
+
+
+def make_tree_with_duplicate(content_of_copy):
+    return FakeNode('', children=[
+        FakeNode('a', images=[FakeImage('1.jpg', content=b'one')]),
+        FakeNode('b', images=[FakeImage('1.jpg', content=content_of_copy)]),
+    ])
+
+
+def test_backup_dedupe_copy():
+    bucket = FakeBucket()
+    backup(FakeNode('', children=[FakeNode('a', images=[FakeImage('1.jpg', content=b'one')])]), bucket, '')
+    backup(make_tree_with_duplicate(IOError('no download')), bucket, '', dedupe=DEDUPE_COPY)
+    [(_, new_path)] = bucket.copies
+    assert new_path.startswith('b/')
+    assert b'one' == bucket.files[new_path][0]
+
+
+def test_backup_dedupe_copy_survives_deleting_the_original():
+    bucket = FakeBucket()
+    backup(FakeNode('', children=[FakeNode('a', images=[FakeImage('1.jpg', content=b'one')])]), bucket, '')
+    backup(make_tree_with_duplicate(IOError('no download')), bucket, '', dedupe=DEDUPE_COPY)
+    [(_, copy_path)] = bucket.copies
+    # The original is deleted from SmugMug, and its file is hidden.
+    only_copy = FakeNode('', children=[FakeNode('b', images=[FakeImage('1.jpg', content=IOError('no download'))])])
+    backup(only_copy, bucket, '', dedupe=DEDUPE_COPY)
+    assert [p for p in bucket.hidden if p.startswith('a/')]
+    assert [copy_path] == list(bucket.files)
+    assert b'one' == bucket.files[copy_path][0]
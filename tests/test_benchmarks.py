@@ -0,0 +1,16 @@
+from benchmarks.run import make_parser, run_benchmarks
+
+
+def test_benchmarks_run_against_fake_smugmug():
+    args = make_parser().parse_args([
+        '--folders', '2', '--albums', '2', '--images', '3', '--video-every', '2',
+        '--image-size', '4', '--video-size', '8', '--zip-items', '100', '--no-memory'
+    ])
+    [crawl, zip_result, backup_result] = run_benchmarks(args)
+    assert 12 == crawl.items
+    assert 100 == zip_result.items
+    assert 12 == backup_result.items
+    assert 12 == backup_result.requests['download']
+    # Albums and videos come expanded in the listings, so they aren't fetched one at a time.
+    assert 'album' not in crawl.requests
+    assert 'image!largestvideo' not in backup_result.requests
@@ -0,0 +1,121 @@
+from types import SimpleNamespace
+
+from smugmug_to_b2.backup import backup
+from smugmug_to_b2.concurrency import AdaptiveLimit, RateLimiter, watch_b2_requests
+from smugmug_to_b2.metrics import run_metrics
+from smugmug_to_b2.transport import (
+    add_throttle_listener,
+    b2_endpoint_name,
+    b2_request_counter,
+    remove_throttle_listener,
+    report_throttle,
+)
+
+from test_backup import FakeBucket, FakeImage, make_tree
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_adds_a_transfer_when_transfers_waited():
+    clock = FakeClock()
+    limit = AdaptiveLimit(2, maximum=4, interval=10, clock=clock)
+    limit.acquire()
+    limit.acquire()
+    limit._waited = True  # a third transfer would have had to wait
+    clock.now = 10
+    limit.release(1000, 1.0)
+    assert 3 == limit.limit
+    # Nobody waited in the next interval, so it stays put.
+    clock.now = 20
+    limit.release(1000, 1.0)
+    assert 3 == limit.limit
+
+
+def test_halves_on_throttle_at_most_once_per_interval():
+    clock = FakeClock()
+    limit = AdaptiveLimit(8, maximum=16, interval=10, clock=clock)
+    limit.throttled('smugmug', 429)
+    assert 4 == limit.limit
+    clock.now = 5
+    limit.throttled('b2', 503)
+    assert 4 == limit.limit
+    clock.now = 15
+    limit.throttled('b2', 503)
+    assert 2 == limit.limit
+    for _ in range(5):
+        clock.now += 10
+        limit.throttled('b2', 503)
+    assert 1 == limit.limit
+
+
+def test_rate_limiter_paces_reads():
+    clock = FakeClock()
+    limiter = RateLimiter(1000, clock=clock, sleep=clock.sleep)
+    for _ in range(5):
+        limiter.consume(500)
+    # The first read goes right away; the rest wait their turn.
+    assert 2.0 == clock.now
+
+
+def test_backup_hears_about_throttling():
+    limit = AdaptiveLimit(2, maximum=4)
+    tree = make_tree(FakeImage('a.jpg'), FakeImage('b.jpg'))
+
+    class ThrottledBucket(FakeBucket):
+        def upload_unbound_stream(self, *args, **kwargs):
+            report_throttle('b2', 503)
+            return super().upload_unbound_stream(*args, **kwargs)
+
+    bucket = ThrottledBucket()
+    backup(tree, bucket, '', concurrency=limit)
+    assert 1 == limit.limit
+    assert 2 == len(bucket.files)
+
+
+def test_b2_requests_are_counted_by_api():
+    assert 'b2_upload_part' == b2_endpoint_name('https://pod-000.backblaze.com/b2api/v2/b2_upload_part/id/token')
+    assert 'b2_download_file_by_name' == b2_endpoint_name('https://f001.backblazeb2.com/file/bucket/a/b.jpg')
+
+    callbacks = []
+    b2_api = SimpleNamespace(session=SimpleNamespace(raw_api=SimpleNamespace(
+        b2_http=SimpleNamespace(add_callback=callbacks.append)
+    )))
+    watch_b2_requests(b2_api)
+    [callback] = callbacks
+    throttles = []
+
+    def listener(service, status):
+        throttles.append((service, status))
+
+    add_throttle_listener(listener)
+    run_metrics.reset()
+    before = b2_request_counter.as_dict()
+
+    def call(api, status):
+        url = 'https://api001.backblazeb2.com/b2api/v2/' + api
+        callback.pre_request('POST', url, {})
+        callback.post_request('POST', url, {}, SimpleNamespace(status_code=status))
+
+    try:
+        for status in [200, 503, 200]:
+            call('b2_list_file_names', status)
+        call('b2_hide_file', 200)
+    finally:
+        remove_throttle_listener(listener)
+
+    counts = b2_request_counter.as_dict()
+    assert 3 == counts['b2_list_file_names'] - before.get('b2_list_file_names', 0)
+    assert 1 == counts['b2_hide_file'] - before.get('b2_hide_file', 0)
+    # Only listing calls are timed as the b2_list phase, one operation each.
+    stats = run_metrics.summary()['phases']['b2_list']
+    assert (2, 1) == (stats['count'], stats['errors'])
+    assert ('b2', 503) in throttles
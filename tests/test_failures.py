@@ -0,0 +1,123 @@
+import argparse
+
+import pytest
+
+from smugmug_to_b2.backup import SmugMugImage, backup
+from smugmug_to_b2.command_line import backup_all_command, distributed_backup_command
+from smugmug_to_b2.exception import AppError, NotFoundError, TransferError
+from smugmug_to_b2.failures import FailureQueue, retry_failed
+from smugmug_to_b2.transfer import REUPLOAD, UPLOAD, Action
+
+from test_backup import FakeBucket, FakeImage, make_tree
+
+
+def test_failures_are_queued_and_counted(tmp_path):
+    bucket = FakeBucket()
+    tree = make_tree(FakeImage('a.jpg', content=IOError('boom')), FakeImage('b.jpg'))
+    with FailureQueue(tmp_path / 'failures.sqlite') as failures:
+        for attempt in [1, 2]:
+            with pytest.raises(TransferError):
+                backup(tree, bucket, '', failures=failures)
+            [item] = failures.items()
+            assert ('key-a.jpg', 'album/', attempt) == (item.image_key, item.album, item.attempts)
+            assert 'boom' in item.reason
+    # The queue is kept on disk.
+    with FailureQueue(tmp_path / 'failures.sqlite') as failures:
+        assert 1 == len(failures)
+
+
+def test_retry_failed_looks_up_by_key(tmp_path):
+    bucket = FakeBucket()
+    with FailureQueue(tmp_path / 'failures.sqlite') as failures:
+        with pytest.raises(TransferError):
+            backup(make_tree(FakeImage('a.jpg', content=IOError('boom'))), bucket, '', failures=failures)
+        looked_up = []
+
+        def get_record(image_key):
+            looked_up.append(image_key)
+            return FakeImage('a.jpg')
+
+        assert (1, 3) == retry_failed(failures, bucket, get_record)
+        assert ['key-a.jpg'] == looked_up
+        assert 0 == len(failures)
+        assert ['album/a'] == [name.split('.')[0] for name in bucket.files]
+
+
+def test_retry_failed_keeps_what_still_fails(tmp_path):
+    bucket = FakeBucket()
+    with FailureQueue(tmp_path / 'failures.sqlite') as failures:
+        with pytest.raises(TransferError):
+            backup(make_tree(FakeImage('a.jpg', content=IOError('boom'))), bucket, '', failures=failures)
+
+        def get_record(image_key):
+            raise IOError('not found')
+
+        with pytest.raises(TransferError):
+            retry_failed(failures, bucket, get_record)
+        [item] = failures.items()
+        assert 2 == item.attempts
+        assert 'not found' in item.reason
+
+
+def test_retry_of_a_changed_image_hides_the_file_it_replaced(tmp_path):
+    bucket = FakeBucket()
+    old = SmugMugImage('album/', FakeImage('a.jpg'))
+    bucket.files[old.b2_path] = (b'old', {})
+    with FailureQueue(tmp_path / 'failures.sqlite') as failures:
+        failures.record(Action(REUPLOAD, old.b2_path, old), IOError('boom'))
+        # The caption changed since, so the image has a new path.
+        assert (2, 3) == retry_failed(failures, bucket, lambda image_key: FakeImage('a.jpg', caption='new'))
+        assert 0 == len(failures)
+    assert [old.b2_path] == bucket.hidden
+    assert ['new'] == [info['caption'] for (_, info) in bucket.files.values()]
+
+
+def test_retry_that_cant_look_up_an_image_keeps_its_kind(tmp_path):
+    bucket = FakeBucket()
+    old = SmugMugImage('album/', FakeImage('a.jpg'))
+    bucket.files[old.b2_path] = (b'old', {})
+    with FailureQueue(tmp_path / 'failures.sqlite') as failures:
+        failures.record(Action(REUPLOAD, old.b2_path, old), IOError('boom'))
+
+        def get_record(image_key):
+            raise IOError('timed out')
+
+        with pytest.raises(TransferError):
+            retry_failed(failures, bucket, get_record)
+        [item] = failures.items()
+        assert ('REUPLOAD', 'key-a.jpg', 2) == (item.kind, item.image_key, item.attempts)
+        # So when it is looked up after a move, the old file is still hidden.
+        retry_failed(failures, bucket, lambda image_key: FakeImage('a.jpg', caption='new'))
+    assert [old.b2_path] == bucket.hidden
+
+
+def test_retry_of_a_deleted_image_drops_it(tmp_path):
+    bucket = FakeBucket()
+    old = SmugMugImage('album/', FakeImage('a.jpg'))
+    new = SmugMugImage('album/', FakeImage('b.jpg'))
+    bucket.files[old.b2_path] = (b'old', {})
+
+    def get_record(image_key):
+        raise NotFoundError('status 404')
+
+    with FailureQueue(tmp_path / 'failures.sqlite') as failures:
+        failures.record(Action(REUPLOAD, old.b2_path, old), IOError('boom'))
+        failures.record(Action(UPLOAD, new.b2_path, new), IOError('boom'))
+        assert (1, 0) == retry_failed(failures, bucket, get_record)
+        assert 0 == len(failures)
+    # The file that was being replaced is hidden; the one that never got uploaded has nothing to hide.
+    assert [old.b2_path] == bucket.hidden
+
+
+def test_failure_queue_options_that_dont_apply():
+    args = argparse.Namespace(
+        prefix='', state=None, resume=False, skip_unchanged_albums=False, failures=None, retry_failed=True
+    )
+    # Each host keeps its own queue, so a retry is run on each one.
+    with pytest.raises(AppError):
+        distributed_backup_command({}, args)
+    # Each job has its own queue.
+    job = {'name': 'a', 'b2': {'key': 'k', 'secret': 's', 'bucket': 'b'}}
+    args.failures = 'failures.sqlite'
+    with pytest.raises(AppError):
+        backup_all_command({'smugmug': {'key': 'k', 'secret': 's'}, 'jobs': [job]}, args)
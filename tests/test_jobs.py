@@ -0,0 +1,68 @@
+import pytest
+import requests
+
+from pathlib import Path
+
+from smugmug_to_b2.backup import backup
+from smugmug_to_b2.concurrency import AdaptiveLimit
+from smugmug_to_b2.exception import ConfigReadError, TransferError
+from smugmug_to_b2.jobs import read_jobs, run_jobs
+from smugmug_to_b2.transport import mount_pools
+
+from test_backup import FakeBucket, FakeImage, make_tree
+
+CONFIG = {
+    'smugmug': {'key': 'app-key', 'secret': 'app-secret'},
+    'jobs': [
+        {'name': 'alice', 'b2': {'key': 'k1', 'secret': 's1', 'bucket': 'alice'}, 'state': '/tmp/alice.sqlite'},
+        {
+            'name': 'bob',
+            'smugmug': {'key': 'bob-key', 'secret': 'bob-secret', 'token_file': '/tmp/bob-token'},
+            'b2': {'key': 'k2', 'secret': 's2', 'bucket': 'bob'},
+            'prefix': 'photos/'
+        },
+    ]
+}
+
+
+def test_read_jobs():
+    [alice, bob] = read_jobs(CONFIG)
+    assert ('alice', 'app-key', '') == (alice.name, alice.smugmug['key'], alice.prefix)
+    assert Path('/tmp/alice.sqlite') == alice.state
+    assert alice.token_path.name.endswith('-alice')
+    assert alice.journal.name.endswith('-alice')
+    assert '.smugmug-to-b2-failures-alice.sqlite' == alice.failures.name
+    assert ('bob-key', 'photos/', None) == (bob.smugmug['key'], bob.prefix, bob.state)
+    assert Path('/tmp/bob-token') == bob.token_path
+    assert [] == read_jobs({'smugmug': {}})
+
+
+def test_read_jobs_needs_unique_names():
+    with pytest.raises(ConfigReadError):
+        read_jobs({'smugmug': CONFIG['smugmug'], 'jobs': [CONFIG['jobs'][0], CONFIG['jobs'][0]]})
+
+
+def test_jobs_share_one_limit_and_fail_separately():
+    limit = AdaptiveLimit(2)
+    buckets = {'alice': FakeBucket(), 'bob': FakeBucket()}
+    trees = {
+        'alice': make_tree(FakeImage('a.jpg'), FakeImage('b.jpg')),
+        'bob': make_tree(FakeImage('c.jpg', content=ValueError('broken'))),
+    }
+
+    def run(job):
+        return backup(trees[job.name], buckets[job.name], '', concurrency=limit)
+
+    [alice, bob] = run_jobs(read_jobs(CONFIG), run, parallel=2)
+    assert (True, 2, 6) == (alice.ok, alice.action_count, alice.byte_count)
+    assert 2 == len(buckets['alice'].files)
+    assert not bob.ok
+    assert str(TransferError(1)) == bob.error
+
+
+def test_shared_pools():
+    a = mount_pools(requests.Session(), shared=True)
+    b = mount_pools(requests.Session(), shared=True)
+    c = mount_pools(requests.Session())
+    assert a.get_adapter('https://api.smugmug.com') is b.get_adapter('https://api.smugmug.com')
+    assert a.get_adapter('https://api.smugmug.com') is not c.get_adapter('https://api.smugmug.com')
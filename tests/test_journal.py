@@ -0,0 +1,104 @@
+import pytest
+
+from smugmug_to_b2 import journal as journal_module
+from smugmug_to_b2.backup import backup
+from smugmug_to_b2.exception import JournalInUseError, TransferError
+from smugmug_to_b2.journal import Journal, default_journal_path, read_journal
+from smugmug_to_b2.transfer import UPLOAD, Action
+
+from test_backup import FakeBucket, FakeImage, FakeNode
+
+
+def test_checkpoint_waits_for_earlier_actions(tmp_path):
+    path = tmp_path / 'journal'
+    journal = Journal(path, '')
+    first = Action(UPLOAD, 'a/1')
+    second = Action(UPLOAD, 'a/2')
+    journal.started(first)
+    journal.started(second)
+    journal.reached('a/3')
+    journal.finished(second, True)
+    journal.close()
+    resume_point = read_journal(path, '')
+    assert resume_point.checkpoint is None
+    assert resume_point.is_done(second)
+    assert not resume_point.is_done(first)
+
+    journal = Journal(path, '', resume_point)
+    journal.started(first)
+    journal.finished(first, True)
+    journal.reached('a/3')
+    journal.close()
+    assert 'a/3' == read_journal(path, '').checkpoint
+
+
+def test_actions_done_past_a_checkpoint_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal_module, 'CHECKPOINT_SECONDS', 0)
+    path = tmp_path / 'journal'
+    journal = Journal(path, '')
+    first, second, third = [Action(UPLOAD, 'a/%d' % (i,)) for i in [1, 2, 3]]
+    for action in [first, second, third]:
+        journal.started(action)
+    journal.finished(third, True)
+    # This writes a checkpoint at a/1, after the record that a/3 is done.
+    journal.finished(first, True)
+    journal.close()
+    resume_point = read_journal(path, '')
+    assert 'a/1' == resume_point.checkpoint
+    assert resume_point.is_done(third)
+    assert not resume_point.is_done(second)
+    assert {(UPLOAD, 'a/3')} == resume_point.done
+
+
+def test_failed_action_holds_back_checkpoint(tmp_path):
+    path = tmp_path / 'journal'
+    journal = Journal(path, '')
+    journal.reached('a/0')
+    failed = Action(UPLOAD, 'a/1')
+    journal.started(failed)
+    journal.finished(failed, False)
+    journal.reached('a/2')
+    journal.close()
+    assert 'a/0' == read_journal(path, '').checkpoint
+    assert read_journal(path, 'other/').checkpoint is None
+
+
+def test_resumed_backup_skips_finished_folders(tmp_path):
+    path = tmp_path / 'journal'
+    bucket = FakeBucket()
+    tree = FakeNode('', children=[
+        FakeNode('a', images=[FakeImage('1.jpg')]),
+        FakeNode('b', images=[FakeImage('1.jpg')]),
+        FakeNode('c', images=[FakeImage('1.jpg', content=IOError('boom'))]),
+    ])
+    with pytest.raises(TransferError):
+        backup(tree, bucket, '', journal_path=path)
+    assert read_journal(path, '').checkpoint.startswith('b/')
+    finished = sorted(bucket.files)
+
+    # Changes in folders that were finished aren't noticed by a resumed backup.
+    tree = FakeNode('', children=[
+        FakeNode('a', images=[FakeImage('2.jpg', content=IOError('listed a'))]),
+        FakeNode('b', images=[FakeImage('1.jpg')]),
+        FakeNode('c', images=[FakeImage('1.jpg')]),
+    ])
+    backup(tree, bucket, '', journal_path=path, resume=True)
+    assert finished == sorted(bucket.files)[:2]
+    assert sorted(bucket.files)[2].startswith('c/')
+    assert [] == bucket.hidden
+    assert not path.exists()
+
+
+def test_journal_is_locked(tmp_path):
+    path = tmp_path / 'journal'
+    journal = Journal(path, '')
+    # flock locks belong to open files, so a second open in the same process conflicts too.
+    with pytest.raises(JournalInUseError):
+        Journal(path, '')
+    journal.close()
+    Journal(path, '').close()
+
+
+def test_default_journal_path_depends_on_bucket_and_prefix():
+    paths = set(default_journal_path(bucket, prefix) for bucket in ['b1', 'b2'] for prefix in ['', 'x/'])
+    assert 4 == len(paths)
@@ -0,0 +1,81 @@
+import hashlib
+import io
+
+from b2sdk.v1 import B2Api, InMemoryAccountInfo, RawSimulator
+
+from smugmug_to_b2 import transfer
+from smugmug_to_b2.backup import SmugMugImage
+from smugmug_to_b2.large_file import MIN_PART_SIZE, upload_large_stream
+
+from test_backup import FakeBucket, FakeImage
+
+
+def make_bucket():
+    raw_api = RawSimulator()
+    api = B2Api(InMemoryAccountInfo(), raw_api=raw_api)
+    key_id, key = raw_api.create_account()
+    api.authorize_account('production', key_id, key)
+    return api.create_bucket('bucket', 'allPrivate')
+
+
+def count_part_uploads(bucket):
+    uploaded = []
+    upload_part = bucket.api.session.upload_part
+
+    def counting_upload_part(file_id, part_number, *args, **kwargs):
+        uploaded.append(part_number)
+        return upload_part(file_id, part_number, *args, **kwargs)
+
+    bucket.api.session.upload_part = counting_upload_part
+    return uploaded
+
+
+def test_upload_large_stream():
+    bucket = make_bucket()
+    content = bytes(range(256)) * (MIN_PART_SIZE * 5 // 2 // 256)
+    upload_large_stream(bucket, io.BytesIO(content), 'a/b.mp4', {'title': 't'}, MIN_PART_SIZE, 2)
+    [(file_version, _)] = list(bucket.ls('', recursive=True))
+    assert len(content) == file_version.size
+    assert {'title': 't'} == file_version.file_info
+
+
+def test_upload_small_stream_is_not_large_file():
+    bucket = make_bucket()
+    started = []
+    bucket.start_large_file = lambda *args: started.append(args)
+    upload_large_stream(bucket, io.BytesIO(b'x' * MIN_PART_SIZE), 'a/b.mp4', {}, MIN_PART_SIZE, 2)
+    assert [] == started
+    assert 1 == len(list(bucket.ls('', recursive=True)))
+
+
+def test_upload_large_stream_reuses_parts():
+    bucket = make_bucket()
+    content = b'y' * (MIN_PART_SIZE * 3)
+    first_part = content[:MIN_PART_SIZE]
+    file_id = bucket.start_large_file('a/b.mp4', None, {'title': 't'}).file_id
+    bucket.api.session.upload_part(
+        file_id, 1, len(first_part), hashlib.sha1(first_part).hexdigest(), io.BytesIO(first_part)
+    )
+    uploaded = count_part_uploads(bucket)
+    upload_large_stream(bucket, io.BytesIO(content), 'a/b.mp4', {'title': 't'}, MIN_PART_SIZE, 2)
+    assert [2, 3] == sorted(uploaded)
+    [(file_version, _)] = list(bucket.ls('', recursive=True))
+    assert len(content) == file_version.size
+
+
+def test_video_size_chooses_large_file(monkeypatch):
+    large_uploads = []
+
+    def fake_upload_large_stream(bucket, stream, file_name, file_infos, part_size, part_workers):
+        large_uploads.append(file_name)
+        return bucket.upload_unbound_stream(stream, file_name, file_info=file_infos).id_
+
+    monkeypatch.setattr(transfer, 'upload_large_stream', fake_upload_large_stream)
+    video = FakeImage('v.mp4', content=b'x' * 200)
+    # ArchivedSize of a video is not the size of the LargestVideo that is streamed.
+    video.byte_count = 10
+    video.content_location = lambda: (video.archived_uri, 200, video.archived_md5)
+    options = transfer.TransferOptions(part_size=MIN_PART_SIZE, large_file_threshold=100)
+    image = SmugMugImage('album/', video)
+    transfer.copy_from_smugmug_to_b2(image, FakeBucket(), transfer.UPLOAD, options=options)
+    assert [image.b2_path] == large_uploads
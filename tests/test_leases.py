@@ -0,0 +1,143 @@
+import pytest
+
+from benchmarks.memory_bucket import simulator_bucket
+from smugmug_to_b2.backup import all_b2_images, backup, make_content_index
+from smugmug_to_b2.exception import AppError
+from smugmug_to_b2.dedupe import DEDUPE_COPY
+from smugmug_to_b2.leases import (
+    DONE, HELD, NodeWithChildren, PrefixLease, lease_state, run_prefixes, top_level_prefixes
+)
+
+from test_backup import FakeBucket, FakeImage, FakeNode
+
+
+def claim(owner, status=HELD, duration_ms=10):
+    return dict(owner=owner, status=status, duration_ms=str(duration_ms))
+
+
+def test_lease_state_ignores_claims_while_held():
+    state = lease_state([(100, 'b', claim('bob')), (100, 'a', claim('alice')), (105, 'c', claim('bob'))])
+    assert ('alice', 110) == (state.holder, state.expires)
+    # After it runs out, the next claim takes it.
+    state = lease_state([(100, 'a', claim('alice')), (110, 'b', claim('bob'))])
+    assert 'bob' == state.holder
+    # Done is for good.
+    state = lease_state([(100, 'a', claim('alice', DONE, 0)), (200, 'b', claim('bob'))])
+    assert ('alice', True) == (state.holder, state.finished)
+
+
+def test_lease_is_taken_renewed_and_reclaimed():
+    bucket = simulator_bucket()
+    # The simulator's clock goes up a millisecond with each upload.
+    alice = PrefixLease(bucket, 'run', 'a/', 'alice', lease_seconds=0.003)
+    bob = PrefixLease(bucket, 'run', 'a/', 'bob', lease_seconds=0.003)
+    assert alice.acquire()
+    assert not bob.acquire()
+    assert alice.renew()
+    # Bob's losing claims were deleted, so only Alice's two are left.
+    assert 2 == len(list(bucket.list_file_versions(alice.name)))
+    bucket.upload_bytes(b'', 'elsewhere', file_info={})
+    bucket.upload_bytes(b'', 'elsewhere', file_info={})
+    # Alice stopped renewing, so her lease has run out.
+    assert bob.acquire()
+    assert not alice.renew()
+
+
+def test_renewals_delete_older_claims():
+    bucket = simulator_bucket()
+    alice = PrefixLease(bucket, 'run', 'a/', 'alice', lease_seconds=0.003)
+    bob = PrefixLease(bucket, 'run', 'a/', 'bob', lease_seconds=0.003)
+    assert alice.acquire()
+    for _ in range(5):
+        assert alice.renew()
+    assert 2 == len(list(bucket.list_file_versions(alice.name)))
+    # A claim by Bob that lost, and wasn't deleted, because Bob died first.
+    bob._claim(HELD, bob._duration_ms)
+    for _ in range(5):
+        assert alice.renew()
+    # Alice's claim before Bob's is kept, so that his still doesn't count.
+    owners = [version.file_info['owner'] for version in bucket.list_file_versions(alice.name)]
+    assert ['alice', 'alice', 'bob', 'alice'] == owners
+    assert not bob.acquire()
+
+
+def test_prefixes_include_folders_only_in_the_bucket():
+    bucket = simulator_bucket()
+    bucket.upload_bytes(b'', 'gone/album/a.jpg', file_info={})
+    bucket.upload_bytes(b'', 'x/album/b.jpg', file_info={})
+    assert PrefixLease(bucket, 'run', 'x/', 'alice').acquire()
+    assert ['gone/', 'x/', 'y/', 'z/'] == top_level_prefixes(three_folders(), bucket)
+
+
+def three_folders():
+    return FakeNode('', children=[
+        FakeNode(name, images=[FakeImage(name + '.jpg')]) for name in ['x', 'y', 'z']
+    ])
+
+
+def test_workers_share_folders():
+    bucket = simulator_bucket()
+    tree = three_folders()
+    prefixes = top_level_prefixes(tree)
+    assert ['x/', 'y/', 'z/'] == prefixes
+    alice = PrefixLease(bucket, 'run', 'x/', 'alice')
+    assert alice.acquire()
+    ran = []
+
+    def run(prefix):
+        ran.append(prefix)
+        backup(tree, bucket, prefix)
+
+    def sleep(seconds):
+        # Alice finishes while Bob waits for her.
+        backup(tree, bucket, 'x/')
+        alice.finish(DONE)
+
+    assert ['y/', 'z/'] == sorted(run_prefixes(bucket, 'run', prefixes, run, 'bob', sleep=sleep))
+    assert ['y/', 'z/'] == sorted(ran)
+    assert ['x', 'y', 'z'] == [image.file_name.split('.')[0] for image in all_b2_images(bucket, '')]
+    # Another worker joining the finished run has nothing to do.
+    assert [] == run_prefixes(bucket, 'run', prefixes, run, 'carol')
+
+
+class CountingNode(FakeNode):
+    def __init__(self, name, children):
+        super().__init__(name, children=children)
+        self._children = children
+        self.fetches = 0
+
+    @property
+    def children(self):
+        self.fetches += 1
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        pass
+
+
+def test_folders_share_the_top_node_and_content_index():
+    bucket = FakeBucket()
+    backup(three_folders(), bucket, '')
+    top = CountingNode('', three_folders().children)
+    node = NodeWithChildren(top)
+    content_index = make_content_index(bucket, None, True, DEDUPE_COPY)
+    listings = bucket.ls_count
+    for prefix in top_level_prefixes(node):
+        backup(node, bucket, prefix, dedupe=DEDUPE_COPY, content_index=content_index)
+    assert 1 == top.fetches
+    # Each folder's backup lists only its own folder.
+    assert listings + 3 == bucket.ls_count
+
+
+def test_failed_folder_is_reported():
+    bucket = simulator_bucket()
+
+    def run(prefix):
+        if prefix == 'y/':
+            raise ValueError('broken')
+
+    with pytest.raises(AppError):
+        run_prefixes(bucket, 'run', ['x/', 'y/'], run, 'bob')
+    assert 'broken' == PrefixLease(bucket, 'run', 'y/', 'carol').read().reason
+    assert PrefixLease(bucket, 'run', 'x/', 'carol').read().finished
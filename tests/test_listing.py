@@ -0,0 +1,39 @@
+from b2sdk.v1 import B2Api, InMemoryAccountInfo, RawSimulator
+
+from smugmug_to_b2.listing import parallel_ls
+
+
+def make_bucket(file_names):
+    raw_api = RawSimulator()
+    api = B2Api(InMemoryAccountInfo(), raw_api=raw_api)
+    key_id, key = raw_api.create_account()
+    api.authorize_account('production', key_id, key)
+    bucket = api.create_bucket('bucket', 'allPrivate')
+    for file_name in file_names:
+        bucket.upload_bytes(b'x', file_name)
+    return bucket
+
+
+FILE_NAMES = [
+    'a b/1.jpg',
+    'a/1.jpg',
+    'a/b/2.jpg',
+    'a/c/3.jpg',
+    'm.jpg',
+    'x/y/z/4.jpg',
+    'z/5.jpg',
+]
+
+
+def test_parallel_ls_matches_recursive_ls():
+    bucket = make_bucket(FILE_NAMES)
+    for workers in [1, 2, 8]:
+        assert FILE_NAMES == [f.file_name for f in parallel_ls(bucket, '', workers, fetch_count=2)]
+        assert FILE_NAMES[1:4] == [f.file_name for f in parallel_ls(bucket, 'a/', workers)]
+
+
+def test_parallel_ls_stops_early():
+    bucket = make_bucket(FILE_NAMES)
+    listing = parallel_ls(bucket, '', 2)
+    assert 'a b/1.jpg' == next(listing).file_name
+    listing.close()
@@ -0,0 +1,50 @@
+import pytest
+
+from smugmug_to_b2.backup import backup
+from smugmug_to_b2.exception import TransferError
+from smugmug_to_b2.metrics import Histogram, prometheus_text, run_metrics
+
+from test_backup import FakeBucket, FakeImage, make_tree
+
+
+def test_histogram_counts_are_cumulative():
+    histogram = Histogram(buckets=(1.0, 10.0))
+    for value in [0.5, 2.0, 3.0, 100.0]:
+        histogram.observe(value)
+    assert [(1.0, 1), (10.0, 3), ('+Inf', 4)] == histogram.cumulative_counts()
+    assert 105.5 == histogram.sum
+
+
+def test_backup_phases():
+    bucket = FakeBucket()
+    backup(make_tree(FakeImage('a.jpg', content=b'12345'), FakeImage('b.jpg')), bucket, '')
+    run_metrics.reset()
+    new_tree = make_tree(FakeImage('a.jpg', content=b'12345', caption='new'), FakeImage('c.jpg', content=b'12345'))
+    backup(new_tree, bucket, '', workers=2)
+    phases = run_metrics.summary()['phases']
+    assert (1, 5) == (phases['download']['count'], phases['download']['bytes'])
+    assert (1, 5) == (phases['upload']['count'], phases['upload']['bytes'])
+    assert (1, 5) == (phases['copy']['count'], phases['copy']['bytes'])
+    assert 2 == phases['hide']['count']
+    # The fake bucket lists without calling B2, and B2 calls are what the b2_list phase counts.
+    assert 0 == phases['b2_list']['count']
+    assert 2 == phases['crawl']['count']
+    assert (4, 4) == (run_metrics.done_count, run_metrics.planned_count)
+
+    text = prometheus_text(run_metrics.summary({'node': 3}, b2_requests={'b2_list_file_names': 2}))
+    assert 'smugmug_to_b2_phase_seconds_count{phase="hide"} 2' in text
+    assert 'smugmug_to_b2_phase_bytes_total{phase="upload"} 5' in text
+    assert 'smugmug_to_b2_smugmug_requests_total{endpoint="node"} 3' in text
+    assert 'smugmug_to_b2_b2_requests_total{endpoint="b2_list_file_names"} 2' in text
+
+
+def test_failed_transfers_are_not_done():
+    run_metrics.reset()
+    tree = make_tree(FakeImage('a.jpg', content=IOError('boom')), FakeImage('b.jpg', content=b'12345'))
+    with pytest.raises(TransferError):
+        backup(tree, FakeBucket(), '', workers=2)
+    done_count, failed_count, planned_count, done_bytes, planned_bytes, rate, eta = run_metrics.progress()
+    assert (1, 1, 2) == (done_count, failed_count, planned_count)
+    assert 5 == done_bytes
+    # Nothing is left to do, even though the failure was planned.
+    assert 0 == eta
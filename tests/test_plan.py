@@ -0,0 +1,89 @@
+import hashlib
+
+from smugmug_to_b2 import plan
+from smugmug_to_b2.backup import backup
+from smugmug_to_b2.metrics import run_metrics
+from smugmug_to_b2.plan import PlannedImage, apply_plan, make_plan, read_plan, size_aware_order, write_plan
+from smugmug_to_b2.transfer import HIDE, UPLOAD, Action
+
+from test_backup import FakeBucket, FakeImage, make_tree
+
+
+class FakeDownload:
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, contents):
+        self.contents = contents
+
+    def get(self, url, **kwargs):
+        return FakeDownload(self.contents[url])
+
+
+def image_with_content(file_name, content):
+    image = FakeImage(file_name, content)
+    image.archived_md5 = hashlib.md5(content).hexdigest()
+    return image
+
+
+def test_plan_and_apply(tmp_path):
+    bucket = FakeBucket()
+    bucket.files['album/old.jpg'] = (b'old', {})
+    images = [image_with_content('a.jpg', b'aaa'), image_with_content('b.jpg', b'bbbb')]
+    plan_path = tmp_path / 'plan.gz'
+    count, byte_count = write_plan(plan_path, '', make_plan(make_tree(*images), bucket, ''))
+    assert (3, 7) == (count, byte_count)
+
+    header, actions = read_plan(plan_path)
+    assert '' == header['prefix']
+    assert [HIDE, UPLOAD, UPLOAD] == sorted(action.kind for action in actions)
+
+    session = FakeSession(dict((image.archived_uri, image.open_content().read()) for image in images))
+    apply_plan(actions, bucket, workers=2, make_session=lambda: session)
+    assert ['album/old.jpg'] == bucket.hidden
+    assert [b'aaa', b'bbbb'] == [bucket.files[name][0] for name in sorted(bucket.files)]
+
+
+def upload_of_size(name, size):
+    image = PlannedImage('', '', size, '', '', name, '', '', '', '', name, 'url', size, 'md5')
+    return Action(UPLOAD, name, image)
+
+
+def test_size_aware_order_spreads_out_big_files():
+    small = [upload_of_size('small-%02d' % (i,), 1024 * 1024) for i in range(20)]
+    big = [upload_of_size('big-%d' % (i,), size * 1024 * 1024) for (i, size) in enumerate([60, 100])]
+    order = [action.b2_path for action in size_aware_order(small + big)]
+    assert sorted(order) == sorted(action.b2_path for action in small + big)
+    assert [action.b2_path for action in small] == [name for name in order if name.startswith('small')]
+    # The biggest goes first, and the next one waits until the small files have caught up.
+    assert 'big-1' == order[0]
+    assert 5 < order.index('big-0') < 15
+
+
+def test_open_content_without_a_session(monkeypatch):
+    monkeypatch.setattr(plan, '_plain_session', lambda: FakeSession({'url': b'abc'}))
+    image = PlannedImage('', '', 3, '', '', 'a.jpg', '', '', '', '', 'a.jpg', 'url', 3, hashlib.md5(b'abc').hexdigest())
+    with image.open_content() as stream:
+        assert b'abc' == stream.read()
+
+
+def test_plan_and_backup_count_the_same_bytes(tmp_path):
+    video = image_with_content('v.mp4', b'x' * 7)
+    # ArchivedSize of a video is not the size of the LargestVideo that is streamed.
+    video.byte_count = 100
+    video.content_location = lambda: (video.archived_uri, 7, video.archived_md5)
+    count, byte_count = write_plan(tmp_path / 'plan.gz', '', make_plan(make_tree(video), FakeBucket(), ''))
+    assert (1, 7) == (count, byte_count)
+    run_metrics.reset()
+    backup(make_tree(video), FakeBucket(), '')
+    assert (7, 7) == (run_metrics.planned_bytes, run_metrics.done_bytes)
@@ -0,0 +1,65 @@
+import pytest
+
+from smugmug_to_b2.backup import backup
+from smugmug_to_b2.metrics import run_metrics
+from smugmug_to_b2.reconcile import RECONCILE_SORT, sorted_zip, top_level_folder
+
+from test_backup import FakeBucket, FakeImage, FakeNode
+
+
+def test_sorted_zip_takes_any_order():
+    assert [(1, None), (None, 2), (3, 3), (4, None)] == list(sorted_zip([4, 3, 1], [3, 2]))
+
+
+def test_sorted_zip_uses_first_of_duplicates(tmp_path):
+    pairs = list(sorted_zip(['b1', 'a1', 'b2'], ['a9'], key=lambda s: s[0], directory=str(tmp_path)))
+    assert [('a1', 'a9'), ('b1', None)] == pairs
+    # The temporary database is gone.
+    assert [] == list(tmp_path.iterdir())
+
+
+def test_sorted_zip_yields_each_group_before_reading_the_next():
+    read = []
+
+    def listing(paths):
+        for path in paths:
+            read.append(path)
+            yield path
+
+    pairs = sorted_zip(listing(['a/2', 'a/1', 'b/1', 'c/1']), ['a/1', 'c/1'], group=top_level_folder)
+    assert ('a/1', 'a/1') == next(pairs)
+    assert 'c/1' not in read
+    assert [('a/2', None), ('b/1', None), ('c/1', 'c/1')] == list(pairs)
+
+
+def test_sorted_zip_counts_duplicates():
+    run_metrics.reset()
+    assert [('a', None), ('b', None)] == list(sorted_zip(['b', 'a', 'b', 'b'], []))
+    assert 2 == run_metrics.summary()['duplicates']
+
+
+def test_top_level_folder():
+    assert 'trip/' == top_level_folder('trip/day/a.jpg')
+    assert 'photos/trip/' == top_level_folder('photos/trip/day/a.jpg', 'photos/')
+    assert 'a.jpg' == top_level_folder('a.jpg')
+
+
+def two_albums_with_one_name():
+    return FakeNode('', children=[
+        FakeNode('trip', images=[FakeImage('b.jpg')]),
+        FakeNode('trip', images=[FakeImage('a.jpg'), FakeImage('b.jpg')]),
+    ])
+
+
+def test_duplicate_albums_stop_a_streaming_backup():
+    with pytest.raises(AssertionError):
+        backup(two_albums_with_one_name(), FakeBucket(), '')
+
+
+def test_duplicate_albums_with_sort():
+    bucket = FakeBucket()
+    backup(two_albums_with_one_name(), bucket, '', reconcile=RECONCILE_SORT)
+    assert ['trip/a', 'trip/b'] == sorted(name.split('.')[0] for name in bucket.files)
+    # A second run finds everything in place.
+    backup(two_albums_with_one_name(), bucket, '', reconcile=RECONCILE_SORT)
+    assert [] == bucket.hidden
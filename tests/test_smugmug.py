@@ -0,0 +1,170 @@
+import hashlib
+import pytest
+
+from urllib.parse import parse_qsl, urlsplit
+
+from smugmug_to_b2.exception import ContentError
+from smugmug_to_b2.smugmug import (
+    MAX_PAGE_SIZE,
+    BaseObject,
+    LargestVideo,
+    VerifyingStream,
+    _get_paged_json,
+    _iter_paged_json,
+    configure_paging,
+    endpoint_name,
+    request_counter,
+)
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+def read_all(stream, size):
+    result = b''
+    while True:
+        data = stream.read(size)
+        if not data:
+            return result
+        result += data
+
+
+def test_verifying_stream_good():
+    content = b'0123456789' * 10
+    response = FakeResponse(content)
+    stream = VerifyingStream(response, 'url', len(content), hashlib.md5(content).hexdigest(), chunk_size=7)
+    assert content == read_all(stream, 5)
+    assert response.closed
+
+
+def test_verifying_stream_bad_md5():
+    stream = VerifyingStream(FakeResponse(b'abc'), 'url', 3, 'not-the-md5', chunk_size=2)
+    with pytest.raises(ContentError):
+        read_all(stream, 100)
+
+
+def test_verifying_stream_bad_size():
+    stream = VerifyingStream(FakeResponse(b'abc'), 'url', 4, None, chunk_size=2)
+    with pytest.raises(ContentError):
+        stream.read()
+
+
+class FakeJsonResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return {'Response': self._data}
+
+
+class FakePagingSession:
+    """Serves a list of 'total' numbered AlbumImages, a page at a time."""
+
+    def __init__(self, total):
+        self.total = total
+        self.paths = []
+        self.sessions = []
+
+    def get(self, url, headers=None):
+        self.paths.append(url)
+        self.sessions.append(self)
+        query = dict(parse_qsl(urlsplit(url).query))
+        start = int(query['start'])
+        count = int(query['count'])
+        items = list(range(start, min(start + count, self.total + 1)))
+        next_page = '/next' if start + count <= self.total else None
+        return FakeJsonResponse({
+            'Locator': 'AlbumImage',
+            'AlbumImage': items,
+            'Pages': {'Total': self.total, 'Start': start, 'Count': len(items), 'NextPage': next_page},
+        })
+
+
+def test_get_paged_json_merges_pages_in_order():
+    configure_paging(page_size=7, page_workers=3)
+    try:
+        session = FakePagingSession(30)
+        before = request_counter.total()
+        result = _get_paged_json(session, '/api/v2/album/abc!images')
+        assert list(range(1, 31)) == result['AlbumImage']
+        assert 'Pages' not in result
+        assert 5 == len(session.paths)
+        assert 5 == request_counter.total() - before
+        # Only the first page is fetched with the caller's session.
+        assert [session] == [s for s in session.sessions if s is session]
+    finally:
+        configure_paging(page_size=MAX_PAGE_SIZE)
+
+
+def test_iter_paged_json_yields_pages_as_they_come():
+    configure_paging(page_size=7, page_workers=2)
+    try:
+        session = FakePagingSession(30)
+        pages = _iter_paged_json(session, '/api/v2/album/abc!images')
+        assert list(range(1, 8)) == next(pages)['AlbumImage']
+        # Only the first page has been asked for so far.
+        assert 1 == len(session.paths)
+        assert list(range(8, 31)) == [i for page in pages for i in page['AlbumImage']]
+    finally:
+        configure_paging(page_size=MAX_PAGE_SIZE)
+
+
+def test_endpoint_name():
+    assert 'node!children' == endpoint_name('/api/v2/node/XwLd6!children?count=100')
+    assert 'node' == endpoint_name('/api/v2/node/XwLd6')
+    assert '!authuser' == endpoint_name('/api/v2!authuser')
+
+
+def test_expansion_saves_request():
+    video_uri = '/api/v2/largestvideo/abc'
+    expansions = {video_uri: {'LargestVideo': {'Url': 'https://example.com/v.mp4', 'Size': 3, 'MD5': 'x'}}}
+    image = BaseObject.make_object(
+        None,
+        'AlbumImage',
+        {'Format': 'MP4', 'Uris': {'LargestVideo': {'Uri': video_uri}}},
+        expansions
+    )
+    video = image.largest_video
+    assert isinstance(video, LargestVideo)
+    assert 3 == video.size
+
+
+def test_expansion_with_extra_keys():
+    video_uri = '/api/v2/largestvideo/abc'
+    expansion = {
+        'Uri': video_uri, 'LocatorType': 'Object', 'UriDescription': 'Largest video', 'DocUri': '/docs',
+        'LargestVideo': {'Url': 'https://example.com/v.mp4', 'Size': 3, 'MD5': 'x'}
+    }
+    image = BaseObject.make_object(
+        None,
+        'AlbumImage',
+        {'Format': 'MP4', 'Uris': {'LargestVideo': {'Uri': video_uri}}},
+        {video_uri: expansion}
+    )
+    assert 3 == image.largest_video.size
+
+
+def test_image_record_keeps_only_what_backup_needs():
+    video_uri = '/api/v2/largestvideo/abc'
+    expansions = {video_uri: {'LargestVideo': {'Url': 'https://example.com/v.mp4', 'Size': 3, 'MD5': 'x'}}}
+    data = {
+        'ArchivedMD5': 'a', 'ArchivedSize': 5, 'ArchivedUri': 'https://example.com/v.mov', 'Caption': 'c',
+        'Date': 'd', 'FileName': 'v.mov', 'Format': 'MP4', 'ImageKey': 'k', 'Keywords': '', 'LastUpdated': 'u',
+        'Title': '', 'Uris': {'LargestVideo': {'Uri': video_uri}}
+    }
+    record = BaseObject.make_object(None, 'AlbumImage', data, expansions).record()
+    assert not hasattr(record, '__dict__')
+    assert ('https://example.com/v.mp4', 3, 'x') == record.content_location()
+    assert ('a', 5, 'v.mov') == (record.archived_md5, record.byte_count, record.file_name)
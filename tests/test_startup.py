@@ -0,0 +1,14 @@
+from benchmarks.startup import COMMAND_LINE, STARTUP_BUDGET_SECONDS, import_times, slow_imports
+
+
+def test_command_line_imports_quickly():
+    times = import_times()
+    assert [] == slow_imports(times)
+    _, cumulative = times[COMMAND_LINE]
+    assert cumulative < STARTUP_BUDGET_SECONDS
+
+
+def test_help_imports_nothing_slow():
+    times = import_times(['--help'])
+    assert COMMAND_LINE in times
+    assert [] == slow_imports(times)
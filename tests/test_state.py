@@ -0,0 +1,91 @@
+from smugmug_to_b2.backup import all_b2_images, backup
+from smugmug_to_b2.state import StateDb, rebuild_state
+
+from test_backup import FakeBucket, FakeImage, FakeNode, make_tree
+
+
+def test_backup_with_state_skips_listing_bucket(tmp_path):
+    bucket = FakeBucket()
+    with StateDb(tmp_path / 'state.sqlite') as state:
+        backup(make_tree(FakeImage('a.jpg'), FakeImage('b.jpg')), bucket, '', state=state)
+        assert 0 == bucket.ls_count
+        assert sorted(bucket.files) == [i.b2_path for i in state.images()]
+
+        backup(make_tree(FakeImage('a.jpg'), FakeImage('b.jpg')), bucket, '', state=state)
+        assert 0 == bucket.ls_count
+
+        backup(make_tree(FakeImage('a.jpg')), bucket, '', state=state)
+        assert 0 == bucket.ls_count
+        assert 1 == len(bucket.files)
+        assert sorted(bucket.files) == [i.b2_path for i in state.images()]
+
+
+def test_full_backup_brings_state_up_to_date(tmp_path):
+    bucket = FakeBucket()
+    backup(make_tree(FakeImage('a.jpg'), FakeImage('b.jpg')), bucket, '')
+    with StateDb(tmp_path / 'state.sqlite') as state:
+        backup(make_tree(FakeImage('a.jpg'), FakeImage('b.jpg')), bucket, '', state=state, full=True)
+        images = list(state.images())
+        assert sorted(bucket.files) == [i.b2_path for i in images]
+        assert ['md5-a.jpg', 'md5-b.jpg'] == [i.archived_md5 for i in images]
+
+
+def test_rebuild_state(tmp_path):
+    bucket = FakeBucket()
+    backup(make_tree(FakeImage('a.jpg'), FakeImage('b.jpg')), bucket, '')
+    with StateDb(tmp_path / 'state.sqlite') as state:
+        assert 2 == rebuild_state(state, all_b2_images(bucket, ''))
+        images = list(state.images('album/'))
+        assert sorted(bucket.files) == [i.b2_path for i in images]
+        assert ['key-a.jpg', 'key-b.jpg'] == [i.image_key for i in images]
+        assert [] == list(state.images('other/'))
+
+
+def test_rebuilt_state_of_an_older_bucket_is_filled_in(tmp_path):
+    bucket = FakeBucket()
+    backup(make_tree(FakeImage('a.jpg'), FakeImage('b.jpg')), bucket, '')
+    # Older versions only recorded the metadata in the file info.
+    for (name, (content, info)) in bucket.files.items():
+        bucket.files[name] = (content, dict((k, info[k]) for k in ['caption', 'file_name', 'keywords', 'title']))
+    uploaded = dict(bucket.files)
+    with StateDb(tmp_path / 'state.sqlite') as state:
+        rebuild_state(state, all_b2_images(bucket, ''))
+        assert [None, None] == [i.archived_md5 for i in state.images()]
+        assert (0, 0) == backup(make_tree(FakeImage('a.jpg'), FakeImage('b.jpg')), bucket, '', state=state)
+        assert uploaded == bucket.files
+        assert ['md5-a.jpg', 'md5-b.jpg'] == [i.archived_md5 for i in state.images()]
+
+
+class CountingList(list):
+    def __init__(self, items, counter):
+        super().__init__(items)
+        self.counter = counter
+
+    def __iter__(self):
+        self.counter.append(1)
+        return super().__iter__()
+
+
+def test_unchanged_albums_are_skipped(tmp_path):
+    bucket = FakeBucket()
+    listings = []
+
+    def make_tree_with_stamps(a_stamp, b_stamp):
+        return FakeNode('', children=[
+            FakeNode('a', images=CountingList([FakeImage('1.jpg')], listings), last_updated=a_stamp),
+            FakeNode('b', images=CountingList([FakeImage('2.jpg')], listings), last_updated=b_stamp),
+        ])
+
+    with StateDb(tmp_path / 'state.sqlite') as state:
+        backup(make_tree_with_stamps('t1', 't1'), bucket, '', state=state, skip_unchanged_albums=True)
+        assert 2 == len(listings)
+        assert 2 == len(bucket.files)
+
+        backup(make_tree_with_stamps('t1', 't1'), bucket, '', state=state, skip_unchanged_albums=True)
+        assert 2 == len(listings)
+        assert 2 == len(bucket.files)
+
+        backup(make_tree_with_stamps('t1', 't2'), bucket, '', state=state, skip_unchanged_albums=True)
+        assert 3 == len(listings)
+        assert 2 == len(bucket.files)
+        assert ['a/', 'b/'] == sorted(state.albums())
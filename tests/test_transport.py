@@ -0,0 +1,116 @@
+import argparse
+
+import pytest
+import requests
+
+from smugmug_to_b2 import smugmug, transport
+from smugmug_to_b2.transport import (
+    RetryPolicy,
+    configure_transport,
+    mount_pools,
+    retry_counter,
+    send_with_retry,
+    session_for_thread,
+)
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def get(self, url, **kwargs):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture
+def fast_policy():
+    configure_transport(retry_policy=RetryPolicy(base_delay=0.5, max_delay=10, max_total_time=100))
+    yield
+    configure_transport(retry_policy=RetryPolicy())
+
+
+def test_retries_until_success(fast_policy):
+    sleeps = []
+    session = FakeSession(
+        FakeResponse(503),
+        requests.ConnectionError('reset'),
+        FakeResponse(429, {'Retry-After': '7'}),
+        FakeResponse(200),
+    )
+    before = retry_counter.as_dict().get('test', 0)
+    response = send_with_retry(session, 'url', 'test', sleep=sleeps.append)
+    assert 200 == response.status_code
+    assert 3 == len(sleeps)
+    assert 0 <= sleeps[0] <= 0.5
+    assert 0 <= sleeps[1] <= 1.0
+    assert 7 == sleeps[2]
+    assert 3 == retry_counter.as_dict()['test'] - before
+
+
+def test_does_not_retry_client_errors(fast_policy):
+    sleeps = []
+    response = send_with_retry(FakeSession(FakeResponse(404)), 'url', 'test', sleep=sleeps.append)
+    assert 404 == response.status_code
+    assert [] == sleeps
+
+
+def test_gives_up_when_out_of_time():
+    configure_transport(retry_policy=RetryPolicy(max_total_time=5))
+    try:
+        session = FakeSession(FakeResponse(503, {'Retry-After': '60'}))
+        response = send_with_retry(session, 'url', 'test', sleep=pytest.fail)
+        assert 503 == response.status_code
+    finally:
+        configure_transport(retry_policy=RetryPolicy())
+
+
+def test_session_for_thread_shares_only_pools():
+    session = mount_pools(requests.Session())
+    session.headers['X-Test'] = 'yes'
+    copy = session_for_thread(session)
+    assert copy is not session
+    assert copy.cookies is not session.cookies
+    assert copy.headers is not session.headers
+    assert 'yes' == copy.headers['X-Test']
+    assert copy.get_adapter('https://api.smugmug.com') is session.get_adapter('https://api.smugmug.com')
+
+
+def test_pool_size_reaches_the_first_session():
+    from smugmug_to_b2.command_line import configure_requests
+    from smugmug_to_b2.transport import DEFAULT_POOL_SIZE
+    configure_requests(argparse.Namespace(pool_size=3, max_retry_time=5.0))
+    try:
+        session = mount_pools(requests.Session())
+        assert 3 == session.get_adapter('https://api.smugmug.com')._pool_maxsize
+    finally:
+        configure_transport(DEFAULT_POOL_SIZE, RetryPolicy())
+
+
+def test_shared_pools_are_sized_for_every_job(monkeypatch):
+    from smugmug_to_b2.command_line import configure_requests
+    args = argparse.Namespace(
+        all=True, jobs=3, workers=4, max_workers=10, crawl_workers=8, page_size=None, page_workers=2,
+        pool_size=None, max_retry_time=5.0
+    )
+    monkeypatch.setattr(transport, '_shared_adapter', None)
+    monkeypatch.setattr(transport, '_shared_pool_size', None)
+    monkeypatch.setattr(transport, '_retry_policy', transport.DEFAULT_RETRY_POLICY)
+    monkeypatch.setattr(smugmug, '_page_workers', smugmug.DEFAULT_PAGE_WORKERS)
+    configure_requests(args)
+    session = mount_pools(requests.Session(), shared=True)
+    assert 3 * (10 + 8 + 2) == session.get_adapter('https://api.smugmug.com')._pool_maxsize
+    # Sessions of their own keep the size for one session.
+    session = mount_pools(requests.Session())
+    assert transport.DEFAULT_POOL_SIZE == session.get_adapter('https://api.smugmug.com')._pool_maxsize